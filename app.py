@@ -3,18 +3,30 @@ from langchain.chat_models import ChatOpenAI
 from langchain.schema import HumanMessage, AIMessage
 from langchain.memory import ConversationSummaryBufferMemory
 from langchain.callbacks.base import BaseCallbackHandler
-from langchain.utilities import SQLDatabase
 import pandas as pd
-from sqlalchemy import create_engine, text
 from dotenv import load_dotenv
 import glob
+import logging
 import os
-import re
-import json
+import queue
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import shutil
 import toml
 
+from database import get_conn_str, create_pooled_engine, cancel_backend
+from pipeline import Pipeline, PipelineSettings, load_prompt_template
+from result_store import ResultStore, purge_stale_sessions, result_metadata
+from result_summary import ShadowMemory, summarize_result
+from memory_worker import BackgroundSummarizer
+from llm_cache import replay_tokens, shared_llm_cache
+from tracing import LLMTraceHandler, StageMetrics, Trace, start_metrics_server
+
+logger = logging.getLogger(__name__)
+
 # --- Paths ---
 CUSTOM_DIR = Path("customizations")
 LOGO_DIR = CUSTOM_DIR / "logos"
@@ -23,6 +35,9 @@ THEME_FILE = Path("custom_theme.toml")
 STREAMLIT_CONFIG = Path(".streamlit/config.toml")
 STREAMLIT_CONFIG.parent.mkdir(exist_ok=True)
 
+# --- DB connection + tuning settings (PG_*, RESULT_CACHE_*, ...) ---
+load_dotenv("db_config.env")
+
 # --- Load title ---
 default_title = "Text-to-SQL Agentic AI Chatbot"
 if TITLE_FILE.exists():
@@ -62,6 +77,10 @@ st.sidebar.title("Settings")
 api_key = st.sidebar.text_input("🔑 OpenAI API key", type="password")
 
 if st.sidebar.button("🧹 Clear Conversation"):
+    if "result_store" in st.session_state:
+        st.session_state.result_store.clear()
+    if st.session_state.get("memory") is not None:
+        st.session_state.memory.stop()
     st.session_state.clear()
     st.rerun()
 
@@ -70,6 +89,27 @@ prompt_files = glob.glob("./prompts/*.md")
 prompt_options = ["None"] + [os.path.basename(f) for f in prompt_files]
 selected_prompt = st.sidebar.selectbox("Select Prompt Template", prompt_options)
 display_formatted_prompt_in_chat = st.sidebar.checkbox("Display prompt in chat", value=False)
+reuse_cached_sql = st.sidebar.checkbox("Reuse SQL for repeated questions", value=True)
+question_match_mode = st.sidebar.selectbox("Question matching", ["normalized", "fuzzy"])
+prune_schema_in_prompt = st.sidebar.checkbox("Only send relevant tables to the LLM", value=True)
+COST_GUARD_ACTIONS = {
+    "Ask the model to aggregate": "feedback",
+    "Fetch the first rows only": "limit",
+    "Show a row-count preview": "aggregate",
+}
+parallel_sql_candidates = st.sidebar.slider(
+    "Parallel SQL candidates", min_value=1, max_value=5, value=1,
+    help="Ask for several queries at once and run the cheapest valid one (1 = off)",
+)
+cost_guard_action = COST_GUARD_ACTIONS[st.sidebar.selectbox("Over-budget queries", list(COST_GUARD_ACTIONS))]
+cache_llm_completions = st.sidebar.checkbox(
+    "Cache LLM completions", value=True,
+    help="Replay the stored answer to an identical prompt (temperature-0 calls only)",
+)
+
+# Conversation memory: buffer size before summarizing, result summary size
+MEMORY_MAX_TOKENS = int(os.getenv("MEMORY_MAX_TOKENS", "6000"))
+RESULT_SUMMARY_TOKENS = int(os.getenv("RESULT_SUMMARY_TOKENS", "250"))
 
 # --------------------------- #
 #   SESSION STATE INIT
@@ -80,114 +120,368 @@ if "memory" not in st.session_state:
     st.session_state.memory = None
 if "llm" not in st.session_state:
     st.session_state.llm = None
-if "db" not in st.session_state:
-    st.session_state.db = None
-if "engine" not in st.session_state:
-    st.session_state.engine = None
+if "classification_llm" not in st.session_state:
+    st.session_state.classification_llm = None
+if "candidate_llm" not in st.session_state:
+    st.session_state.candidate_llm = None
+if "stream_metrics" not in st.session_state:
+    st.session_state.stream_metrics = {"renders": 0, "bytes_sent": 0, "tokens": 0}
+if "result_store" not in st.session_state:
+    # Full query results live on disk; messages only keep previews
+    st.session_state.result_store = ResultStore(
+        uuid.uuid4().hex,
+        max_disk_bytes=int(os.getenv("RESULT_STORE_MAX_MB", "512")) * 1024 ** 2,
+        max_memory_bytes=int(os.getenv("RESULT_STORE_MEMORY_MB", "64")) * 1024 ** 2,
+    )
+if "memory_shadow" not in st.session_state:
+    # What the memory buffer would hold with raw DataFrame reprs vs compact summaries
+    st.session_state.memory_shadow = {
+        "repr": ShadowMemory(MEMORY_MAX_TOKENS),
+        "summary": ShadowMemory(MEMORY_MAX_TOKENS),
+    }
+if "chart_data" not in st.session_state:
+    st.session_state.chart_data = OrderedDict()
+if "prompt_tokens" not in st.session_state:
+    st.session_state.prompt_tokens = {"before": 0, "after": 0}
+if "validation_stats" not in st.session_state:
+    st.session_state.validation_stats = {"fixed": 0, "rejected": 0}
+if "llm_traces" not in st.session_state:
+    # Per-LLM callbacks that add an "llm" span (tokens, time to first token) to the current turn's trace
+    st.session_state.llm_traces = {name: LLMTraceHandler(name) for name in ("chat", "helper", "candidates")}
+if "last_trace" not in st.session_state:
+    st.session_state.last_trace = None
 
 # --------------------------- #
 #     UTILITIES
 # --------------------------- #
-def load_prompt(filepath: str) -> str:
-    """Load a .md prompt template from disk."""
-    with open(filepath, "r") as file:
-        return file.read()
+# Limits and thresholds of the pipeline (QUERY_*, PLOT_*, *_CONFIDENCE_THRESHOLD, ...)
+SETTINGS = PipelineSettings.from_env()
 
-def extract_sql(response_text: str) -> str:
+@st.cache_resource
+def get_pipeline() -> Pipeline:
     """
-    Extract SQL code from triple-backtick ```sql ... ``` blocks.
-    Returns the first match or None if no block found.
+    One text-to-SQL pipeline per server process, shared by every session:
+    pooled engine, result cache, question -> SQL cache, local classifier.
     """
-    pattern = r"```sql\s*(.*?)\s*```"
-    matches = re.findall(pattern, response_text, flags=re.DOTALL | re.IGNORECASE)
-    return matches[0].strip() if matches else None
-
-def run_query(sql_query: str) -> pd.DataFrame:
-    """Run a SQL query and return a Pandas DataFrame."""
-    with st.session_state.engine.connect() as conn:
-        df = pd.read_sql(text(sql_query), conn)
-    return df
+    return Pipeline(create_pooled_engine(get_conn_str("db_config.env")), SETTINGS)
+
+@st.cache_resource
+def get_query_executor() -> ThreadPoolExecutor:
+    """Threads that run queries so the script thread stays free to react to Cancel."""
+    max_workers = int(os.getenv("PG_POOL_SIZE", "5")) + int(os.getenv("PG_MAX_OVERFLOW", "10"))
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="query")
 
-def extract_chart_instruction(response_text: str):
+@st.cache_resource
+def get_metrics() -> StageMetrics:
+    """
+    Per-stage latency of every session in this process, also served as
+    Prometheus text on METRICS_PORT (default 9464, empty to disable).
     """
-    Look for a JSON object of the form:
-      {
-         "chart_type": "bar" / "line" / "scatter",
-         "x": "Month",
-         "y": "Revenue"
-      }
-    Returns a dict or None if not found/invalid.
+    metrics = StageMetrics()
+    port = os.getenv("METRICS_PORT", "9464")
+    if port:
+        try:
+            start_metrics_server(metrics, int(port), os.getenv("METRICS_HOST", "127.0.0.1"))
+        except OSError as e:  # e.g. a second app process on the same host
+            logger.warning("Metrics endpoint not started on port %s: %s", port, e)
+    return metrics
+
+def render_latency_panel(metrics: StageMetrics, last_trace: dict = None):
+    """Sidebar p50 / p95 / p99 per stage (all sessions of this process) and the spans of the last turn."""
+    summary = metrics.summary()
+    if not summary:
+        return
+    with st.sidebar.expander("⏱️ Stage latency"):
+        st.dataframe(pd.DataFrame([
+            {"stage": stage, "n": stats["count"], "p50 ms": round(stats["p50"] * 1000),
+             "p95 ms": round(stats["p95"] * 1000), "p99 ms": round(stats["p99"] * 1000)}
+            for stage, stats in summary.items()
+        ]).set_index("stage"))
+        if last_trace:
+            st.caption(f"Last turn ({last_trace.get('action')}): {last_trace['seconds']:.2f}s, "
+                       f"{last_trace.get('retries', 0)} retries")
+            details = ("llm", "attempt", "rows", "prompt_tokens", "completion_tokens", "error")
+            st.dataframe(pd.DataFrame([
+                {"stage": span["name"], "ms": round(span["seconds"] * 1000),
+                 "detail": ", ".join(f"{k}={span[k]}" for k in details if span.get(k) is not None)}
+                for span in last_trace["spans"]
+            ]), hide_index=True)
+
+# Parallel candidate generation (sidebar "Parallel SQL candidates" > 1)
+SQL_CANDIDATE_TEMPERATURE = float(os.getenv("SQL_CANDIDATE_TEMPERATURE", "0.7"))
+
+def run_query(sql_query: str, on_chunk=None) -> pd.DataFrame:
     """
+    Run a SQL query through the pipeline and return a Pandas DataFrame.
+    Identical (normalized) read-only queries are served from the shared result cache.
+    on_chunk(chunk_df, rows_so_far) is called as chunks arrive.
+
+    The query runs on a worker thread under QUERY_TIMEOUT_SECONDS while this
+    thread shows a Cancel button. Clicking it reruns the script, which
+    interrupts the wait below; the finally-block then cancels the backend.
+    """
+    pipeline = get_pipeline()
+    if sql_query in pipeline.result_cache:
+        df = pipeline.result_cache.get(sql_query)
+        if df is not None:
+            return df
+
+    chunks = queue.Queue()
+    backend = {}
+    future = get_query_executor().submit(
+        pipeline.run_sql,
+        sql_query,
+        on_chunk=lambda chunk, rows: chunks.put((chunk, rows)),
+        on_backend_pid=lambda pid: backend.update(pid=pid),
+    )
+
+    controls = st.empty()
+    with controls.container():
+        st.button("⏹ Cancel query", key=f"cancel_query_{uuid.uuid4().hex}")
+        elapsed = st.empty()
+    started = time.time()
+    last_tick = 0.0
     try:
-        match = re.search(r"{\s*\"chart_type\".*?}", response_text, re.DOTALL)
-        if match:
-            return json.loads(match.group())
-    except Exception:
+        while not future.done() or not chunks.empty():
+            try:
+                chunk, rows = chunks.get(timeout=0.1)
+                if on_chunk is not None:
+                    on_chunk(chunk, rows)
+            except queue.Empty:
+                pass
+            # Any Streamlit call lets a pending rerun (Cancel click) interrupt us
+            if time.time() - last_tick >= 0.5:
+                last_tick = time.time()
+                elapsed.caption(f"⏱️ Query running for {last_tick - started:.0f}s...")
+    finally:
+        if not future.done():
+            # Interrupted by Cancel, a new message or a closed session
+            if "pid" in backend:
+                cancel_backend(pipeline.engine, backend["pid"])
+            st.session_state.messages.append(AIMessage(content="⏹ Query cancelled."))
+    controls.empty()
+    return future.result()
+
+def show_dataframe(df: pd.DataFrame, container=None):
+    """Display a result, flagging it when the row/byte cap cut it short."""
+    container = container or st.container()
+    with container:
+        st.dataframe(df)
+        if df.attrs.get("truncated_at"):
+            st.caption(
+                f"⚠️ Result truncated at {df.attrs['truncated_at']:,} rows "
+                f"(limit {SETTINGS.max_rows:,} rows / {SETTINGS.max_mb} MB). "
+                "Add filters or aggregate to see everything."
+            )
+
+def show_stored_result(metadata: dict, key: str):
+    """
+    Re-render a result from chat history: the stored preview, or the full
+    result (loaded from disk) when the user asks for it. Returns the full
+    DataFrame if it was loaded, else None.
+    """
+    preview = metadata["df_preview"]
+    if metadata["rows"] <= len(preview):
+        st.dataframe(preview)
         return None
+    if st.toggle(f"Show all {metadata['rows']:,} rows", key=key):
+        df = load_result(metadata)
+        if df is not None:
+            show_dataframe(df)
+            return df
+        st.caption("⚠️ The full result is no longer stored; showing the preview.")
+    st.dataframe(preview)
+    st.caption(f"Showing the first {len(preview):,} of {metadata['rows']:,} rows.")
     return None
 
-def get_last_dataframe() -> pd.DataFrame:
+# Messages at the end of the history rendered in full on every rerun
+HISTORY_EXPANDED_MESSAGES = int(os.getenv("HISTORY_EXPANDED_MESSAGES", "6"))
+CHART_DATA_CACHE_ENTRIES = int(os.getenv("CHART_DATA_CACHE_ENTRIES", "16"))
+
+def get_chart_data(metadata: dict, plot_spec: dict):
     """
-    Return the most recent DataFrame from conversation history,
-    or None if not found.
+    Reduced (data, spec, note) of a saved chart, prepared once per message and
+    kept in a small per-session LRU so reruns do not reload the result from disk.
     """
+    y_cols = plot_spec["y"] if isinstance(plot_spec["y"], list) else [plot_spec["y"]]
+    key = (metadata["result_id"], plot_spec["chart_type"], plot_spec["x"], tuple(y_cols))
+    cache = st.session_state.chart_data
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+    df = load_result(metadata)
+    if df is None:
+        return None
+    prepared = get_pipeline().prepare_chart(df, plot_spec)
+    cache[key] = prepared
+    while len(cache) > CHART_DATA_CACHE_ENTRIES:
+        cache.popitem(last=False)
+    return prepared
+
+def render_chart(df: pd.DataFrame, plot_spec: dict, note: str = None):
+    """Draw a {"chart_type", "x", "y"[, "size"]} spec prepared by Pipeline.prepare_chart()."""
+    chart_type = plot_spec["chart_type"]
+    x_col = plot_spec["x"]
+    y_col = plot_spec["y"]
+    if chart_type == "line":
+        st.line_chart(df, x=x_col, y=y_col)
+    elif chart_type == "scatter":
+        st.scatter_chart(df, x=x_col, y=y_col, size=plot_spec.get("size"))
+    else:
+        st.bar_chart(df, x=x_col, y=y_col)
+    if note:
+        st.caption(f"📉 {note}")
+
+def render_message_results(metadata: dict, key: str, expanded: bool):
+    """
+    Result table and chart of a history message. Collapsed messages show a
+    one-line placeholder and only render (and load) anything when toggled.
+    """
+    plot_spec = metadata.get("plot")
+    if "result_id" in metadata and not isinstance(plot_spec, dict):
+        if expanded:
+            show_stored_result(metadata, key=f"{key}_rows")
+        elif st.toggle(f"📄 Result: {metadata['rows']:,} rows × {metadata['df_preview'].shape[1]} columns",
+                       key=f"{key}_result"):
+            show_stored_result(metadata, key=f"{key}_rows")
+
+    if isinstance(plot_spec, dict) and "result_id" in metadata:
+        label = f"📊 {plot_spec['chart_type']} chart of {plot_spec['y']} by {plot_spec['x']}"
+        if expanded or st.toggle(label, key=f"{key}_chart"):
+            prepared = get_chart_data(metadata, plot_spec)
+            if prepared is None:
+                st.caption("⚠️ The data for this chart is no longer stored.")
+                return
+            try:
+                render_chart(*prepared)
+            except Exception as e:
+                st.error(f"❌ Failed to plot chart: {e}")
+
+def make_chunk_preview(placeholder):
+    """on_chunk callback that shows the first chunk immediately, then a row counter."""
+    box = placeholder.container()
+    preview = box.empty()
+    counter = box.empty()
+    def on_chunk(chunk: pd.DataFrame, rows_so_far: int):
+        if rows_so_far == len(chunk):
+            preview.dataframe(chunk)
+        counter.caption(f"⏳ Fetched {rows_so_far:,} rows so far...")
+    return on_chunk
+
+@st.cache_resource
+def purge_old_results() -> int:
+    """Once per process: remove spilled results of sessions that are long gone."""
+    max_age_hours = float(os.getenv("RESULT_STORE_MAX_AGE_HOURS", "24"))
+    return purge_stale_sessions(max_age_seconds=max_age_hours * 3600)
+
+def load_result(metadata: dict):
+    """Full DataFrame behind a message's result metadata (read lazily from the result store)."""
+    df = st.session_state.result_store.get(metadata["result_id"])
+    if df is not None and metadata.get("truncated_at"):
+        df.attrs["truncated_at"] = metadata["truncated_at"]
+    return df
+
+def get_last_result_metadata() -> dict:
+    """Result metadata of the most recent query result (plots and their aggregates are skipped), or None."""
     for msg in reversed(st.session_state.messages):
         if isinstance(msg, AIMessage):
-            if msg.metadata and "df_result" in msg.metadata:
-                df = msg.metadata["df_result"]
-                if isinstance(df, pd.DataFrame):
-                    return df
+            if msg.metadata and "result_id" in msg.metadata and "plot" not in msg.metadata:
+                return msg.metadata
     return None
 
+def get_last_dataframe() -> pd.DataFrame:
+    """
+    Return the most recent DataFrame from conversation history,
+    or None if not found.
+    """
+    metadata = get_last_result_metadata()
+    return load_result(metadata) if metadata else None
+
 
 # --------------------------- #
 #  STREAM HANDLER (for LLM)
 # --------------------------- #
+# Re-render streamed text at most this often / after this many new characters
+STREAM_FLUSH_SECONDS = float(os.getenv("STREAM_FLUSH_MS", "50")) / 1000
+STREAM_FLUSH_CHARS = int(os.getenv("STREAM_FLUSH_CHARS", "2000"))
+
 class StreamHandler(BaseCallbackHandler):
     """
     Streams tokens from ChatOpenAI to a Streamlit container as they arrive.
+
+    Tokens are collected in a list and the container is only re-rendered once
+    STREAM_FLUSH_SECONDS have passed or STREAM_FLUSH_CHARS characters are
+    pending, plus a final render when the LLM finishes. Every render resends
+    the whole text, so this keeps the number of websocket updates roughly
+    constant per second instead of one per token.
+
+    metrics (optional dict) accumulates "renders", "bytes_sent" and "tokens".
     """
-    def __init__(self, container):
+    def __init__(self, container, metrics: dict = None,
+                 flush_seconds: float = STREAM_FLUSH_SECONDS, flush_chars: int = STREAM_FLUSH_CHARS):
         self.container = container
-        self.text = ""
+        self.metrics = metrics if metrics is not None else {}
+        self.flush_seconds = flush_seconds
+        self.flush_chars = flush_chars
+        self.render_count = 0
+        self.bytes_sent = 0
+        self._parts = []
+        self._pending_chars = 0
+        self._last_flush = 0.0
+
+    @property
+    def text(self) -> str:
+        if len(self._parts) > 1:
+            self._parts = ["".join(self._parts)]
+        return self._parts[0] if self._parts else ""
+
+    @text.setter
+    def text(self, value: str):
+        self._parts = [value] if value else []
+        self._pending_chars = 0
+
+    def _render(self, cursor: str = "▌"):
+        body = self.text + cursor
+        self.container.markdown(body)
+        self._pending_chars = 0
+        self._last_flush = time.time()
+        self.render_count += 1
+        self.bytes_sent += len(body.encode("utf-8"))
+        self.metrics["renders"] = self.metrics.get("renders", 0) + 1
+        self.metrics["bytes_sent"] = self.metrics.get("bytes_sent", 0) + len(body.encode("utf-8"))
 
     def on_llm_new_token(self, token: str, **kwargs):
-        self.text += token
-        self.container.markdown(self.text + "▌")
-
-
-# --------------------------- #
-#  CLASSIFICATION LOGIC
-# --------------------------- #
-def classify_user_request(user_input: str, chat_history: str, classification_llm: ChatOpenAI) -> str:
+        self._parts.append(token)
+        self._pending_chars += len(token)
+        self.metrics["tokens"] = self.metrics.get("tokens", 0) + 1
+        if (time.time() - self._last_flush >= self.flush_seconds
+                or self._pending_chars >= self.flush_chars):
+            self._render()
+
+    def on_llm_end(self, response, **kwargs):
+        # Completions served from the LLM cache arrive without tokens; replay them
+        for token in replay_tokens(response):
+            self.on_llm_new_token(token)
+        # Final render: the remaining tokens, without the cursor
+        if self._parts:
+            self._render(cursor="")
+
+
+def save_to_memory(memory: BackgroundSummarizer, user_input: str, output: str, df: pd.DataFrame = None,
+                   trace: Trace = None):
     """
-    Decide if the user wants:
-      - "SQL"  => run a new query
-      - "PLOT" => plot the last DataFrame
-      - "CHAT" => normal conversation only
-    Returns one of ["SQL", "PLOT", "CHAT"].
+    Save a turn to conversation memory. Results are stored as a compact
+    summary instead of the DataFrame repr; a shadow model of the buffer
+    counts the summarization calls that saves.
     """
-    classification_prompt = f"""
-You are a text classifier that must categorize the user's request as one of these three categories only:
-1) SQL  - The user wants a new SQL query or fresh data from the DB or has SQL query they want to run.
-2) PLOT - The user wants to plot or visualize the last known data.
-3) CHAT - The user is simply chatting or clarifying, with no need for SQL or plotting.
-
-Chat history summary:  
-{chat_history}
-
-User's request: 
-{user_input}
-
-Return ONLY one word, either 'SQL', 'PLOT', or 'CHAT'.
-"""
-    result = classification_llm.predict(classification_prompt).strip().upper()
-    if "SQL" in result:
-        return "SQL"
-    elif "PLOT" in result:
-        return "PLOT"
-    else:
-        return "CHAT"
+    started = time.time()
+    summary_output = f"{output}\n{summarize_result(df, RESULT_SUMMARY_TOKENS)}" if df is not None else output
+    memory.save(user_input, summary_output)
+    shadow = st.session_state.memory_shadow
+    shadow["summary"].add(user_input, summary_output)
+    shadow["repr"].add(user_input, f"{output} {df}" if df is not None else output)
+    if trace is not None:
+        trace.add("memory_save", started, time.time() - started)
 
 
 # --------------------------- #
@@ -205,41 +499,116 @@ def main():
                 model_name="gpt-4o",
                 streaming=True
             )
+            # Summaries use their own non-streaming LLM and run on a background thread
+            summary_llm = ChatOpenAI(
+                temperature=0.0,
+                openai_api_key=api_key,
+                model_name="gpt-4o",
+                streaming=False
+            )
             memory = ConversationSummaryBufferMemory(
-                llm=llm,
-                max_token_limit=6000,
+                llm=summary_llm,
+                max_token_limit=MEMORY_MAX_TOKENS,
                 return_messages=True
             )
             st.session_state.llm = llm
-            st.session_state.memory = memory
-
-        # We'll also define a classification LLM (non-streaming) for short text classification
-        classification_llm = ChatOpenAI(
-            temperature=0.0,
-            openai_api_key=api_key,
-            model_name="gpt-4o",
-            streaming=False
-        )
+            st.session_state.memory = BackgroundSummarizer(
+                memory, queue_size=int(os.getenv("MEMORY_QUEUE_SIZE", "8"))
+            )
 
-        # 2) Initialize DB if not set
-        if st.session_state.engine is None:
-            load_dotenv("db_config.env")
-            conn_str = (
-                f'postgresql+psycopg2://{os.getenv("PG_USER")}:'
-                f'{os.getenv("PG_PASSWORD")}@{os.getenv("PG_HOST")}:'
-                f'{os.getenv("PG_PORT")}/{os.getenv("PG_DATABASE")}'
+        # We'll also define a classification LLM (non-streaming) for requests
+        # the local classifier is unsure about
+        if st.session_state.classification_llm is None:
+            st.session_state.classification_llm = ChatOpenAI(
+                temperature=0.0,
+                openai_api_key=api_key,
+                model_name="gpt-4o",
+                streaming=False,
+                callbacks=[st.session_state.llm_traces["helper"]]
             )
-            engine = create_engine(conn_str)
-            st.session_state.engine = engine
-            st.session_state.db = SQLDatabase.from_uri(conn_str)
+        classification_llm = st.session_state.classification_llm
+
+        # Non-streaming LLM for parallel SQL candidates; temperature makes them differ
+        if st.session_state.candidate_llm is None:
+            st.session_state.candidate_llm = ChatOpenAI(
+                temperature=SQL_CANDIDATE_TEMPERATURE,
+                openai_api_key=api_key,
+                model_name="gpt-4o",
+                streaming=False,
+                callbacks=[st.session_state.llm_traces["candidates"]]
+            )
+
+        # 2) Attach the shared pipeline (pooled DB engine, caches, classifier)
+        pipeline = get_pipeline()
 
         llm = st.session_state.llm
         memory = st.session_state.memory
+        purge_old_results()
+
+        # Deterministic (temperature 0) calls may be answered from the LLM cache;
+        # the candidate LLM samples at a higher temperature and never is
+        llm_cache = shared_llm_cache() if cache_llm_completions else False
+        llm.cache = llm_cache
+        classification_llm.cache = llm_cache
+
+        result_cache = pipeline.result_cache
+        st.sidebar.caption(
+            f"🗄️ Result cache: {len(result_cache)} queries, "
+            f"{result_cache.total_bytes / 1024 ** 2:.1f} MB, "
+            f"{result_cache.hits} hits / {result_cache.misses} misses"
+        )
+        question_cache = pipeline.question_cache
+        st.sidebar.caption(
+            f"🔁 Question cache: {question_cache.hits} hits / {question_cache.misses} misses"
+        )
+        if pipeline.plan_cache is not None:
+            plan_stats = pipeline.plan_cache.stats(top=0)
+            if plan_stats["prepared_executions"]:
+                st.sidebar.caption(
+                    f"📌 Prepared statements: {plan_stats['prepared_executions']:,} of "
+                    f"{plan_stats['executions']:,} queries ({plan_stats['shapes']:,} shapes), "
+                    f"~{plan_stats['planning_ms_saved']:,.0f} ms planning saved"
+                )
+        if llm_cache:
+            llm_cache_stats = llm_cache.stats()
+            st.sidebar.caption(
+                f"💾 LLM cache: {llm_cache_stats['entries']:,} completions, "
+                f"{llm_cache_stats['bytes'] / 1024 ** 2:.1f} MB, {llm_cache.hits} hits / {llm_cache.misses} misses"
+            )
+        validation_stats = st.session_state.validation_stats
+        if validation_stats["fixed"] or validation_stats["rejected"]:
+            st.sidebar.caption(
+                f"🔧 SQL checked locally: {validation_stats['fixed']} fixed, "
+                f"{validation_stats['rejected']} rejected before running"
+            )
+        stream_metrics = st.session_state.stream_metrics
+        if stream_metrics["tokens"]:
+            st.sidebar.caption(
+                f"📡 Streaming: {stream_metrics['tokens']:,} tokens in {stream_metrics['renders']:,} renders, "
+                f"{stream_metrics['bytes_sent'] / 1024:,.0f} KB sent"
+            )
+        if memory.pending or memory.summarizations:
+            st.sidebar.caption(
+                f"🧠 Background summaries: {memory.summarizations} done, {memory.pending} pending"
+            )
+        shadow = st.session_state.memory_shadow
+        if shadow["repr"].summarizations:
+            st.sidebar.caption(
+                f"🧠 Memory summarizations: {shadow['summary'].summarizations} "
+                f"({shadow['repr'].summarizations - shadow['summary'].summarizations} avoided by result summaries)"
+            )
+        prompt_tokens = st.session_state.prompt_tokens
+        if prompt_tokens["before"]:
+            st.sidebar.caption(
+                f"🧩 Schema prompt tokens this session: {prompt_tokens['before']:,} → "
+                f"{prompt_tokens['after']:,}"
+            )
+        render_latency_panel(get_metrics(), st.session_state.last_trace)
 
         # --------------------------- #
         # Display Chat History
         # --------------------------- #
-        for msg in st.session_state.messages:
+        for index, msg in enumerate(st.session_state.messages):
             role = "user" if isinstance(msg, HumanMessage) else "assistant"
             with st.chat_message(role):
                 if ('```sql' in msg.content):
@@ -249,26 +618,9 @@ def main():
                     st.markdown(msg.content)
 
                 if isinstance(msg, AIMessage) and hasattr(msg, "metadata") and msg.metadata:
-                    df = msg.metadata.get("df_result")
-                    plot_spec = msg.metadata.get("plot")
-
-                    if isinstance(df, pd.DataFrame):
-                        st.dataframe(df)
-
-                    if isinstance(plot_spec, dict):
-                        with st.expander("📊 Previous Chart", expanded=False):
-                            try:
-                                chart_type = plot_spec["chart_type"]
-                                x_col = plot_spec["x"]
-                                y_col = plot_spec["y"]
-                                if chart_type == "bar":
-                                    st.bar_chart(df, x=x_col, y=y_col)
-                                elif chart_type == "line":
-                                    st.line_chart(df, x=x_col, y=y_col)
-                                elif chart_type == "scatter":
-                                    st.scatter_chart(df, x=x_col, y=y_col)
-                            except Exception as e:
-                                st.error(f"❌ Failed to plot chart: {e}")
+                    # Only the latest messages render results/charts; older ones wait for a toggle
+                    expanded = index >= len(st.session_state.messages) - HISTORY_EXPANDED_MESSAGES
+                    render_message_results(msg.metadata, key=f"msg_{index}", expanded=expanded)
 
         # --------------------------- #
         #     User Input
@@ -281,22 +633,30 @@ def main():
 
             # 1) Add user's message to conversation
             # Build or load prompt template:
-            if selected_prompt != "None":
-                prompt_template = load_prompt(os.path.join("./prompts", selected_prompt))
-            else:
-                prompt_template = """{conversation_summary}
+            prompt_template = load_prompt_template(selected_prompt)
 
-User says: {user_input}
+            # Spans of this turn (JSONL trace file, sidebar panel, /metrics)
+            trace = Trace(get_metrics(), session=st.session_state.result_store.directory.name)
+            for trace_handler in st.session_state.llm_traces.values():
+                trace_handler.trace = trace
 
-Assistant:"""
+            with trace.span("memory_load"):
+                conversation_summary = memory.load()
 
-            conversation_summary = memory.load_memory_variables({}).get("history", "NONE")
-            formatted_prompt = prompt_template.format(
-                conversation_summary=conversation_summary or "NONE",
-                user_input=user_input
-            )
+            # Keep only the schema sections relevant to this question
+            with trace.span("prompt_build") as span:
+                formatted_prompt, prune_report = pipeline.build_prompt(
+                    prompt_template, user_input, conversation_summary, prune_schema=prune_schema_in_prompt
+                )
+                if prune_report is not None:
+                    span["prompt_tokens"] = prune_report.tokens_after
+            if prune_report is not None:
+                st.session_state.prompt_tokens["before"] += prune_report.tokens_before
+                st.session_state.prompt_tokens["after"] += prune_report.tokens_after
 
-            action = classify_user_request(user_input, conversation_summary, classification_llm)
+            with trace.span("classify"):
+                action = pipeline.classify(user_input, conversation_summary, classification_llm)
+            trace.set(action=action)
 
             # If the user wants to see the entire "formatted prompt" in the chat:
             display_user_content = formatted_prompt if display_formatted_prompt_in_chat else user_input
@@ -304,6 +664,11 @@ Assistant:"""
             st.session_state.messages.append(HumanMessage(content=display_user_content))
             with st.chat_message("user"):
                 st.markdown(display_user_content)
+                if prune_report is not None and prune_report.pruned:
+                    st.caption(
+                        f"🧩 Schema sent: {', '.join(prune_report.tables)} "
+                        f"({prune_report.tokens_before:,} → {prune_report.tokens_after:,} prompt tokens)"
+                    )
 
             # 2) Branch logic
             if action == "SQL":
@@ -313,64 +678,71 @@ Assistant:"""
                     with st.expander("SQL code Response", expanded=False):
                         response_container = st.empty()
 
-                stream_handler = StreamHandler(response_container)
-                llm.callbacks = [stream_handler]
-
-                MAX_SQL_RETRIES = 5
-                agent_prompt = formatted_prompt
-                final_response = ""
-                sql_df = None
-
-                for attempt in range(MAX_SQL_RETRIES):
-                    response = llm.predict(agent_prompt)
-                    response_text = stream_handler.text
-                    stream_handler.text = ""  # reset so next attempt won't keep appending
-
-                    extracted = extract_sql(response_text)
-                    if extracted:
-                        # Attempt to run SQL
-                        try:
-                            sql_df = run_query(extracted)
-                            final_response = (
-                                f"{response_text}\n\n**SQL Results:**\n\nData retrieved successfully."
-                            )
-                            response_container.markdown(final_response)
-                            st.dataframe(sql_df)
-                            break
-                        except Exception as e:
-                            error_msg = (
-                                f"here is the original user prompt:\n{response_text}\n"
-                                f"The SQL query caused an error:\n```\n{str(e)}\n```\n"
-                                f"Please provide a corrected SQL query."
-                            )
-                            agent_prompt = error_msg
+                stream_handler = StreamHandler(response_container, st.session_state.stream_metrics)
+                llm.callbacks = [stream_handler, st.session_state.llm_traces["chat"]]
+
+                # Results (and the first streamed chunk) are shown here
+                result_placeholder = st.empty()
+
+                def on_sql_event(event: dict):
+                    if event["type"] == "generate":
+                        stream_handler.text = ""  # reset so the next attempt won't keep appending
+                    elif event["type"] == "candidates":
+                        response_container.markdown(f"⏳ Generating {event['n']} candidate queries in parallel...")
+                    elif event["type"] in ("sql_error", "cached_sql_failed"):
+                        result_placeholder.empty()
+                        if "max_attempts" in event:
                             response_container.markdown(
-                                f"**SQL Error**: {e}\n\nAttempt {attempt+1} of {MAX_SQL_RETRIES}..."
+                                f"**SQL Error**: {event['error']}\n\n"
+                                f"Attempt {event['attempt']} of {event['max_attempts']}..."
                             )
-                    else:
-                        # No SQL found => normal chat
-                        final_response = response_text
-                        response_container.markdown(final_response)
-                        break
-                else:
-                    final_response = (
-                        f"❌ Unable to produce a working SQL query after {MAX_SQL_RETRIES} attempts."
-                    )
+
+                answer = pipeline.answer_sql(
+                    llm,
+                    formatted_prompt,
+                    prompt_template,
+                    user_input,
+                    run=lambda sql: run_query(sql, on_chunk=make_chunk_preview(result_placeholder)),
+                    on_event=on_sql_event,
+                    candidates=parallel_sql_candidates,
+                    candidate_llm=st.session_state.candidate_llm,
+                    cost_action=cost_guard_action,
+                    reuse_sql=reuse_cached_sql,
+                    match_mode=question_match_mode,
+                )
+                st.session_state.validation_stats["fixed"] += answer.fixed
+                st.session_state.validation_stats["rejected"] += answer.rejected
+                trace.extend(answer.spans)
+                trace.set(source=answer.source, retries=max(0, answer.attempts - 1), error=answer.error)
+                final_response = answer.response_text
+                if answer.error:
                     response_container.error(final_response)
+                else:
+                    response_container.markdown(final_response)
 
                 # Save the assistant message
+                metadata = {}
+                if answer.df is not None:
+                    with trace.span("render", rows=len(answer.df)):
+                        show_dataframe(answer.df, result_placeholder.container())
+                        metadata = result_metadata(st.session_state.result_store.put(answer.df), answer.df)
+                    metadata["sql"] = answer.sql
+                    run_spans = [span for span in answer.spans if span["name"] == "run" and "rows" in span]
+                    if run_spans:
+                        trace.set(rows=run_spans[-1]["rows"], bytes=run_spans[-1]["bytes"])
                 ai_msg = AIMessage(
                     content=final_response,
-                    metadata={"df_result": sql_df}
+                    metadata=metadata
                 )
                 st.session_state.messages.append(ai_msg)
 
                 # Update memory
-                memory.save_context({"input": user_input}, {"output": f"{final_response} {sql_df}"})
+                save_to_memory(memory, user_input, final_response, answer.df, trace=trace)
 
             elif action == "PLOT":
                 # (B) Plot the last known DataFrame
-                df_to_plot = get_last_dataframe()
+                last_result = get_last_result_metadata()
+                df_to_plot = load_result(last_result) if last_result else None
                 with st.chat_message("assistant"):
                     if df_to_plot is None or df_to_plot.empty:
                         msg = "No recent data found to plot. Please run a query first."
@@ -378,92 +750,68 @@ Assistant:"""
                         final_response = msg
                         ai_msg = AIMessage(content=final_response)
                         st.session_state.messages.append(ai_msg)
-                        memory.save_context({"input": user_input}, {"output": final_response})
+                        save_to_memory(memory, user_input, final_response, trace=trace)
                     else:
-                        # We'll do a second LLM pass to request a JSON snippet for chart instructions
-                        st.markdown("Let me figure out how to plot that data...")
-                        second_container = st.empty()
-                        plot_stream_handler = StreamHandler(second_container)
-                        llm.callbacks = [plot_stream_handler]
-
-                        # We can attempt multiple times to parse chart instructions
-                        MAX_PLOT_ATTEMPTS = 5
-                        final_plot_text = ""
-
-                        for attempt in range(MAX_PLOT_ATTEMPTS):
-                            # Basic prompt for plot specs
-                            chart_prompt = f"""
-You must return a JSON object specifying how to plot the DataFrame below. 
-
-DataFrame columns: {list(df_to_plot.columns)}
-
-Return a JSON object with this format:
-{{
-  "chart_type": "bar" | "line" | "scatter",
-  "x": "<column name for x-axis>",
-  "y": "<column name or list of columns for y-axis>"
-}}
-
-No additional text, only JSON. If you can't produce a valid specification, say so.
-
-here is the user input: {user_input}
-"""
-                            chart_llm_response = llm.predict(chart_prompt)
-                            chart_response_text = plot_stream_handler.text
-                            plot_stream_handler.text = ""  # reset for next iteration
-
-                            chart_instruction = extract_chart_instruction(chart_response_text)
-                            if chart_instruction:
-                                chart_type = chart_instruction.get("chart_type", "bar")
-                                x_col = chart_instruction.get("x", None)
-                                y_col = chart_instruction.get("y", None)
-
-                                final_plot_text = f"Plotting a {chart_type} chart with x={x_col}, y={y_col}."
-                                st.markdown(final_plot_text)
-
-                                # Display the chart:
-                                try:
-                                    if chart_type == "line":
-                                        st.line_chart(df_to_plot, x=x_col, y=y_col)
-                                    elif chart_type == "scatter":
-                                        st.scatter_chart(df_to_plot, x=x_col, y=y_col)
-                                    else:
-                                        st.bar_chart(df_to_plot, x=x_col, y=y_col)
-
-                                    # We'll store the instructions in metadata
-                                    ai_msg = AIMessage(
-                                        content=final_plot_text,
-                                        metadata={
-                                            "df_result": df_to_plot,
-                                            "plot": {
-                                                "chart_type": chart_type,
-                                                "x": x_col,
-                                                "y": y_col
-                                            }
-                                        }
-                                    )
-                                    st.session_state.messages.append(ai_msg)
-                                    memory.save_context({"input": user_input}, {"output": final_plot_text})
-                                    break
-                                except Exception as e:
-                                    st.warning(f"⚠️ Chart plotting failed: {e}")
-                            else:
-                                st.info(
-                                    f"Could not parse chart instructions on attempt {attempt+1}. Retrying..."
+                        # Pick the chart locally (LLM only when ambiguous); Postgres
+                        # aggregates the series when the stored rows are capped or too many
+                        def on_plot_event(event: dict):
+                            if event["type"] == "chart_llm":
+                                st.markdown("Let me figure out how to plot that data...")
+                            elif event["type"] == "chart_parse_failed":
+                                st.info(f"Could not parse chart instructions on attempt {event['attempt']}.")
+
+                        with trace.span("plot") as span:
+                            plot = pipeline.plot(
+                                df_to_plot, user_input, classification_llm,
+                                sql_query=last_result.get("sql"), run=run_query, on_event=on_plot_event,
+                            )
+                            span.update(chart=(plot.spec or {}).get("chart_type"), pushdown=bool(plot.pushdown_sql))
+                        for note in plot.notes:
+                            st.caption(note)
+                        plot_spec, plot_df, pushdown_sql = plot.spec, plot.df, plot.pushdown_sql
+
+                        # Same stored result as the SQL turn unless the series was aggregated
+                        plot_metadata = last_result
+                        if pushdown_sql:
+                            plot_metadata = {
+                                **result_metadata(st.session_state.result_store.put(plot_df), plot_df),
+                                "sql": pushdown_sql,
+                            }
+
+                        final_plot_text = None
+                        if plot_spec:
+                            final_plot_text = (
+                                f"Plotting a {plot_spec['chart_type']} chart with "
+                                f"x={plot_spec['x']}, y={plot_spec['y']}."
+                            )
+                            if pushdown_sql:
+                                final_plot_text += (
+                                    f" The series was aggregated in the database:\n\n```sql\n{pushdown_sql}\n```"
                                 )
-                        else:
+                            st.markdown(final_plot_text)
+                            try:
+                                with trace.span("render", rows=len(plot_df)):
+                                    render_chart(*pipeline.prepare_chart(plot_df, plot_spec))
+                                ai_msg = AIMessage(
+                                    content=final_plot_text,
+                                    metadata={**plot_metadata, "plot": plot_spec}
+                                )
+                            except Exception as e:
+                                st.warning(f"⚠️ Chart plotting failed: {e}")
+                                final_plot_text = None
+                        if final_plot_text is None:
                             final_plot_text = "⚠️ Plotting instructions could not be determined."
                             st.warning(final_plot_text)
                             ai_msg = AIMessage(content=final_plot_text)
-                            st.session_state.messages.append(ai_msg)
-                            memory.save_context({"input": user_input}, {"output": final_plot_text})
+                        st.session_state.messages.append(ai_msg)
+                        save_to_memory(memory, user_input, final_plot_text, trace=trace)
 
             else:
                 # (C) Normal CHAT, no SQL or plotting
                 with st.chat_message("assistant"):
                     response_container = st.empty()
-                stream_handler = StreamHandler(response_container)
-                llm.callbacks = [stream_handler]
+                stream_handler = StreamHandler(response_container, st.session_state.stream_metrics)
+                llm.callbacks = [stream_handler, st.session_state.llm_traces["chat"]]
 
                 # Single pass for normal chat
                 response = llm.predict(formatted_prompt)
@@ -472,7 +820,9 @@ here is the user input: {user_input}
                 # Save in conversation
                 ai_msg = AIMessage(content=response_text)
                 st.session_state.messages.append(ai_msg)
-                memory.save_context({"input": user_input}, {"output": response_text})
+                save_to_memory(memory, user_input, response_text, trace=trace)
+
+            st.session_state.last_trace = trace.finish()
 
     else:
         st.warning("🔑 Please enter your OpenAI API key in the sidebar to start.")
@@ -0,0 +1,208 @@
+"""
+Run a file of natural-language questions through the text-to-SQL pipeline
+without the UI (nightly reports, regression checks).
+
+Input is JSONL ({"question": ..., "id": optional}) or CSV (a `question`
+column, optional `id`). Every question is answered independently, like a
+first turn in the app: schema pruning, question -> SQL reuse, validation,
+cost guard and the retry loop all apply. Output goes to --out:
+
+  results.jsonl          one record per question (SQL, rows, attempts,
+                         timings, error), appended as questions finish
+  results/<id>.parquet   the full result of each answered question
+
+    python batch_runner.py questions.jsonl --prompt db-sql-prompt.md \\
+        --llm-concurrency 8 --db-concurrency 4
+"""
+import argparse
+import csv
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+from dotenv import load_dotenv
+from langchain.chat_models import ChatOpenAI
+
+from database import create_pooled_engine, get_conn_str
+from stats_utils import percentile
+from llm_cache import shared_llm_cache
+from pipeline import COST_ACTIONS, Pipeline, load_prompt_template
+
+# --- Paths ---
+RUNS_DIR = Path("runs")
+
+
+def load_questions(path: Path) -> list:
+    """[{"id", "question"}, ...] from a JSONL or CSV file; ids default to the line number."""
+    with open(path, "r", encoding="utf-8", newline="") as file:
+        if path.suffix.lower() == ".csv":
+            rows = list(csv.DictReader(file))
+        else:
+            rows = [json.loads(line) for line in file if line.strip()]
+    questions = []
+    for number, row in enumerate(rows, start=1):
+        question = (row.get("question") or "").strip()
+        if question:
+            questions.append({"id": str(row.get("id") or number), "question": question})
+    return questions
+
+
+def _file_name(question_id: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", question_id)[:100] or "question"
+
+
+def write_result(df, directory: Path, question_id: str) -> Path:
+    """Parquet (pickle if pyarrow cannot encode the frame) under directory."""
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f"{_file_name(question_id)}.parquet"
+    try:
+        df.to_parquet(path, index=False)
+    except Exception:
+        path = path.with_suffix(".pkl")
+        df.to_pickle(path)
+    return path
+
+
+class BatchRunner:
+    """
+    Answers questions on llm_concurrency threads; at most db_concurrency of
+    them execute SQL at the same time (EXPLAIN pre-flights are not limited).
+    """
+    def __init__(self, pipeline: Pipeline, llm, prompt_template: str, out_dir: Path,
+                 db_concurrency: int = 4, candidate_llm=None, candidates: int = 1,
+                 cost_action: str = "feedback", reuse_sql: bool = True, prune_schema: bool = True):
+        self.pipeline = pipeline
+        self.llm = llm
+        self.prompt_template = prompt_template
+        self.out_dir = out_dir
+        self.candidate_llm = candidate_llm
+        self.candidates = candidates
+        self.cost_action = cost_action
+        self.reuse_sql = reuse_sql
+        self.prune_schema = prune_schema
+        self._db_slots = threading.BoundedSemaphore(db_concurrency)
+        self._log_lock = threading.Lock()
+
+    def _run(self, sql_query: str):
+        with self._db_slots:
+            return self.pipeline.run_sql(sql_query)
+
+    def answer(self, item: dict) -> dict:
+        """Answer one question; never raises (errors end up in the record)."""
+        started = time.time()
+        record = {"id": item["id"], "question": item["question"]}
+        try:
+            prompt, report = self.pipeline.build_prompt(
+                self.prompt_template, item["question"], "NONE", prune_schema=self.prune_schema
+            )
+            answer = self.pipeline.answer_sql(
+                self.llm, prompt, self.prompt_template, item["question"],
+                run=self._run,
+                candidates=self.candidates,
+                candidate_llm=self.candidate_llm,
+                cost_action=self.cost_action,
+                reuse_sql=self.reuse_sql,
+            )
+            record.update({
+                "sql": answer.sql,
+                "source": answer.source,
+                "attempts": answer.attempts,
+                "retries": max(0, answer.attempts - 1),
+                "error": answer.error,
+                "notes": answer.notes,
+                "prompt_tokens": report.tokens_after if report else None,
+                "timings": {k: round(v, 3) for k, v in answer.timings.items()},
+            })
+            if answer.df is not None:
+                record.update({
+                    "rows": len(answer.df),
+                    "truncated_at": answer.df.attrs.get("truncated_at"),
+                    "result_file": str(write_result(answer.df, self.out_dir / "results", item["id"])),
+                })
+            elif not answer.error:
+                record["response"] = answer.response_text  # no SQL: a clarifying question
+        except Exception as e:  # LLM/network/DB errors outside the retry loop
+            record["error"] = str(e)
+        record["seconds"] = round(time.time() - started, 3)
+        record["ok"] = "result_file" in record
+        return record
+
+    def log(self, record: dict) -> None:
+        with self._log_lock:
+            with open(self.out_dir / "results.jsonl", "a", encoding="utf-8") as file:
+                file.write(json.dumps(record, default=str) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a file of questions with the text-to-SQL pipeline.")
+    parser.add_argument("questions", help="JSONL ({\"question\", \"id\"}) or CSV (question, id columns)")
+    parser.add_argument("--prompt", default="db-sql-prompt.md", help="Prompt template in ./prompts")
+    parser.add_argument("--out", default=None, help="Output directory (default runs/<timestamp>)")
+    parser.add_argument("--llm-concurrency", type=int, default=4, help="Questions answered at once")
+    parser.add_argument("--db-concurrency", type=int, default=4, help="Queries executed at once")
+    parser.add_argument("--candidates", type=int, default=1, help="Parallel SQL candidates per question")
+    parser.add_argument("--cost-action", choices=COST_ACTIONS, default="feedback",
+                        help="What to do with queries over the EXPLAIN budget")
+    parser.add_argument("--fresh", action="store_true",
+                        help="Always ask the LLM (skip SQL reuse for repeated questions)")
+    parser.add_argument("--no-prune", action="store_true", help="Send the whole schema with every question")
+    parser.add_argument("--no-llm-cache", action="store_true",
+                        help="Always call the LLM (skip cached completions of identical prompts)")
+    parser.add_argument("--model", default="gpt-4o")
+    args = parser.parse_args()
+
+    load_dotenv("db_config.env")
+    questions = load_questions(Path(args.questions))
+    out_dir = Path(args.out) if args.out else RUNS_DIR / time.strftime("%Y%m%d-%H%M%S")
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    llm = ChatOpenAI(temperature=0.0, openai_api_key=os.getenv("OPENAI_API_KEY"), model_name=args.model,
+                     cache=False if args.no_llm_cache else shared_llm_cache())
+    candidate_llm = None
+    if args.candidates > 1:
+        candidate_llm = ChatOpenAI(
+            temperature=float(os.getenv("SQL_CANDIDATE_TEMPERATURE", "0.7")),
+            openai_api_key=os.getenv("OPENAI_API_KEY"),
+            model_name=args.model,
+        )
+    runner = BatchRunner(
+        Pipeline(create_pooled_engine(get_conn_str("db_config.env"))),
+        llm,
+        load_prompt_template(args.prompt),
+        out_dir,
+        db_concurrency=args.db_concurrency,
+        candidate_llm=candidate_llm,
+        candidates=args.candidates,
+        cost_action=args.cost_action,
+        reuse_sql=not args.fresh,
+        prune_schema=not args.no_prune,
+    )
+
+    started = time.time()
+    records = []
+    with ThreadPoolExecutor(max_workers=args.llm_concurrency, thread_name_prefix="batch") as executor:
+        futures = [executor.submit(runner.answer, item) for item in questions]
+        for future in as_completed(futures):
+            record = future.result()
+            runner.log(record)
+            records.append(record)
+            status = f"{record['rows']:,} rows" if record["ok"] else (record.get("error") or "no SQL")
+            print(f"[{len(records)}/{len(questions)}] {record['id']}: {status} "
+                  f"({record['seconds']:.1f}s, {record.get('attempts', 0)} attempts)")
+
+    elapsed = time.time() - started
+    seconds = [r["seconds"] for r in records] or [0.0]
+    answered = sum(r["ok"] for r in records)
+    print(f"answered:   {answered} / {len(records)}")
+    print(f"retries:    {sum(r.get('retries', 0) for r in records)}")
+    print(f"latency:    p50 {percentile(seconds, 50):.1f} s, p95 {percentile(seconds, 95):.1f} s")
+    print(f"wall time:  {elapsed:.1f} s ({len(records) / elapsed if elapsed else 0:.2f} questions/s)")
+    print(f"output:     {out_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+"""
+End-to-end latency benchmark of the text-to-SQL pipeline.
+
+Stands up the fake education DB at --scale (make_fake_db_data.py +
+populate_db.py; this REPLACES the tables of the database in --db-config),
+answers a fixed question set through a local OpenAI-compatible stub
+(mock_llm_server.py) and reports per-stage latency:
+
+  classify      local classifier / LLM fallback
+  prompt_build  schema pruning + formatting
+  generate      LLM calls (first_token: time to the first streamed token)
+  extract       pulling the SQL out of the reply
+  validate      local identifier checks
+  explain       EXPLAIN cost pre-flight
+  run           query execution
+  render        result store, memory summary and Arrow encoding (as st.dataframe)
+  plot          chart spec + SQL pushdown (PLOT questions)
+  total         the whole turn
+
+The report is JSON (--out); with --baseline the run exits non-zero when a
+stage's p50 got slower than the baseline by more than --tolerance.
+
+    python benchmark.py --scale 0.1 --repeat 3 --out runs/bench.json
+    python benchmark.py --skip-setup --baseline runs/bench.json
+"""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import pandas as pd
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.chat_models import ChatOpenAI
+from sqlalchemy import text
+from streamlit import dataframe_util
+
+import make_fake_db_data
+from database import create_pooled_engine, get_conn_str
+from stats_utils import percentile
+from llm_cache import LLMCache
+from mock_llm_server import QUESTIONS_FILE, load_answers, start_mock_server
+from pipeline import Pipeline, PipelineSettings, load_prompt_template
+from populate_db import populate_database
+from query_cache import ResultCache
+from query_db import WorkloadLog
+from question_cache import QuestionCache
+from result_store import ResultStore
+from result_summary import summarize_result
+
+# --- Paths ---
+CSV_CACHE_DIR = Path(".cache/benchmark_csvs")
+
+STAGES = ("classify", "prompt_build", "generate", "first_token", "extract", "validate",
+          "explain", "run", "render", "plot", "total")
+# Stages this fast are all noise; they never count as regressions
+MIN_REGRESSION_MS = 5.0
+
+
+class FirstTokenTimer(BaseCallbackHandler):
+    """Time from the start of the first LLM call of a turn to its first streamed token."""
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        self.started = None
+        self.first_token = None
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        if self.started is None:
+            self.started = time.time()
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        if self.started is None:
+            self.started = time.time()
+
+    def on_llm_new_token(self, token: str, **kwargs):
+        if self.first_token is None and self.started is not None:
+            self.first_token = time.time() - self.started
+
+
+# --------------------------- #
+#     SETUP
+# --------------------------- #
+def prepare_database(engine, scale: float, seed: int) -> list:
+    """Generate (once per scale/seed) and load the fake education data; returns the tables."""
+    csv_folder = CSV_CACHE_DIR / f"scale_{scale:g}_seed_{seed}"
+    if not any(csv_folder.glob("*.csv")):
+        make_fake_db_data.main(scale=scale, output_dir=str(csv_folder), seed=seed)
+    return populate_database(engine, csv_folder, verbose=False)
+
+
+def table_rows(engine, tables: list) -> dict:
+    with engine.connect() as conn:
+        return {t: conn.execute(text(f'SELECT COUNT(*) FROM "{t}"')).scalar() for t in tables}
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+# --------------------------- #
+#     MEASURE
+# --------------------------- #
+def render(df: pd.DataFrame, store: ResultStore) -> None:
+    """What the app does with a fresh result before the user sees it."""
+    store.put(df)
+    summarize_result(df)
+    dataframe_util.convert_pandas_df_to_arrow_bytes(df)
+
+
+def run_question(pipeline: Pipeline, question: dict, llm, classification_llm, timer: FirstTokenTimer,
+                 prompt_template: str, store: ResultStore, previous: dict) -> dict:
+    """Answer one question like a turn in the app; previous holds the last result (for PLOT)."""
+    stages = {}
+    started = time.time()
+
+    def timed(name, function, *args, **kwargs):
+        stage_started = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stages[name] = stages.get(name, 0.0) + time.time() - stage_started
+
+    record = {"id": question["id"], "expected": question.get("label")}
+    label = timed("classify", pipeline.classify, question["question"], "NONE", classification_llm)
+    record["label"] = label
+
+    if label == "PLOT" and previous.get("df") is not None:
+        answer = timed("plot", pipeline.plot, previous["df"], question["question"], llm=classification_llm,
+                       sql_query=previous["sql"])
+        record["chart"] = answer.spec
+        if answer.spec is not None:
+            timed("render", pipeline.prepare_chart, answer.df, answer.spec)
+    elif label == "SQL":
+        prompt, _ = timed("prompt_build", pipeline.build_prompt, prompt_template, question["question"])
+        timer.reset()
+        answer = pipeline.answer_sql(llm, prompt, prompt_template, question["question"], reuse_sql=False)
+        stages.update(answer.timings)
+        stages.pop("total", None)
+        if timer.first_token is not None:
+            stages["first_token"] = timer.first_token
+        record.update({"attempts": answer.attempts, "error": answer.error})
+        if answer.df is not None:
+            record["rows"] = len(answer.df)
+            timed("render", render, answer.df, store)
+            previous.update(df=answer.df, sql=answer.sql)
+    else:
+        timer.reset()
+        timed("generate", llm.predict, question["question"])
+        if timer.first_token is not None:
+            stages["first_token"] = timer.first_token
+
+    stages["total"] = time.time() - started
+    record["stages"] = {name: round(seconds * 1000, 2) for name, seconds in stages.items()}
+    return record
+
+
+def summarize(records: list) -> dict:
+    """{stage: {"n", "p50_ms", "p95_ms", "mean_ms"}} over all records."""
+    summary = {}
+    for stage in STAGES:
+        values = [r["stages"][stage] for r in records if stage in r["stages"]]
+        if values:
+            summary[stage] = {
+                "n": len(values),
+                "p50_ms": round(percentile(values, 50), 2),
+                "p95_ms": round(percentile(values, 95), 2),
+                "mean_ms": round(sum(values) / len(values), 2),
+            }
+    return summary
+
+
+def compare(summary: dict, baseline: dict, tolerance: float) -> list:
+    """Stages whose p50 is more than tolerance (a fraction) slower than in baseline."""
+    regressions = []
+    for stage, stats in summary.items():
+        before = baseline.get(stage)
+        if not before:
+            continue
+        limit = before["p50_ms"] * (1 + tolerance)
+        if stats["p50_ms"] > limit and stats["p50_ms"] - before["p50_ms"] > MIN_REGRESSION_MS:
+            regressions.append({"stage": stage, "baseline_p50_ms": before["p50_ms"], "p50_ms": stats["p50_ms"]})
+    return regressions
+
+
+def print_summary(summary: dict, baseline: dict = None) -> None:
+    print(f"{'stage':<14}{'n':>5}{'p50 ms':>11}{'p95 ms':>11}{'mean ms':>11}" + ("   vs baseline" if baseline else ""))
+    for stage, stats in summary.items():
+        line = f"{stage:<14}{stats['n']:>5}{stats['p50_ms']:>11.1f}{stats['p95_ms']:>11.1f}{stats['mean_ms']:>11.1f}"
+        if baseline and baseline.get(stage, {}).get("p50_ms"):
+            line += f"   {(stats['p50_ms'] / baseline[stage]['p50_ms'] - 1) * 100:+.0f}%"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the text-to-SQL pipeline against a mock LLM.")
+    parser.add_argument("--questions", default=str(QUESTIONS_FILE))
+    parser.add_argument("--prompt", default="db-sql-prompt.md", help="Prompt template in ./prompts")
+    parser.add_argument("--db-config", default="db_config.env")
+    parser.add_argument("--scale", type=float, default=0.1, help="Fake data size relative to make_fake_db_data")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--skip-setup", action="store_true", help="Use the tables already in the database")
+    parser.add_argument("--tokens-per-second", type=float, default=80.0)
+    parser.add_argument("--first-token-ms", type=float, default=300.0)
+    parser.add_argument("--repeat", type=int, default=3, help="Passes over the question set")
+    parser.add_argument("--llm-cache", action="store_true",
+                        help="Answer repeated prompts from a fresh LLM cache (measures cache hits after pass 1)")
+    parser.add_argument("--out", default=None, help="JSON report (default runs/benchmark-<timestamp>.json)")
+    parser.add_argument("--baseline", default=None, help="Earlier JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed p50 slowdown (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    questions = load_answers(Path(args.questions))
+    engine = create_pooled_engine(get_conn_str(args.db_config))
+    tables = [] if args.skip_setup else prepare_database(engine, args.scale, args.seed)
+
+    server = start_mock_server(questions, tokens_per_second=args.tokens_per_second,
+                               first_token_ms=args.first_token_ms)
+    timer = FirstTokenTimer()
+    llm = ChatOpenAI(temperature=0.0, openai_api_key="mock", openai_api_base=server.base_url,
+                     model_name="mock", streaming=True, callbacks=[timer])
+    classification_llm = ChatOpenAI(temperature=0.0, openai_api_key="mock", openai_api_base=server.base_url,
+                                    model_name="mock", streaming=False)
+
+    prompt_template = load_prompt_template(args.prompt)
+    records = []
+    with tempfile.TemporaryDirectory(prefix="benchmark-") as scratch:
+        if args.llm_cache:
+            llm.cache = classification_llm.cache = LLMCache(Path(scratch) / "llm_cache.sqlite")
+        settings = PipelineSettings.from_env()
+        # Benchmark queries are not analyst traffic: keep them out of the workload log
+        pipeline = Pipeline(engine, settings, question_cache=QuestionCache(Path(scratch) / "questions.db"),
+                            workload_log=WorkloadLog(None))
+        store = ResultStore("benchmark", root=Path(scratch))
+        for repetition in range(args.repeat):
+            # Every pass measures the database, not the result cache
+            pipeline.result_cache = ResultCache(max_bytes=settings.result_cache_max_mb * 1024 ** 2,
+                                                ttl_seconds=settings.result_cache_ttl_seconds)
+            previous = {}
+            for question in questions:
+                record = run_question(pipeline, question, llm, classification_llm, timer,
+                                      prompt_template, store, previous)
+                record["repetition"] = repetition
+                records.append(record)
+                print(f"[{repetition + 1}/{args.repeat}] {record['id']} {record['label']}: "
+                      f"{record['stages']['total']:.0f} ms")
+    server.shutdown()
+
+    summary = summarize(records)
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "scale": None if args.skip_setup else args.scale,
+            "seed": args.seed,
+            "table_rows": table_rows(engine, tables) if tables else None,
+            "tokens_per_second": args.tokens_per_second,
+            "first_token_ms": args.first_token_ms,
+            "repeat": args.repeat,
+            "llm_cache": args.llm_cache,
+            "llm_calls": server.calls,
+            "misclassified": sum(1 for r in records if r["expected"] and r["label"] != r["expected"]),
+            "failed": sum(1 for r in records if r.get("error")),
+        },
+        "summary": summary,
+        "questions": records,
+    }
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as file:
+            baseline = json.load(file)["summary"]
+        report["regressions"] = compare(summary, baseline, args.tolerance)
+
+    out = Path(args.out) if args.out else Path("runs") / f"benchmark-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    with open(out, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2, default=str)
+
+    print_summary(summary, baseline)
+    print(f"report: {out}")
+    if report.get("regressions"):
+        for regression in report["regressions"]:
+            print(f"REGRESSION {regression['stage']}: p50 {regression['baseline_p50_ms']:.1f} ms "
+                  f"-> {regression['p50_ms']:.1f} ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+Local chart-spec inference for the PLOT path.
+
+Picks {"chart_type", "x", "y"} from column types, cardinality, column names
+mentioned in the request and a few keywords ("over time" -> line,
+"vs" -> scatter). The LLM is only needed when the result is ambiguous;
+whatever spec is used is checked against the DataFrame first.
+"""
+import json
+import re
+
+import pandas as pd
+
+LINE_WORDS = re.compile(r"\b(line|trend|trends|over time|timeline|time series|by (year|month|day|date|week))\b", re.I)
+SCATTER_WORDS = re.compile(r"\b(scatter|correlat\w*|relationship|vs\.?|versus|against)\b", re.I)
+BAR_WORDS = re.compile(r"\b(bar|bars|histogram|compare|comparison|per|by|breakdown|distribution|count)\b", re.I)
+TIME_NAME = re.compile(r"(date|time|year|month|day|week|quarter|period)", re.I)
+ID_NAME = re.compile(r"(^id$|_id$|_fk$|\bid\b|identifier|record id)", re.I)
+CHART_TYPES = ("bar", "line", "scatter")
+
+
+def _words(text: str) -> str:
+    return " " + re.sub(r"[^a-z0-9]+", " ", text.lower()) + " "
+
+
+def mentioned_columns(df: pd.DataFrame, user_input: str) -> list:
+    """Columns named in the request, in order of appearance."""
+    text = _words(user_input)
+    found = []
+    for column in df.columns:
+        position = text.find(_words(str(column)))
+        if position >= 0:
+            found.append((position, column))
+    return [column for _, column in sorted(found, key=lambda item: item[0])]
+
+
+def _is_time(df: pd.DataFrame, column) -> bool:
+    if pd.api.types.is_datetime64_any_dtype(df[column]):
+        return True
+    return bool(TIME_NAME.search(str(column))) and not ID_NAME.search(str(column))
+
+
+def _is_measure(df: pd.DataFrame, column) -> bool:
+    return (pd.api.types.is_numeric_dtype(df[column]) and not pd.api.types.is_bool_dtype(df[column])
+            and not ID_NAME.search(str(column)))
+
+
+def infer_chart_spec(df: pd.DataFrame, user_input: str):
+    """
+    Return (spec, confidence). spec is a {"chart_type", "x", "y"} dict or None
+    when the data cannot be plotted; confidence is in [0, 1].
+    """
+    if df is None or df.empty or df.shape[1] < 2:
+        return None, 0.0
+    confidence = 1.0
+    mentioned = mentioned_columns(df, user_input)
+    measures = [c for c in df.columns if _is_measure(df, c)]
+    times = [c for c in df.columns if _is_time(df, c)]
+    categories = [
+        c for c in df.columns
+        if c not in measures and c not in times and not pd.api.types.is_numeric_dtype(df[c])
+    ]
+
+    if LINE_WORDS.search(user_input):
+        chart_type = "line"
+    elif SCATTER_WORDS.search(user_input):
+        chart_type = "scatter"
+    elif BAR_WORDS.search(user_input):
+        chart_type = "bar"
+    else:
+        chart_type = None
+
+    # x: a mentioned non-measure column, else the column the chart type calls for
+    x_options = [c for c in mentioned if c not in measures] or (
+        [c for c in mentioned if chart_type == "scatter"][:1]
+    )
+    if x_options:
+        x = x_options[0]
+    elif chart_type == "scatter" and len(measures) >= 2:
+        x = measures[0]
+    elif (chart_type in (None, "line")) and times:
+        x = times[0]
+    elif categories:
+        # The most readable axis: fewest distinct values (but more than one)
+        x = min(categories, key=lambda c: (df[c].nunique() <= 1, df[c].nunique()))
+        confidence -= 0.2 if len(categories) > 1 else 0.0
+    elif times:
+        x = times[0]
+    else:
+        x = df.columns[0]
+        confidence -= 0.3
+
+    # y: mentioned measures, else every measure (for bar/line), else the first one
+    y_candidates = [c for c in mentioned if c in measures and c != x] or [c for c in measures if c != x]
+    if not y_candidates:
+        return None, 0.0
+    if chart_type == "scatter" or len(y_candidates) == 1:
+        y = y_candidates[0]
+        if not [c for c in mentioned if c in measures] and len(y_candidates) > 1:
+            confidence -= 0.3
+    else:
+        y = y_candidates if len(y_candidates) <= 3 else y_candidates[0]
+        if len(y_candidates) > 3:
+            confidence -= 0.3
+
+    if chart_type is None:
+        chart_type = "line" if x in times else "scatter" if x in measures else "bar"
+        confidence -= 0.1
+    if chart_type == "bar" and df[x].nunique() > 50:
+        confidence -= 0.2  # unreadable bar chart: maybe the user meant something else
+    return {"chart_type": chart_type, "x": x, "y": y}, max(confidence, 0.0)
+
+
+def validate_chart_spec(spec: dict, df: pd.DataFrame):
+    """
+    Check an (LLM-produced) spec against the DataFrame. Returns a cleaned
+    spec, or None if it names missing columns or an unknown chart type.
+    """
+    if not isinstance(spec, dict) or df is None:
+        return None
+    chart_type = str(spec.get("chart_type", "bar")).lower()
+    x = spec.get("x")
+    y = spec.get("y")
+    y_cols = y if isinstance(y, list) else [y]
+    if chart_type not in CHART_TYPES or x not in df.columns or not y_cols:
+        return None
+    if any(c not in df.columns for c in y_cols):
+        return None
+    return {"chart_type": chart_type, "x": x, "y": y_cols if isinstance(y, list) else y}
+
+
+def extract_chart_instruction(response_text: str):
+    """
+    Look for a JSON object of the form:
+      {
+         "chart_type": "bar" / "line" / "scatter",
+         "x": "Month",
+         "y": "Revenue"
+      }
+    Returns a dict or None if not found/invalid.
+    """
+    try:
+        match = re.search(r"{\s*\"chart_type\".*?}", response_text, re.DOTALL)
+        if match:
+            return json.loads(match.group())
+    except Exception:
+        return None
+    return None
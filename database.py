@@ -0,0 +1,503 @@
+import hashlib
+import itertools
+import json
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import pandas as pd
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import DBAPIError
+from dotenv import load_dotenv
+
+from sql_utils import ParameterizedQuery, is_select_query, is_single_statement, parameterize_sql, wrap_subquery
+
+# --- Paths ---
+SCHEMA_CACHE_DIR = Path(".cache/schema")
+
+
+# --------------------------- #
+#     CONNECTION POOL
+# --------------------------- #
+def get_conn_str(env_file: str = "db_config.env") -> str:
+    """Build the Postgres connection string from db_config.env / the environment."""
+    load_dotenv(env_file)
+    return (
+        f'postgresql+psycopg2://{os.getenv("PG_USER")}:'
+        f'{os.getenv("PG_PASSWORD")}@{os.getenv("PG_HOST")}:'
+        f'{os.getenv("PG_PORT")}/{os.getenv("PG_DATABASE")}'
+    )
+
+
+def create_pooled_engine(conn_str: str = None):
+    """
+    Create the engine shared by every session of a process.
+    Pool settings come from the environment (or db_config.env):
+      PG_POOL_SIZE       persistent connections kept open (default 5)
+      PG_MAX_OVERFLOW    extra connections allowed under load (default 10)
+      PG_POOL_TIMEOUT    seconds to wait for a free connection (default 30)
+      PG_POOL_PRE_PING   test connections before use (default true)
+      PG_POOL_RECYCLE    seconds before a connection is replaced (default 1800)
+    """
+    conn_str = conn_str or get_conn_str()
+    return create_engine(
+        conn_str,
+        pool_size=int(os.getenv("PG_POOL_SIZE", "5")),
+        max_overflow=int(os.getenv("PG_MAX_OVERFLOW", "10")),
+        pool_timeout=float(os.getenv("PG_POOL_TIMEOUT", "30")),
+        pool_pre_ping=os.getenv("PG_POOL_PRE_PING", "true").lower() in ("1", "true", "yes"),
+        pool_recycle=int(os.getenv("PG_POOL_RECYCLE", "1800")),
+    )
+
+
+# --------------------------- #
+#     QUERY EXECUTION
+# --------------------------- #
+class QueryTimeoutError(Exception):
+    """The query ran longer than its statement_timeout and was cancelled by Postgres."""
+
+
+class QueryCancelledError(Exception):
+    """The query was cancelled on request (pg_cancel_backend)."""
+
+
+def _translate_cancel(error: DBAPIError, timeout_ms) -> Exception:
+    """Map Postgres' query_canceled (57014) errors to our own exceptions."""
+    if getattr(error.orig, "pgcode", None) != "57014":
+        return error
+    if "statement timeout" in str(error.orig):
+        return QueryTimeoutError(
+            f"Query too slow: it was stopped after {timeout_ms / 1000:g} seconds. "
+            "Simplify it: filter early, aggregate instead of returning raw rows, "
+            "avoid cross joins / non-key joins, or add a LIMIT."
+        )
+    return QueryCancelledError("Query cancelled by user.")
+
+
+class MultipleStatementsError(Exception):
+    """The SQL text holds more than one statement."""
+
+
+def check_single_statement(sql_query: str) -> None:
+    """
+    Refuse multi-statement text before it reaches the server: a COMMIT in it
+    would end the read-only transaction and let the statements after it write.
+    """
+    if not is_single_statement(sql_query):
+        raise MultipleStatementsError(
+            "Only a single SQL statement can be run. Remove the extra statements "
+            "(and any dollar-quoted strings) and send one SELECT query."
+        )
+
+
+class QueryTooExpensiveError(Exception):
+    """EXPLAIN estimates the query to be too expensive to run as written."""
+
+
+def explain_estimate(engine, sql_query: str, timeout_ms: int = None) -> dict:
+    """
+    Planner estimate for a query without running it:
+    {"cost": total cost, "rows": estimated rows returned, "planning_ms"}.
+    """
+    check_single_statement(sql_query)
+    with engine.connect() as conn:
+        conn.execute(text("SET TRANSACTION READ ONLY"))
+        if timeout_ms:
+            conn.execute(text(f"SET LOCAL statement_timeout = {int(timeout_ms)}"))
+        plan = conn.execute(text(f"EXPLAIN (FORMAT JSON, SUMMARY) {sql_query}")).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    top = plan[0]["Plan"]
+    return {"cost": float(top["Total Cost"]), "rows": float(top["Plan Rows"]),
+            "planning_ms": float(plan[0].get("Planning Time", 0.0))}
+
+
+def guard_query_cost(engine, sql_query: str, max_cost: float, max_rows: float,
+                     action: str = "feedback", limit_rows: int = 1000, timeout_ms: int = None,
+                     plan_cache: "PlanCache" = None):
+    """
+    Pre-flight check of a generated query against planner estimates.
+
+    Returns (sql to execute, note or None). Queries within budget come back
+    unchanged. Over-budget queries are handled per action:
+      - "limit":     wrapped in an outer LIMIT limit_rows
+      - "aggregate": replaced by a COUNT(*) preview of the result
+      - "feedback":  not run; QueryTooExpensiveError asks the model to aggregate
+    Rewrites that are still over budget fall back to "feedback".
+    The planning time of the EXPLAIN is reported to plan_cache.
+    """
+    if not is_select_query(sql_query):
+        return sql_query, None
+    estimate = explain_estimate(engine, sql_query, timeout_ms)
+    if plan_cache is not None:
+        plan_cache.observe_planning(sql_query, estimate["planning_ms"])
+    if estimate["cost"] <= max_cost and estimate["rows"] <= max_rows:
+        return sql_query, None
+
+    summary = f"estimated {estimate['rows']:,.0f} rows / cost {estimate['cost']:,.0f}"
+    rewrites = {
+        "limit": (
+            wrap_subquery(sql_query, "SELECT *", "limited_result") + f" LIMIT {int(limit_rows)}",
+            f"⚠️ This query was over budget ({summary}), so only the first {int(limit_rows):,} rows were fetched.",
+        ),
+        "aggregate": (
+            wrap_subquery(sql_query, 'SELECT COUNT(*) AS "row_count"', "aggregate_preview"),
+            f"⚠️ This query was over budget ({summary}), so only its row count is shown. "
+            "Ask for an aggregated version to see the data.",
+        ),
+    }
+    if action in rewrites:
+        rewritten, note = rewrites[action]
+        rewritten_estimate = explain_estimate(engine, rewritten, timeout_ms)
+        if rewritten_estimate["cost"] <= max_cost:
+            return rewritten, note
+    raise QueryTooExpensiveError(
+        f"The query was not run: the planner {summary}, over the limits of "
+        f"{max_rows:,.0f} rows / cost {max_cost:,.0f}. Please aggregate (GROUP BY with "
+        "COUNT/SUM/AVG), filter to fewer rows, or avoid cross joins instead of returning raw rows."
+    )
+
+
+def cancel_backend(engine, backend_pid: int) -> bool:
+    """Ask Postgres to cancel whatever the given backend is running."""
+    with engine.connect() as conn:
+        return bool(conn.execute(text("SELECT pg_cancel_backend(:pid)"), {"pid": backend_pid}).scalar())
+
+
+def stream_query(engine, sql_query: str, max_rows: int = 100_000, max_bytes: int = 200 * 1024 ** 2,
+                 chunk_rows: int = 10_000, on_chunk=None, timeout_ms: int = None,
+                 read_only: bool = True, on_backend_pid=None, plan_cache: "PlanCache" = None) -> pd.DataFrame:
+    """
+    Run a query through a server-side (named) cursor, fetching chunk_rows at
+    a time, and stop once max_rows rows or max_bytes of DataFrame memory have
+    been read. on_chunk(chunk_df, rows_so_far) is called after every chunk so
+    callers can show the first rows early.
+
+    The query runs in a (by default) read-only transaction with a local
+    statement_timeout; on_backend_pid(pid) receives the backend PID so another
+    thread can cancel it with cancel_backend(). Timeouts raise
+    QueryTimeoutError, cancellations QueryCancelledError.
+
+    With a plan_cache, hot query shapes with small results run as prepared
+    statements on the pooled connection instead (see PlanCache).
+
+    Text with more than one statement raises MultipleStatementsError.
+
+    If the result was cut short, df.attrs["truncated_at"] holds the row count.
+    """
+    check_single_statement(sql_query)
+    try:
+        return _stream_query(engine, sql_query, max_rows, max_bytes, chunk_rows, on_chunk, timeout_ms,
+                             read_only, on_backend_pid, plan_cache)
+    except _StalePlanError:
+        # The transaction is aborted; run it again without prepared statements
+        return _stream_query(engine, sql_query, max_rows, max_bytes, chunk_rows, on_chunk, timeout_ms,
+                             read_only, on_backend_pid, None)
+
+
+def _stream_query(engine, sql_query, max_rows, max_bytes, chunk_rows, on_chunk, timeout_ms,
+                  read_only, on_backend_pid, plan_cache) -> pd.DataFrame:
+    with engine.connect() as conn:
+        try:
+            # SET TRANSACTION must come first in the (implicitly begun) transaction
+            if read_only:
+                conn.execute(text("SET TRANSACTION READ ONLY"))
+            if timeout_ms:
+                conn.execute(text(f"SET LOCAL statement_timeout = {int(timeout_ms)}"))
+            if on_backend_pid is not None:
+                on_backend_pid(conn.execute(text("SELECT pg_backend_pid()")).scalar())
+            _deallocate_stale(conn)
+            if not is_select_query(sql_query):
+                # Server-side cursors only accept SELECT / VALUES
+                return pd.read_sql(text(sql_query), conn)
+            shape = plan_cache.shape(sql_query) if plan_cache is not None else None
+            df = None
+            if shape is not None and plan_cache.is_hot(shape):
+                df = plan_cache.execute(conn, shape, max_rows, max_bytes, chunk_rows, on_chunk)
+            if df is None:
+                df = _fetch_capped(conn, sql_query, max_rows, max_bytes, chunk_rows, on_chunk)
+            if shape is not None:
+                plan_cache.record(shape, len(df))
+            return df
+        except DBAPIError as e:
+            translated = _translate_cancel(e, timeout_ms)
+            if translated is e:
+                raise
+            raise translated from e
+
+
+def _fetch_capped(conn, sql_query, max_rows, max_bytes, chunk_rows, on_chunk) -> pd.DataFrame:
+    result = conn.execution_options(stream_results=True, max_row_buffer=chunk_rows).execute(
+        text(sql_query)
+    )
+    return _read_capped(result, max_rows, max_bytes, chunk_rows, on_chunk)
+
+
+def _read_capped(result, max_rows, max_bytes, chunk_rows, on_chunk) -> pd.DataFrame:
+    """Read a result chunk_rows at a time up to max_rows / max_bytes (see stream_query)."""
+    columns = list(result.keys())
+    frames = []
+    rows = 0
+    nbytes = 0
+    truncated = False
+    for partition in result.partitions(chunk_rows):
+        chunk = pd.DataFrame.from_records(partition, columns=columns, coerce_float=True)
+        if rows + len(chunk) > max_rows:
+            chunk = chunk.iloc[:max_rows - rows]
+            truncated = True
+        frames.append(chunk)
+        rows += len(chunk)
+        nbytes += int(chunk.memory_usage(deep=True).sum())
+        if on_chunk is not None:
+            on_chunk(chunk, rows)
+        if truncated:
+            break
+        if rows >= max_rows or nbytes >= max_bytes:
+            truncated = result.fetchone() is not None
+            break
+    result.close()
+
+    if frames:
+        df = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+    else:
+        df = pd.DataFrame(columns=columns)
+    if truncated:
+        df.attrs["truncated_at"] = rows
+    return df
+
+
+# --------------------------- #
+#     PREPARED STATEMENTS
+# --------------------------- #
+STATEMENTS_INFO_KEY = "prepared_statements"  # key in each pooled DBAPI connection's .info
+STALE_INFO_KEY = "prepared_statements_stale"  # set when the connection's statements must be deallocated
+CUSTOM_PLAN_EXECUTIONS = 5  # Postgres plans the first executions of a statement with their parameters
+_statement_ids = itertools.count(1)
+
+
+class _StalePlanError(Exception):
+    """A prepared statement is gone or no longer matches the schema (e.g. a table was reloaded)."""
+
+
+def _deallocate_stale(conn) -> None:
+    """
+    DEALLOCATE ALL on a connection whose statements went stale. That cannot
+    run in the aborted transaction that noticed it, so it runs on the next one.
+    """
+    if conn.connection.info.pop(STALE_INFO_KEY, False):
+        conn.execute(text("DEALLOCATE ALL"))
+
+
+class PlanCache:
+    """
+    Server-side prepared statements for hot query shapes.
+
+    Queries are parameterized (sql_utils.parameterize_sql); a shape seen at
+    least min_executions times whose results have never exceeded max_rows
+    is PREPAREd on the pooled connection that runs it and EXECUTEd from then
+    on, so Postgres can skip parsing and, once it settles on a generic plan,
+    planning. Statements live per connection (at most max_statements, least
+    recently used are deallocated) and disappear with it.
+
+    EXECUTE cannot feed a server-side cursor, so prepared shapes are fetched
+    through a client-side cursor, capped by an outer LIMIT of max_rows (of
+    the cache) + 1 and read in chunks under the same row / byte caps as the
+    cursor path. A shape that returns more rows goes back to the cursor. Shapes Postgres refuses to prepare (e.g. a
+    parameter whose type cannot be inferred) are not tried again.
+
+    Planning time saved is an estimate: the shape's planning time (from
+    the EXPLAIN pre-flight check) times its executions past the first
+    CUSTOM_PLAN_EXECUTIONS of each statement.
+    """
+    def __init__(self, min_executions: int = 3, max_rows: int = 10_000, max_statements: int = 100,
+                 max_shapes: int = 10_000):
+        self.min_executions = min_executions
+        self.max_rows = max_rows
+        self.max_statements = max_statements
+        self.max_shapes = max_shapes
+        self._shapes = OrderedDict()  # key -> stats, least recently used first
+        self._rejected = set()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """A PlanCache from PREPARE_* settings, or None when PREPARED_STATEMENTS=false."""
+        if os.getenv("PREPARED_STATEMENTS", "true").strip().lower() not in ("1", "true", "yes", "on"):
+            return None
+        return cls(
+            min_executions=int(os.getenv("PREPARE_MIN_EXECUTIONS", "3")),
+            max_rows=int(os.getenv("PREPARE_MAX_ROWS", "10000")),
+            max_statements=int(os.getenv("PREPARE_MAX_STATEMENTS", "100")),
+        )
+
+    def _stats(self, key: str) -> dict:
+        stats = self._shapes.get(key)
+        if stats is None:
+            stats = self._shapes[key] = {
+                "executions": 0, "prepared": 0, "generic": 0, "max_rows": 0, "planning_ms": None,
+            }
+            if len(self._shapes) > self.max_shapes:
+                self._shapes.popitem(last=False)
+        self._shapes.move_to_end(key)
+        return stats
+
+    def shape(self, sql_query: str):
+        """The parameterized query, or None if it has no literals to lift."""
+        return parameterize_sql(sql_query)
+
+    def is_hot(self, shape: ParameterizedQuery) -> bool:
+        with self._lock:
+            stats = self._shapes.get(shape.key)
+            return (
+                stats is not None
+                and shape.key not in self._rejected
+                and stats["executions"] + 1 >= self.min_executions
+                and stats["max_rows"] <= self.max_rows
+            )
+
+    def record(self, shape: ParameterizedQuery, rows: int) -> None:
+        with self._lock:
+            stats = self._stats(shape.key)
+            stats["executions"] += 1
+            stats["max_rows"] = max(stats["max_rows"], rows)
+
+    def observe_planning(self, sql_query: str, planning_ms: float) -> None:
+        shape = parameterize_sql(sql_query)
+        if shape is None:
+            return
+        with self._lock:
+            stats = self._stats(shape.key)
+            previous = stats["planning_ms"]
+            stats["planning_ms"] = planning_ms if previous is None else 0.8 * previous + 0.2 * planning_ms
+
+    def execute(self, conn, shape: ParameterizedQuery, max_rows: int, max_bytes: int, chunk_rows: int,
+                on_chunk=None):
+        """
+        Run the shape as a prepared statement on conn (PREPAREd on first
+        use). Returns None if Postgres cannot prepare it or the result is too
+        large for a client-side cursor; the caller then uses the cursor path.
+        """
+        statements = conn.connection.info.setdefault(STATEMENTS_INFO_KEY, OrderedDict())
+        statement = statements.get(shape.key)
+        if statement is None:
+            statement = {"name": f"text_to_sql_{next(_statement_ids)}", "executions": 0}
+            limit = f"${len(shape.values) + 1}"
+            try:
+                with conn.begin_nested():
+                    conn.execute(text(
+                        f"PREPARE {statement['name']} ({', '.join(shape.types + ['bigint'])}) AS "
+                        + wrap_subquery(shape.template, "SELECT *", "prepared_result") + f" LIMIT {limit}"
+                    ))
+            except DBAPIError:
+                with self._lock:
+                    self._rejected.add(shape.key)
+                return None
+            statements[shape.key] = statement
+            while len(statements) > self.max_statements:
+                _, evicted = statements.popitem(last=False)
+                conn.execute(text(f"DEALLOCATE {evicted['name']}"))
+        statements.move_to_end(shape.key)
+
+        # Never hold more than self.max_rows rows client-side
+        cap = min(max_rows, self.max_rows)
+        params = {f"p{i}": value for i, value in enumerate(shape.values + [str(cap + 1)])}
+        try:
+            result = conn.execute(
+                text(f"EXECUTE {statement['name']} ({', '.join(f':{name}' for name in params)})"), params
+            )
+        except DBAPIError as e:
+            if (getattr(e.orig, "pgcode", None) == "26000"
+                    or "cached plan must not change result type" in str(e.orig)):
+                # Forget this connection's statements (new ones get new names) and
+                # deallocate them at the start of its next transaction
+                statements.clear()
+                conn.connection.info[STALE_INFO_KEY] = True
+                raise _StalePlanError() from e
+            raise
+        statement["executions"] += 1
+        with self._lock:
+            stats = self._stats(shape.key)
+            stats["prepared"] += 1
+            stats["generic"] += statement["executions"] > CUSTOM_PLAN_EXECUTIONS
+            if result.rowcount > cap and cap < max_rows:
+                # No longer a small shape: stop preparing it and rerun through the cursor
+                stats["max_rows"] = max(stats["max_rows"], result.rowcount)
+                result.close()
+                return None
+        return _read_capped(result, max_rows, max_bytes, chunk_rows, on_chunk)
+
+    def stats(self, top: int = 10) -> dict:
+        """Totals plus the `top` most frequent shapes (executions, prepared runs, planning ms saved)."""
+        with self._lock:
+            shapes = [{"shape": key, **stats} for key, stats in self._shapes.items()]
+            rejected = len(self._rejected)
+        for shape in shapes:
+            shape["planning_ms_saved"] = (shape["planning_ms"] or 0.0) * shape["generic"]
+        shapes.sort(key=lambda shape: shape["executions"], reverse=True)
+        return {
+            "shapes": len(shapes),
+            "executions": sum(shape["executions"] for shape in shapes),
+            "prepared_executions": sum(shape["prepared"] for shape in shapes),
+            "rejected_shapes": rejected,
+            "planning_ms_saved": sum(shape["planning_ms_saved"] for shape in shapes),
+            "top": shapes[:top],
+        }
+
+
+# --------------------------- #
+#     SCHEMA CATALOG
+# --------------------------- #
+def catalog_fingerprint(engine) -> str:
+    """
+    Hash of every (table, column, type) in the public schema, computed by
+    Postgres in a single cheap query.
+    """
+    query = """
+    SELECT md5(string_agg(table_name || '.' || column_name || ':' || data_type, ','
+                          ORDER BY table_name, ordinal_position))
+    FROM information_schema.columns
+    WHERE table_schema = 'public';
+    """
+    with engine.connect() as conn:
+        digest = conn.execute(text(query)).scalar()
+    return (digest or hashlib.md5(b"").hexdigest())[:16]
+
+
+def reflect_catalog(engine) -> dict:
+    """Return {table name: [{"name": column, "type": data type}, ...]} for the public schema."""
+    query = """
+    SELECT table_name, column_name, data_type
+    FROM information_schema.columns
+    WHERE table_schema = 'public'
+    ORDER BY table_name, ordinal_position;
+    """
+    with engine.connect() as conn:
+        columns = pd.read_sql(text(query), conn)
+    catalog = {}
+    for row in columns.itertuples(index=False):
+        catalog.setdefault(row.table_name, []).append(
+            {"name": row.column_name, "type": row.data_type}
+        )
+    return catalog
+
+
+def load_catalog(engine, fingerprint: str = None) -> dict:
+    """
+    Schema catalog, reflected at most once per schema version: results are
+    stored on disk under the catalog fingerprint and reused by every process.
+    """
+    fingerprint = fingerprint or catalog_fingerprint(engine)
+    cache_file = SCHEMA_CACHE_DIR / f"{fingerprint}.json"
+    try:
+        with open(cache_file, "r") as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        pass
+    catalog = reflect_catalog(engine)
+    SCHEMA_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_file, "w") as file:
+        json.dump(catalog, file)
+    os.replace(tmp_file, cache_file)
+    return catalog
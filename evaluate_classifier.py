@@ -0,0 +1,99 @@
+"""
+Offline evaluation of the local request classifier.
+
+Reports accuracy, escalation rate and per-call latency against a labeled set
+of sample questions (benchmarks/classifier_eval.jsonl by default):
+    python evaluate_classifier.py --threshold 0.75
+"""
+import argparse
+import statistics
+import time
+from collections import Counter
+from pathlib import Path
+
+from request_classifier import (
+    LABELS,
+    MODEL_FILE,
+    TRAIN_SAMPLES_FILE,
+    LocalClassifier,
+    load_labeled,
+    make_pipeline,
+    train_model,
+)
+from stats_utils import percentile
+
+
+def evaluate(classifier: LocalClassifier, samples: list, threshold: float) -> dict:
+    latencies_us = []
+    correct = 0
+    fast_path = 0
+    fast_path_correct = 0
+    confusion = Counter()
+    for text, expected in samples:
+        start = time.perf_counter()
+        label, confidence = classifier.classify(text)
+        latencies_us.append((time.perf_counter() - start) * 1e6)
+        confusion[(expected, label)] += 1
+        correct += label == expected
+        if label is not None and confidence >= threshold:
+            fast_path += 1
+            fast_path_correct += label == expected
+    return {
+        "accuracy": correct / len(samples),
+        "fast_path_rate": fast_path / len(samples),
+        "fast_path_accuracy": fast_path_correct / fast_path if fast_path else float("nan"),
+        "latency_mean_us": statistics.mean(latencies_us),
+        "latency_p50_us": percentile(latencies_us, 50),
+        "latency_p95_us": percentile(latencies_us, 95),
+        "latency_p99_us": percentile(latencies_us, 99),
+        "confusion": confusion,
+    }
+
+
+def print_report(name: str, report: dict) -> None:
+    print(f"\n=== {name} ===")
+    print(f"accuracy (all answers):        {report['accuracy']:.1%}")
+    print(f"answered locally (>= thresh):  {report['fast_path_rate']:.1%}")
+    print(f"accuracy of local answers:     {report['fast_path_accuracy']:.1%}")
+    print(
+        f"latency: mean {report['latency_mean_us']:.1f} us, p50 {report['latency_p50_us']:.1f} us, "
+        f"p95 {report['latency_p95_us']:.1f} us, p99 {report['latency_p99_us']:.1f} us"
+    )
+    print("confusion (expected -> predicted):")
+    for expected in LABELS:
+        row = ", ".join(
+            f"{predicted or 'NONE'}={report['confusion'][(expected, predicted)]}"
+            for predicted in LABELS + (None,)
+        )
+        print(f"  {expected:<4} -> {row}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate the local request classifier.")
+    parser.add_argument("--samples", default="benchmarks/classifier_eval.jsonl",
+                        help="JSONL file of labeled questions to evaluate on")
+    parser.add_argument("--model", default=str(MODEL_FILE),
+                        help="trained model; trained in memory from the training samples if missing")
+    parser.add_argument("--threshold", type=float, default=0.75,
+                        help="confidence below which the app escalates to the LLM")
+    args = parser.parse_args()
+
+    samples = load_labeled(args.samples)
+    if not samples:
+        parser.error(f"No labeled samples found in {args.samples}")
+    print(f"Evaluating on {len(samples)} samples, threshold {args.threshold}")
+
+    print_report("rules only", evaluate(LocalClassifier(), samples, args.threshold))
+
+    classifier = LocalClassifier.load(Path(args.model))
+    if classifier.model is None and make_pipeline is not None:
+        print(f"\n(no model at {args.model}; training in memory on {TRAIN_SAMPLES_FILE})")
+        classifier = LocalClassifier(train_model(load_labeled(TRAIN_SAMPLES_FILE)))
+    if classifier.model is not None:
+        print_report("rules + model", evaluate(classifier, samples, args.threshold))
+    else:
+        print("\nscikit-learn not installed; skipped the rules + model evaluation.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Offline evaluation of the local SQL validator.
+
+Runs the validator over generated queries (benchmarks/validator_cases.jsonl
+by default, each labeled ok / fixed / rejected) against the catalog described
+in a prompt template, and estimates the retries and seconds it saves:
+  - fixed:    the failed execution and the extra LLM attempt are both skipped
+  - rejected: the LLM is asked again, but the failed execution is skipped
+    python evaluate_validator.py --llm-seconds 4 --db-seconds 0.3
+"""
+import argparse
+import json
+import statistics
+import time
+from collections import Counter
+from pathlib import Path
+
+from stats_utils import percentile
+from sql_validator import build_catalog_index, catalog_from_prompt, validate_sql
+
+CASES_FILE = Path("benchmarks/validator_cases.jsonl")
+PROMPT_FILE = Path("prompts/db-sql-prompt.md")
+
+
+def load_cases(path: Path) -> list:
+    with open(path, "r", encoding="utf-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def evaluate(cases: list, index) -> dict:
+    outcomes = Counter()
+    confusion = Counter()
+    latencies_us = []
+    for case in cases:
+        start = time.perf_counter()
+        result = validate_sql(case["sql"], index)
+        latencies_us.append((time.perf_counter() - start) * 1e6)
+        outcome = "rejected" if result.errors else "fixed" if result.fixes else "ok"
+        if outcome == "fixed" and not validate_sql(result.sql, index).ok:
+            outcome = "rejected"
+        outcomes[outcome] += 1
+        confusion[(case["expect"], outcome)] += 1
+    return {
+        "outcomes": outcomes,
+        "confusion": confusion,
+        "accuracy": sum(n for (e, o), n in confusion.items() if e == o) / len(cases),
+        "latency_mean_us": statistics.mean(latencies_us),
+        "latency_p99_us": percentile(latencies_us, 99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate the local SQL validator.")
+    parser.add_argument("--cases", default=str(CASES_FILE))
+    parser.add_argument("--prompt", default=str(PROMPT_FILE),
+                        help="Prompt template whose **Table: ...** sections describe the schema")
+    parser.add_argument("--llm-seconds", type=float, default=4.0,
+                        help="Average latency of one SQL generation call")
+    parser.add_argument("--db-seconds", type=float, default=0.3,
+                        help="Average latency of one failed execution round trip")
+    args = parser.parse_args()
+
+    index = build_catalog_index(catalog_from_prompt(Path(args.prompt).read_text(encoding="utf-8")))
+    cases = load_cases(args.cases)
+    report = evaluate(cases, index)
+
+    fixed = report["outcomes"]["fixed"]
+    rejected = report["outcomes"]["rejected"]
+    retries_saved = fixed
+    seconds_saved = fixed * (args.llm_seconds + args.db_seconds) + rejected * args.db_seconds
+    print(f"cases:                     {len(cases)}")
+    print("outcomes:                  " + ", ".join(f"{k}={v}" for k, v in sorted(report["outcomes"].items())))
+    print(f"agreement with labels:     {report['accuracy']:.1%}")
+    print(f"validator latency:         mean {report['latency_mean_us']:.0f} µs, "
+          f"p99 {report['latency_p99_us']:.0f} µs")
+    print(f"LLM retries saved:         {retries_saved}")
+    print(f"failed executions saved:   {fixed + rejected}")
+    print(f"estimated seconds saved:   {seconds_saved:.1f} "
+          f"({seconds_saved / len(cases):.2f} s per question)")
+    mismatches = {k: v for k, v in report["confusion"].items() if k[0] != k[1]}
+    if mismatches:
+        print("mismatches (expected -> got):")
+        for (expected, got), count in sorted(mismatches.items()):
+            print(f"  {expected:>8} -> {got:<8} {count}")
+
+
+if __name__ == "__main__":
+    main()
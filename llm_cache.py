@@ -0,0 +1,179 @@
+"""
+Persistent (SQLite) cache of LLM completions for deterministic calls.
+
+Entries are content-addressed: the key is a hash of the model configuration
+(model name, temperature and the other invocation parameters, as LangChain
+serializes them) and the full prompt. Pass the cache to a ChatOpenAI with
+temperature 0 (`cache=shared_llm_cache()`); `cache=False` opts a call site
+out. The database is bounded by max_bytes; the least recently used entries
+are evicted first.
+
+Cache hits return without streaming any tokens, so generations served from
+the cache are flagged and stream callbacks replay them with replay_tokens().
+"""
+from contextlib import contextmanager
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from langchain.schema import AIMessage, ChatGeneration, Generation
+from langchain.schema.cache import BaseCache
+
+# --- Paths ---
+LLM_CACHE_FILE = Path(".cache/llm_cache.sqlite")
+
+CACHED_FLAG = "llm_cache"  # generation_info key of cache hits
+REPLAY_CHARS = 4
+
+
+def cache_key(prompt: str, llm_string: str) -> str:
+    return hashlib.sha256(f"{llm_string}\0{prompt}".encode("utf-8")).hexdigest()
+
+
+def _dump_generations(generations) -> str:
+    return json.dumps([
+        {
+            "text": g.text,
+            "generation_info": g.generation_info,
+            "response_metadata": g.message.response_metadata if isinstance(g, ChatGeneration) else None,
+        }
+        for g in generations
+    ], default=str)
+
+
+def _load_generations(payload: str) -> list:
+    generations = []
+    for g in json.loads(payload):
+        info = {**(g["generation_info"] or {}), CACHED_FLAG: True}
+        if g["response_metadata"] is None:
+            generations.append(Generation(text=g["text"], generation_info=info))
+        else:
+            message = AIMessage(content=g["text"], response_metadata=g["response_metadata"])
+            generations.append(ChatGeneration(message=message, generation_info=info))
+    return generations
+
+
+def replay_tokens(response) -> list:
+    """Text of the cached generations in an LLMResult, as token-sized chunks ([] for live completions)."""
+    tokens = []
+    for generations in response.generations:
+        for generation in generations:
+            if (generation.generation_info or {}).get(CACHED_FLAG):
+                text = generation.text
+                tokens.extend(text[i:i + REPLAY_CHARS] for i in range(0, len(text), REPLAY_CHARS))
+    return tokens
+
+
+class LLMCache(BaseCache):
+    """LangChain cache backed by SQLite, size-bounded with LRU eviction; safe to share between threads."""
+    def __init__(self, path: Path = LLM_CACHE_FILE, max_bytes: int = 256 * 1024 ** 2):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS llm_completion (
+                    key TEXT PRIMARY KEY,
+                    generations TEXT NOT NULL,
+                    bytes INTEGER NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    used_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS llm_completion_used_at ON llm_completion (used_at)")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def lookup(self, prompt: str, llm_string: str):
+        """The cached generations (flagged with CACHED_FLAG), or None on a miss."""
+        key = cache_key(prompt, llm_string)
+        with self._lock, self._connect() as conn:
+            row = conn.execute("SELECT generations FROM llm_completion WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute("UPDATE llm_completion SET hits = hits + 1, used_at = ? WHERE key = ?", (time.time(), key))
+            self.hits += 1
+        return _load_generations(row[0])
+
+    def update(self, prompt: str, llm_string: str, return_val) -> None:
+        """Store a completion, then evict the least recently used entries over max_bytes."""
+        payload = _dump_generations(return_val)
+        size = len(payload.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                """
+                INSERT INTO llm_completion (key, generations, bytes, created_at, used_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET generations = excluded.generations,
+                                                bytes = excluded.bytes, used_at = excluded.used_at
+                """,
+                (cache_key(prompt, llm_string), payload, size, now, now),
+            )
+            self._evict(conn)
+
+    def _evict(self, conn) -> None:
+        total = conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM llm_completion").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = conn.execute("SELECT key, bytes FROM llm_completion ORDER BY used_at")
+        evicted = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        conn.executemany("DELETE FROM llm_completion WHERE key = ?", evicted)
+
+    def clear(self, **kwargs) -> None:
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM llm_completion")
+
+    def stats(self) -> dict:
+        """{"entries", "bytes"} currently on disk."""
+        with self._lock, self._connect() as conn:
+            entries, size = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM llm_completion"
+            ).fetchone()
+        return {"entries": entries, "bytes": size}
+
+
+_shared_cache = None
+_shared_lock = threading.Lock()
+
+
+def shared_llm_cache():
+    """
+    The process-wide cache (LLM_CACHE_FILE, LLM_CACHE_MAX_MB), or False when
+    LLM_CACHE=false; either way it can be passed as ChatOpenAI(cache=...).
+    """
+    global _shared_cache
+    if os.getenv("LLM_CACHE", "true").strip().lower() not in ("1", "true", "yes", "on"):
+        return False
+    with _shared_lock:
+        if _shared_cache is None:
+            _shared_cache = LLMCache(
+                Path(os.getenv("LLM_CACHE_FILE", str(LLM_CACHE_FILE))),
+                max_bytes=int(os.getenv("LLM_CACHE_MAX_MB", "256")) * 1024 ** 2,
+            )
+        return _shared_cache
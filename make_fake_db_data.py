@@ -1,5 +1,6 @@
 import os
 import csv
+import argparse
 import random
 import datetime
 from faker import Faker
@@ -7,9 +8,8 @@ from tqdm import tqdm
 
 fake = Faker()
 
-# Make sure the output directory exists
-output_dir = "./table_csvs"
-os.makedirs(output_dir, exist_ok=True)
+# Default output directory (populate_db.py loads every CSV in it)
+OUTPUT_DIR = "./table_csvs"
 
 ##################################################
 # 1) Define how many rows of data to generate per table
@@ -399,11 +399,20 @@ def write_csv(filename, fieldnames, rows):
         for r in rows:
             writer.writerow(r)
 
-def main():
+def scaled(num_rows, scale):
+    """Row count for a scale factor (1.0 = the sizes above), at least one row."""
+    return max(1, int(num_rows * scale))
+
+def main(scale=1.0, output_dir=OUTPUT_DIR, seed=None):
     # Generate the data for each table in order that respects PK/FK references.
+    os.makedirs(output_dir, exist_ok=True)
+    if seed is not None:
+        # Same seed + scale => same data (e.g. for benchmark runs)
+        random.seed(seed)
+        Faker.seed(seed)
 
     # 1) Header
-    header_data = generate_header_table_data(NUM_HEADER_ROWS)
+    header_data = generate_header_table_data(scaled(NUM_HEADER_ROWS, scale))
     header_fields = list(header_data[0].keys()) if header_data else []
     write_csv(
         os.path.join(output_dir, "Header.csv"),
@@ -412,7 +421,7 @@ def main():
     )
 
     # 2) Student
-    student_data = generate_student_table_data(NUM_STUDENT_ROWS)
+    student_data = generate_student_table_data(scaled(NUM_STUDENT_ROWS, scale))
     student_fields = list(student_data[0].keys()) if student_data else []
     write_csv(
         os.path.join(output_dir, "Student.csv"),
@@ -424,7 +433,7 @@ def main():
     student_ids = [row["student_id"] for row in student_data]
 
     # 3) Alternate State Student IDs
-    alt_ids_data = generate_alternate_ids_table_data(NUM_ALTERNATE_IDS_ROWS, student_ids)
+    alt_ids_data = generate_alternate_ids_table_data(scaled(NUM_ALTERNATE_IDS_ROWS, scale), student_ids)
     alt_ids_fields = list(alt_ids_data[0].keys()) if alt_ids_data else []
     write_csv(
         os.path.join(output_dir, "Alternate_State_Student_IDs.csv"),
@@ -433,7 +442,7 @@ def main():
     )
 
     # 4) Demographics
-    demo_data = generate_demographics_table_data(NUM_DEMOGRAPHICS_ROWS, student_ids)
+    demo_data = generate_demographics_table_data(scaled(NUM_DEMOGRAPHICS_ROWS, scale), student_ids)
     demo_fields = list(demo_data[0].keys()) if demo_data else []
     write_csv(
         os.path.join(output_dir, "Demographics.csv"),
@@ -442,7 +451,7 @@ def main():
     )
 
     # 5) Qualifying Moves
-    qual_moves_data = generate_qualifying_moves_table_data(NUM_QUALIFYING_MOVES_ROWS, student_ids)
+    qual_moves_data = generate_qualifying_moves_table_data(scaled(NUM_QUALIFYING_MOVES_ROWS, scale), student_ids)
     qual_moves_fields = list(qual_moves_data[0].keys()) if qual_moves_data else []
     write_csv(
         os.path.join(output_dir, "Qualifying_Moves.csv"),
@@ -451,7 +460,7 @@ def main():
     )
 
     # 6) Enrollments
-    enroll_data = generate_enrollments_table_data(NUM_ENROLLMENTS_ROWS, student_ids)
+    enroll_data = generate_enrollments_table_data(scaled(NUM_ENROLLMENTS_ROWS, scale), student_ids)
     enroll_fields = list(enroll_data[0].keys()) if enroll_data else []
     write_csv(
         os.path.join(output_dir, "Enrollments.csv"),
@@ -460,7 +469,7 @@ def main():
     )
 
     # 7) Course History
-    course_hist_data = generate_course_history_table_data(NUM_COURSE_HISTORY_ROWS, student_ids)
+    course_hist_data = generate_course_history_table_data(scaled(NUM_COURSE_HISTORY_ROWS, scale), student_ids)
     course_hist_fields = list(course_hist_data[0].keys()) if course_hist_data else []
     write_csv(
         os.path.join(output_dir, "Course_History.csv"),
@@ -469,7 +478,7 @@ def main():
     )
 
     # 8) Assessments
-    assess_data = generate_assessments_table_data(NUM_ASSESSMENTS_ROWS, student_ids)
+    assess_data = generate_assessments_table_data(scaled(NUM_ASSESSMENTS_ROWS, scale), student_ids)
     assess_fields = list(assess_data[0].keys()) if assess_data else []
     write_csv(
         os.path.join(output_dir, "Assessments.csv"),
@@ -480,4 +489,10 @@ def main():
     print("Fake data CSVs generated in:", output_dir)
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Generate the fake education dataset as CSV files.")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="Multiplier for the row counts above (e.g. 0.01 for a quick test set)")
+    parser.add_argument("--output-dir", default=OUTPUT_DIR)
+    parser.add_argument("--seed", type=int, default=None, help="Seed for reproducible data")
+    args = parser.parse_args()
+    main(scale=args.scale, output_dir=args.output_dir, seed=args.seed)
@@ -0,0 +1,99 @@
+"""
+Background summarization for ConversationSummaryBufferMemory.
+
+save_context() normally appends the turn and then prunes the buffer, which
+calls the LLM to fold the oldest messages into the running summary while
+the user waits. Here the turn is appended immediately and pruning runs on a
+per-session worker thread. Loads never wait: the summary is computed from a
+snapshot of the oldest messages and swapped in atomically, so a reader sees
+either the unpruned buffer or the pruned buffer plus its new summary, never
+a state in which messages are missing.
+"""
+import queue
+import threading
+
+from langchain.schema import AIMessage, HumanMessage
+
+
+class BackgroundSummarizer:
+    """
+    Wraps a ConversationSummaryBufferMemory; give that memory its own
+    non-streaming LLM so summaries never reach the chat's stream callbacks.
+    """
+    def __init__(self, memory, queue_size: int = 8, idle_seconds: float = 600):
+        self.memory = memory
+        self.idle_seconds = idle_seconds
+        self.summarizations = 0
+        self.last_error = None
+        self._jobs = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()  # guards memory.chat_memory.messages / moving_summary_buffer
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def save(self, user_input: str, output: str) -> None:
+        """Append a turn now; summarize in the background if the buffer is over its limit."""
+        with self._lock:
+            self.memory.chat_memory.add_messages([HumanMessage(content=user_input), AIMessage(content=output)])
+        try:
+            self._jobs.put_nowait("prune")
+        except queue.Full:
+            pass  # a queued prune covers the whole buffer, including this turn
+        self._ensure_thread()
+
+    def load(self):
+        """History as the memory would return it (summary + buffered messages)."""
+        with self._lock:
+            return self.memory.load_memory_variables({}).get("history", "NONE")
+
+    def flush(self) -> None:
+        """Block until all queued summarization work is done."""
+        self._jobs.join()
+
+    @property
+    def pending(self) -> int:
+        return self._jobs.unfinished_tasks
+
+    def stop(self) -> None:
+        with self._thread_lock:
+            if self._thread is not None and self._thread.is_alive():
+                self._jobs.put(None)
+
+    def _ensure_thread(self) -> None:
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="memory-summarizer", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                job = self._jobs.get(timeout=self.idle_seconds)
+            except queue.Empty:
+                return  # idle session: the next save() starts a new thread
+            try:
+                if job is None:
+                    return
+                self._prune()
+            except Exception as e:  # keep the worker alive; the buffer just stays larger
+                self.last_error = e
+            finally:
+                self._jobs.task_done()
+
+    def _prune(self) -> None:
+        memory = self.memory
+        with self._lock:
+            buffer = list(memory.chat_memory.messages)
+            summary = memory.moving_summary_buffer
+        length = memory.llm.get_num_tokens_from_messages(buffer)
+        if length <= memory.max_token_limit:
+            return
+        pruned = []
+        while buffer and length > memory.max_token_limit:
+            pruned.append(buffer.pop(0))
+            length = memory.llm.get_num_tokens_from_messages(buffer)
+        new_summary = memory.predict_new_summary(pruned, summary)
+        with self._lock:
+            # Only this thread removes messages, and only from the front
+            del memory.chat_memory.messages[:len(pruned)]
+            memory.moving_summary_buffer = new_summary
+        self.summarizations += 1
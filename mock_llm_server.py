@@ -0,0 +1,190 @@
+"""
+Local OpenAI-compatible stub for benchmarks and offline runs.
+
+Serves POST /v1/chat/completions (streaming and not) with canned answers
+from a question file (benchmarks/benchmark_questions.jsonl by default):
+
+  - classification prompts  -> the question's "label"
+  - chart-spec prompts      -> the question's "chart" as JSON
+  - SQL prompts             -> the question's "first_sql" if given (to
+                               exercise the retry loop), else its "sql"
+  - error-feedback prompts  -> the "sql" of the question whose first_sql failed
+  - anything else           -> a short chat reply
+
+Tokens (~4 characters each) are emitted at --tokens-per-second after
+--first-token-ms, so generation latency looks like a real model's.
+Point the app or the benchmark at it with OPENAI_API_BASE:
+
+    python mock_llm_server.py --port 8100 --tokens-per-second 80
+    OPENAI_API_BASE=http://127.0.0.1:8100/v1 streamlit run app.py
+"""
+import argparse
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+QUESTIONS_FILE = Path("benchmarks/benchmark_questions.jsonl")
+CHARS_PER_TOKEN = 4
+CHAT_REPLY = "Happy to help! Ask me a question about the data and I will write the SQL for it."
+
+
+def load_answers(path: Path = QUESTIONS_FILE) -> list:
+    with open(path, "r", encoding="utf-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def _sql_reply(sql: str) -> str:
+    return f"Here is a query that answers the question:\n\n```sql\n{sql}\n```"
+
+
+def canned_reply(prompt: str, answers: list) -> str:
+    """The canned answer for a prompt (see the module docstring)."""
+    if "You are a text classifier" in prompt:
+        question = _find_question(prompt, answers)
+        return question.get("label", "SQL") if question else "CHAT"
+    if "specifying how to plot" in prompt:
+        question = _find_question(prompt, answers)
+        return json.dumps(question.get("chart", {})) if question else "{}"
+    if "The SQL query caused an error" in prompt:
+        for question in answers:
+            if question.get("first_sql") and question["first_sql"] in prompt:
+                return _sql_reply(question["sql"])
+    question = _find_question(prompt, answers)
+    if question and question.get("sql"):
+        return _sql_reply(question.get("first_sql") or question["sql"])
+    return CHAT_REPLY
+
+
+def _find_question(prompt: str, answers: list):
+    """The longest question text contained in the prompt."""
+    matches = [q for q in answers if q["question"] in prompt]
+    return max(matches, key=lambda q: len(q["question"])) if matches else None
+
+
+def split_tokens(text: str) -> list:
+    return [text[i:i + CHARS_PER_TOKEN] for i in range(0, len(text), CHARS_PER_TOKEN)]
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    server_version = "MockLLM/1.0"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, body: dict):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._send_json(200, {"object": "list", "data": [{"id": "mock", "object": "model"}]})
+        else:
+            self._send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "not found"}})
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        prompt = "\n".join(str(m.get("content", "")) for m in request.get("messages", []))
+        reply = canned_reply(prompt, self.server.answers)
+        tokens = split_tokens(reply)
+        self.server.record(prompt, reply)
+        time.sleep(self.server.first_token_seconds)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        model = request.get("model", "mock")
+        if request.get("stream"):
+            self._stream(completion_id, model, tokens)
+            return
+        time.sleep(len(tokens) * self.server.seconds_per_token)
+        self._send_json(200, {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": reply},
+                         "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": len(prompt) // CHARS_PER_TOKEN, "completion_tokens": len(tokens),
+                      "total_tokens": len(prompt) // CHARS_PER_TOKEN + len(tokens)},
+        })
+
+    def _stream(self, completion_id: str, model: str, tokens: list):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+        def event(delta: dict, finish_reason=None):
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        event({"role": "assistant", "content": ""})
+        for token in tokens:
+            time.sleep(self.server.seconds_per_token)
+            event({"content": token})
+        event({}, finish_reason="stop")
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+class MockLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, answers: list, tokens_per_second: float = 80.0, first_token_ms: float = 300.0):
+        super().__init__(address, MockLLMHandler)
+        self.answers = answers
+        self.seconds_per_token = 1.0 / tokens_per_second if tokens_per_second > 0 else 0.0
+        self.first_token_seconds = first_token_ms / 1000
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def record(self, prompt: str, reply: str) -> None:
+        with self._lock:
+            self.calls += 1
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+
+def start_mock_server(answers: list, port: int = 0, tokens_per_second: float = 80.0,
+                      first_token_ms: float = 300.0) -> MockLLMServer:
+    """Serve on a background thread (port 0 = any free port); stop with .shutdown()."""
+    server = MockLLMServer(("127.0.0.1", port), answers, tokens_per_second, first_token_ms)
+    threading.Thread(target=server.serve_forever, name="mock-llm", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve canned OpenAI-compatible chat completions.")
+    parser.add_argument("--questions", default=str(QUESTIONS_FILE))
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--tokens-per-second", type=float, default=80.0)
+    parser.add_argument("--first-token-ms", type=float, default=300.0)
+    args = parser.parse_args()
+    server = MockLLMServer(("127.0.0.1", args.port), load_answers(Path(args.questions)),
+                           args.tokens_per_second, args.first_token_ms)
+    print(f"Mock LLM serving on {server.base_url} (Ctrl + C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
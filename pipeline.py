@@ -0,0 +1,537 @@
+"""
+The text-to-SQL pipeline, independent of any UI.
+
+classify -> build prompt -> generate -> extract_sql -> validate -> cost
+guard -> run -> retry, plus chart-spec selection for PLOT requests. A
+Pipeline holds what is shared between requests (pooled engine, result and
+question caches, local classifier, catalog index, SQL workload log,
+prepared statements); everything per request (LLMs with their streaming
+callbacks, conversation history, how queries are run and how progress is
+shown) is passed in by the caller. The Streamlit app and the HTTP service
+(service.py) are both clients of it.
+
+Progress is reported through an optional on_event(dict) callback, e.g.
+{"type": "sql_error", "attempt": 1, "max_attempts": 5, "error": "..."}.
+"""
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import pandas as pd
+
+from chart_inference import extract_chart_instruction, infer_chart_spec, validate_chart_spec
+from database import PlanCache, catalog_fingerprint, guard_query_cost, load_catalog, stream_query
+from plot_prep import aggregate_plot_sql, needs_pushdown, prepare_plot_data
+from query_cache import ResultCache
+from query_db import WorkloadLog
+from question_cache import QuestionCache
+from request_classifier import LocalClassifier, build_classification_prompt, parse_llm_label, log_turn
+from schema_retrieval import prune_prompt_template
+from sql_candidates import generate_candidates
+from sql_utils import extract_sql
+from sql_validator import SQLValidationError, build_catalog_index, validate_sql
+
+# --- Paths ---
+PROMPTS_DIR = Path("prompts")
+
+DEFAULT_PROMPT_TEMPLATE = """{conversation_summary}
+
+User says: {user_input}
+
+Assistant:"""
+
+ACTIONS = ("SQL", "PLOT", "CHAT")
+COST_ACTIONS = ("feedback", "limit", "aggregate")
+
+
+def _env_flag(name: str, default: str) -> bool:
+    return os.getenv(name, default).lower() in ("1", "true", "yes")
+
+
+@dataclass
+class PipelineSettings:
+    """Limits and thresholds; from_env() reads the same variables as db_config.env documents."""
+    # Hard caps on what a single query may pull in
+    max_rows: int = 100_000
+    max_mb: int = 200
+    chunk_rows: int = 10_000
+    # Per-statement timeout; generated SQL runs in read-only transactions unless disabled
+    timeout_seconds: float = 60.0
+    read_only: bool = True
+    # EXPLAIN-based pre-flight budget
+    max_est_cost: float = 5_000_000
+    max_est_rows: float = 1_000_000
+    over_budget_limit: int = 1000
+    max_sql_retries: int = 5
+    # Parallel candidate generation
+    candidate_grace_seconds: float = 1.5
+    llm_max_workers: int = 16
+    # Local classifier / chart inference confidence below which the LLM is asked
+    classifier_threshold: float = 0.75
+    chart_confidence_threshold: float = 0.6
+    max_plot_attempts: int = 2
+    # Point budgets per chart and SQL pushdown of plot aggregation
+    plot_max_line_points: int = 2000
+    plot_max_scatter_points: int = 5000
+    plot_max_bars: int = 30
+    plot_sql_pushdown: bool = True
+    # Shared result cache
+    result_cache_max_mb: int = 256
+    result_cache_ttl_seconds: float = 900
+    schema_check_seconds: float = 300
+
+    @property
+    def timeout_ms(self) -> int:
+        return int(self.timeout_seconds * 1000)
+
+    @classmethod
+    def from_env(cls) -> "PipelineSettings":
+        return cls(
+            max_rows=int(os.getenv("QUERY_MAX_ROWS", "100000")),
+            max_mb=int(os.getenv("QUERY_MAX_MB", "200")),
+            chunk_rows=int(os.getenv("QUERY_CHUNK_ROWS", "10000")),
+            timeout_seconds=float(os.getenv("QUERY_TIMEOUT_SECONDS", "60")),
+            read_only=_env_flag("QUERY_READ_ONLY", "true"),
+            max_est_cost=float(os.getenv("QUERY_MAX_EST_COST", "5000000")),
+            max_est_rows=float(os.getenv("QUERY_MAX_EST_ROWS", "1000000")),
+            over_budget_limit=int(os.getenv("QUERY_OVER_BUDGET_LIMIT", "1000")),
+            max_sql_retries=int(os.getenv("MAX_SQL_RETRIES", "5")),
+            candidate_grace_seconds=float(os.getenv("SQL_CANDIDATE_GRACE_SECONDS", "1.5")),
+            llm_max_workers=int(os.getenv("LLM_MAX_WORKERS", "16")),
+            classifier_threshold=float(os.getenv("CLASSIFIER_CONFIDENCE_THRESHOLD", "0.75")),
+            chart_confidence_threshold=float(os.getenv("CHART_CONFIDENCE_THRESHOLD", "0.6")),
+            plot_max_line_points=int(os.getenv("PLOT_MAX_LINE_POINTS", "2000")),
+            plot_max_scatter_points=int(os.getenv("PLOT_MAX_SCATTER_POINTS", "5000")),
+            plot_max_bars=int(os.getenv("PLOT_MAX_BARS", "30")),
+            plot_sql_pushdown=_env_flag("PLOT_SQL_PUSHDOWN", "true"),
+            result_cache_max_mb=int(os.getenv("RESULT_CACHE_MAX_MB", "256")),
+            result_cache_ttl_seconds=float(os.getenv("RESULT_CACHE_TTL_SECONDS", "900")),
+        )
+
+
+@dataclass
+class SQLAnswer:
+    """Outcome of answer_sql(). df is None for chat replies and failures."""
+    response_text: str = ""
+    sql: str = None
+    df: pd.DataFrame = None
+    source: str = "llm"  # "llm", "question_cache", "candidates" or "chat"
+    attempts: int = 0
+    notes: list = field(default_factory=list)
+    error: str = None
+    fixed: int = 0  # queries repaired by the local validator
+    rejected: int = 0  # queries sent back without a database round trip
+    timings: dict = field(default_factory=dict)
+    spans: list = field(default_factory=list)  # one per timed step: name, start, seconds, attempt, ...
+
+    @property
+    def ok(self) -> bool:
+        return self.df is not None
+
+
+@dataclass
+class PlotAnswer:
+    """Outcome of plot(): the spec and the frame it is drawn from (possibly aggregated in SQL)."""
+    spec: dict = None
+    df: pd.DataFrame = None
+    pushdown_sql: str = None
+    source: str = "local"  # "local" or "llm"
+    notes: list = field(default_factory=list)
+
+
+def load_prompt_template(name: str = None) -> str:
+    """A prompt template from ./prompts by file name; the plain chat template for None/"None"."""
+    if not name or name == "None":
+        return DEFAULT_PROMPT_TEMPLATE
+    return (PROMPTS_DIR / os.path.basename(name)).read_text()
+
+
+def build_chart_prompt(df: pd.DataFrame, user_input: str, local_guess: dict) -> str:
+    return f"""
+You must return a JSON object specifying how to plot the DataFrame below.
+
+DataFrame columns and types: {dict(df.dtypes.astype(str))}
+Best local guess (may be wrong): {json.dumps(local_guess)}
+
+Return a JSON object with this format:
+{{
+  "chart_type": "bar" | "line" | "scatter",
+  "x": "<column name for x-axis>",
+  "y": "<column name or list of columns for y-axis>"
+}}
+
+No additional text, only JSON. If you can't produce a valid specification, say so.
+
+here is the user input: {user_input}
+"""
+
+
+def _ignore(event: dict) -> None:
+    pass
+
+
+class Pipeline:
+    """Shared state of the pipeline; safe to use from several threads."""
+    def __init__(self, engine, settings: PipelineSettings = None, result_cache: ResultCache = None,
+                 question_cache: QuestionCache = None, classifier: LocalClassifier = None,
+                 workload_log: WorkloadLog = None, plan_cache: PlanCache = None):
+        self.engine = engine
+        self.settings = settings or PipelineSettings.from_env()
+        self.result_cache = result_cache or ResultCache(
+            max_bytes=self.settings.result_cache_max_mb * 1024 ** 2,
+            ttl_seconds=self.settings.result_cache_ttl_seconds,
+        )
+        self.question_cache = question_cache or QuestionCache()
+        self.classifier = classifier or LocalClassifier.load()
+        self.workload_log = workload_log or WorkloadLog.from_env()
+        self.plan_cache = plan_cache or PlanCache.from_env()
+        self._llm_executor = None
+        self._fingerprint = (None, 0.0)
+        self._catalog_indexes = {}
+        self._lock = threading.Lock()
+
+    # --------------------------- #
+    #     SHARED RESOURCES
+    # --------------------------- #
+    @property
+    def llm_executor(self) -> ThreadPoolExecutor:
+        """Threads for concurrent LLM calls (parallel candidates)."""
+        with self._lock:
+            if self._llm_executor is None:
+                self._llm_executor = ThreadPoolExecutor(
+                    max_workers=self.settings.llm_max_workers, thread_name_prefix="llm"
+                )
+            return self._llm_executor
+
+    def schema_fingerprint(self) -> str:
+        """Catalog fingerprint, re-checked every settings.schema_check_seconds."""
+        fingerprint, checked_at = self._fingerprint
+        if fingerprint is None or time.time() - checked_at > self.settings.schema_check_seconds:
+            fingerprint = catalog_fingerprint(self.engine)
+            self._fingerprint = (fingerprint, time.time())
+        return fingerprint
+
+    def catalog_index(self, schema_fingerprint: str = None):
+        """Validator lookup tables, built once per schema version."""
+        schema_fingerprint = schema_fingerprint or self.schema_fingerprint()
+        index = self._catalog_indexes.get(schema_fingerprint)
+        if index is None:
+            index = build_catalog_index(load_catalog(self.engine, schema_fingerprint))
+            with self._lock:
+                self._catalog_indexes = {schema_fingerprint: index}
+        return index
+
+    # --------------------------- #
+    #     CLASSIFY + PROMPT
+    # --------------------------- #
+    def classify(self, user_input: str, chat_history: str, llm) -> str:
+        """
+        "SQL", "PLOT" or "CHAT". The local classifier answers confident
+        cases; llm (non-streaming) is only called otherwise.
+        """
+        label, confidence = self.classifier.classify(user_input)
+        if label is not None and confidence >= self.settings.classifier_threshold:
+            log_turn(user_input, label, "local", confidence)
+            return label
+        label = parse_llm_label(llm.predict(build_classification_prompt(user_input, chat_history)))
+        log_turn(user_input, label, "llm", confidence)
+        return label
+
+    def build_prompt(self, prompt_template: str, user_input: str, chat_history: str = "NONE",
+                     prune_schema: bool = True):
+        """Return (formatted prompt, PruneReport or None) with only the relevant schema sections."""
+        report = None
+        if prune_schema:
+            prompt_template, report = prune_prompt_template(prompt_template, user_input, str(chat_history))
+        formatted = prompt_template.format(conversation_summary=chat_history or "NONE", user_input=user_input)
+        return formatted, report
+
+    # --------------------------- #
+    #     RUN SQL
+    # --------------------------- #
+    def run_sql(self, sql_query: str, on_chunk=None, on_backend_pid=None) -> pd.DataFrame:
+        """
+        Run a query through the shared result cache. Rows are streamed from a
+        server-side cursor and capped at settings.max_rows / max_mb; this
+        blocks the calling thread (callers that need Cancel run it on a worker).
+        Executed queries (not cache hits) are appended to the workload log;
+        hot query shapes run as prepared statements (plan_cache).
+        """
+        df = self.result_cache.get(sql_query)
+        if df is not None:
+            return df
+        settings = self.settings
+        started = time.time()
+        try:
+            df = stream_query(
+                self.engine,
+                sql_query,
+                max_rows=settings.max_rows,
+                max_bytes=settings.max_mb * 1024 ** 2,
+                chunk_rows=settings.chunk_rows,
+                on_chunk=on_chunk,
+                timeout_ms=settings.timeout_ms,
+                read_only=settings.read_only,
+                on_backend_pid=on_backend_pid,
+                plan_cache=self.plan_cache,
+            )
+        except Exception as e:
+            self.workload_log.record(sql_query, time.time() - started, error=str(e))
+            raise
+        self.workload_log.record(sql_query, time.time() - started, rows=len(df),
+                                 truncated=bool(df.attrs.get("truncated_at")))
+        self.result_cache.put(sql_query, df)
+        return df
+
+    def check_cost(self, sql_query: str, action: str = "feedback"):
+        """
+        Return (sql to run, note or None) after an EXPLAIN pre-flight check.
+        Raises QueryTooExpensiveError when the query should go back to the model.
+        Queries already in the result cache skip the check.
+        """
+        if sql_query in self.result_cache:
+            return sql_query, None
+        settings = self.settings
+        return guard_query_cost(
+            self.engine,
+            sql_query,
+            max_cost=settings.max_est_cost,
+            max_rows=settings.max_est_rows,
+            action=action,
+            limit_rows=settings.over_budget_limit,
+            timeout_ms=settings.timeout_ms,
+            plan_cache=self.plan_cache,
+        )
+
+    # --------------------------- #
+    #     GENERATE + RETRY
+    # --------------------------- #
+    def answer_sql(self, llm, prompt: str, prompt_template: str, user_input: str, run=None, on_event=None,
+                   candidates: int = 1, candidate_llm=None, cost_action: str = "feedback",
+                   reuse_sql: bool = True, match_mode: str = "normalized") -> SQLAnswer:
+        """
+        Answer a SQL request: replay the SQL of an identical earlier question,
+        else generate (optionally `candidates` at once with candidate_llm),
+        validate, cost-check and run, feeding errors back to llm for up to
+        settings.max_sql_retries attempts.
+
+        run(sql) -> DataFrame defaults to run_sql(); llm.predict's return value
+        is used as the response, so streaming callbacks are up to the caller.
+        """
+        run = run or self.run_sql
+        emit = on_event or _ignore
+        answer = SQLAnswer()
+        started = time.time()
+        schema_fingerprint = self.schema_fingerprint()
+
+        # Replay the SQL of a previously answered identical question, skipping the LLM
+        cached_sql = None
+        if reuse_sql:
+            cached_sql = self.question_cache.lookup(prompt_template, schema_fingerprint, user_input, mode=match_mode)
+        if cached_sql:
+            emit({"type": "cached_sql", "sql": cached_sql})
+            try:
+                answer.df = self._timed(answer, "run", run, cached_sql)
+                answer.sql, answer.source = cached_sql, "question_cache"
+                answer.response_text = (
+                    f"⚡ Reusing the SQL from a previous identical question:\n\n"
+                    f"```sql\n{cached_sql}\n```\n\n**SQL Results:**\n\nData retrieved successfully."
+                )
+                answer.timings["total"] = time.time() - started
+                return answer
+            except Exception as e:
+                # Stale entry (e.g. schema drift) => fall back to the LLM
+                emit({"type": "cached_sql_failed", "error": str(e)})
+
+        agent_prompt = prompt
+        if candidates > 1:
+            agent_prompt = self._answer_with_candidates(
+                answer, candidate_llm or llm, prompt, prompt_template, user_input,
+                candidates, schema_fingerprint, cost_action, run, emit,
+            )
+        if answer.df is None and not answer.response_text:
+            self._answer_sequentially(
+                answer, llm, agent_prompt, prompt_template, user_input, schema_fingerprint, cost_action, run, emit,
+            )
+        answer.timings["total"] = time.time() - started
+        return answer
+
+    @staticmethod
+    def _timed(answer: SQLAnswer, name: str, function, *args):
+        started = time.time()
+        span = {"name": name, "start": started, "attempt": answer.attempts}
+        try:
+            result = function(*args)
+            if isinstance(result, pd.DataFrame):
+                span["rows"] = len(result)
+                span["bytes"] = int(result.memory_usage(deep=True).sum())
+            return result
+        except Exception as e:
+            span["error"] = str(e)[:500]
+            raise
+        finally:
+            seconds = time.time() - started
+            answer.timings[name] = answer.timings.get(name, 0.0) + seconds
+            answer.spans.append({**span, "seconds": seconds})
+
+    def _answer_with_candidates(self, answer, llm, prompt, prompt_template, user_input, n,
+                                schema_fingerprint, cost_action, run, emit) -> str:
+        """Fill answer from the cheapest working candidate; returns the prompt for the sequential loop."""
+        settings = self.settings
+        emit({"type": "candidates", "n": n})
+        answer.attempts += 1
+        candidates = self._timed(
+            answer, "generate", generate_candidates,
+            self.llm_executor, llm, prompt, n, self.catalog_index(schema_fingerprint), self.engine,
+            settings.max_est_cost, settings.max_est_rows, settings.timeout_ms, settings.candidate_grace_seconds,
+            cost_action,
+        )
+        failures = []
+        for candidate in candidates:
+            if not candidate.ok:
+                if candidate.error:
+                    failures.append((candidate, candidate.error))
+                continue
+            sql_to_run, cost_note = candidate.sql, None
+            try:
+                if candidate.over_budget:
+                    # Same LIMIT / COUNT(*) rewrite the sequential path applies for cost_action
+                    sql_to_run, cost_note = self._timed(answer, "explain", self.check_cost, candidate.sql, cost_action)
+                answer.df = self._timed(answer, "run", run, sql_to_run)
+            except Exception as e:
+                emit({"type": "sql_error", "attempt": answer.attempts, "error": str(e), "sql": candidate.sql})
+                failures.append((candidate, str(e)))
+                continue
+            if not cost_note:
+                self.question_cache.store(prompt_template, schema_fingerprint, user_input, sql_to_run)
+            answer.sql, answer.source = sql_to_run, "candidates"
+            answer.response_text = (
+                f"{candidate.response_text}\n\n**SQL Results:**\n\nData retrieved successfully "
+                f"(cheapest of {len(candidates)} candidates, estimated cost {candidate.cost:,.0f})."
+            )
+            if candidate.fixes:
+                answer.fixed += 1
+                answer.notes.append("🔧 Fixed locally before running: " + "; ".join(candidate.fixes))
+            if cost_note:
+                answer.notes.append(cost_note)
+            if answer.notes:
+                answer.response_text += "\n\n" + "\n\n".join(answer.notes) + f"\n\n```sql\n{sql_to_run}\n```"
+            return prompt
+        if candidates and all(c.sql is None and c.error is None for c in candidates):
+            # No candidate wrote SQL (e.g. a clarifying question) => normal chat
+            answer.response_text, answer.source = candidates[0].response_text, "chat"
+            return prompt
+        if not failures:
+            return prompt
+        # Hand the failures to the sequential loop
+        return (
+            f"{prompt}\n\nThese SQL queries were tried and failed:\n"
+            + "\n".join(f"```sql\n{c.sql}\n```\nError:\n```\n{error}\n```" for c, error in failures if c.sql)
+            + "\nPlease provide a corrected SQL query."
+        )
+
+    def _answer_sequentially(self, answer, llm, agent_prompt, prompt_template, user_input,
+                             schema_fingerprint, cost_action, run, emit) -> None:
+        max_attempts = self.settings.max_sql_retries
+        for attempt in range(max_attempts):
+            emit({"type": "generate", "attempt": attempt + 1, "max_attempts": max_attempts})
+            answer.attempts += 1
+            response_text = self._timed(answer, "generate", llm.predict, agent_prompt)
+            extracted = self._timed(answer, "extract", extract_sql, response_text)
+            if not extracted:
+                # No SQL found => normal chat
+                answer.response_text, answer.source = response_text, "chat"
+                return
+            try:
+                # Fix quoting/casing locally; unknown names go straight back to the model
+                validation = self._timed(
+                    answer, "validate", validate_sql, extracted, self.catalog_index(schema_fingerprint)
+                )
+                if not validation.ok:
+                    answer.rejected += 1
+                    raise SQLValidationError("\n".join(validation.errors))
+                if validation.fixes:
+                    answer.fixed += 1
+                    extracted = validation.sql
+                sql_to_run, cost_note = self._timed(answer, "explain", self.check_cost, extracted, cost_action)
+                answer.df = self._timed(answer, "run", run, sql_to_run)
+            except Exception as e:
+                agent_prompt = (
+                    f"here is the original user prompt:\n{response_text}\n"
+                    f"The SQL query caused an error:\n```\n{str(e)}\n```\n"
+                    f"Please provide a corrected SQL query."
+                )
+                emit({"type": "sql_error", "attempt": attempt + 1, "max_attempts": max_attempts,
+                      "error": str(e), "sql": extracted})
+                continue
+            if not cost_note:
+                # An over-budget rewrite (LIMIT / COUNT(*) preview) is not the answer to replay; replays
+                # skip the cost check, so the original query is not stored either
+                self.question_cache.store(prompt_template, schema_fingerprint, user_input, sql_to_run)
+            answer.sql = sql_to_run
+            answer.response_text = f"{response_text}\n\n**SQL Results:**\n\nData retrieved successfully."
+            if validation.fixes:
+                answer.notes.append("🔧 Fixed locally before running: " + "; ".join(validation.fixes))
+            if cost_note:
+                answer.notes.append(cost_note)
+            if answer.notes:
+                answer.response_text += "\n\n" + "\n\n".join(answer.notes) + f"\n\n```sql\n{sql_to_run}\n```"
+            return
+        answer.error = f"❌ Unable to produce a working SQL query after {max_attempts} attempts."
+        answer.response_text = answer.error
+
+    # --------------------------- #
+    #     PLOT
+    # --------------------------- #
+    def plot(self, df: pd.DataFrame, user_input: str, llm=None, sql_query: str = None,
+             run=None, on_event=None) -> PlotAnswer:
+        """
+        Pick a chart spec for df (locally, asking llm only when ambiguous) and,
+        when df was capped or has more points than the chart can show, let
+        Postgres aggregate the series from sql_query. spec is None if no
+        valid chart could be determined.
+        """
+        run = run or self.run_sql
+        emit = on_event or _ignore
+        settings = self.settings
+        answer = PlotAnswer(df=df)
+        spec, confidence = infer_chart_spec(df, user_input)
+        if (spec is None or confidence < settings.chart_confidence_threshold) and llm is not None:
+            emit({"type": "chart_llm"})
+            for attempt in range(settings.max_plot_attempts):
+                llm_spec = validate_chart_spec(
+                    extract_chart_instruction(llm.predict(build_chart_prompt(df, user_input, spec))), df
+                )
+                if llm_spec:
+                    spec, answer.source = llm_spec, "llm"
+                    break
+                emit({"type": "chart_parse_failed", "attempt": attempt + 1})
+        answer.spec = spec
+        if spec is None:
+            return answer
+
+        if (settings.plot_sql_pushdown and sql_query
+                and needs_pushdown(df, spec, settings.plot_max_line_points, settings.plot_max_bars)):
+            pushdown_sql = aggregate_plot_sql(sql_query, spec, df, user_input, settings.plot_max_line_points)
+            if pushdown_sql:
+                try:
+                    answer.df, answer.pushdown_sql = run(pushdown_sql), pushdown_sql
+                except Exception as e:
+                    answer.notes.append(
+                        f"⚠️ Could not aggregate in the database ({e}); plotting the fetched rows."
+                    )
+        return answer
+
+    def prepare_chart(self, df: pd.DataFrame, spec: dict):
+        """(data, spec, note) reduced to the plot point budgets."""
+        settings = self.settings
+        return prepare_plot_data(
+            df, spec,
+            max_line_points=settings.plot_max_line_points,
+            max_scatter_points=settings.plot_max_scatter_points,
+            max_bars=settings.plot_max_bars,
+        )
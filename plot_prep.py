@@ -0,0 +1,245 @@
+"""
+Reduce large results to what a chart can actually show.
+
+  - line:    LTTB (one series) or min/max per bucket (several series)
+  - scatter: 2D binning; each bin becomes one point sized by its row count
+  - bar:     top-N categories, the rest summed into "Other"
+
+prepare_plot_data() returns the reduced frame, the spec to draw it with and
+a note describing the reduction (None if the data was small enough).
+
+When the fetched rows are capped or far more than a chart can show,
+aggregate_plot_sql() instead builds a query that lets Postgres compute the
+plotted series from the previous query.
+"""
+import re
+
+import numpy as np
+import pandas as pd
+
+from sql_utils import quote_identifier, strip_trailing_semicolon
+
+MAX_LINE_POINTS = 2000
+MAX_SCATTER_POINTS = 5000
+MAX_BARS = 30
+OTHER_LABEL = "Other"
+
+
+def _y_columns(spec: dict) -> list:
+    return spec["y"] if isinstance(spec["y"], list) else [spec["y"]]
+
+
+def _numeric_axis(series: pd.Series) -> np.ndarray:
+    """x values as floats (datetimes as nanoseconds, anything else by position)."""
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series.astype("int64").to_numpy(dtype=float)
+    if pd.api.types.is_numeric_dtype(series):
+        return series.to_numpy(dtype=float)
+    return np.arange(len(series), dtype=float)
+
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """Largest-Triangle-Three-Buckets: indices of `threshold` points that keep the line's shape."""
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    previous = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], max(edges[i + 1], edges[i] + 1)
+        next_start, next_end = edges[i + 1], edges[i + 2] if i + 2 < len(edges) else n
+        next_end = max(next_end, next_start + 1)
+        avg_x, avg_y = x[next_start:next_end].mean(), y[next_start:next_end].mean()
+        # Area of the triangle (previous point, candidate, next bucket average)
+        areas = np.abs(
+            (x[previous] - avg_x) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (avg_y - y[previous])
+        )
+        previous = start + int(np.argmax(areas))
+        selected[i + 1] = previous
+    return selected
+
+
+def minmax_indices(values: np.ndarray, buckets: int) -> np.ndarray:
+    """First/last plus min and max of every bucket, for each column of `values`."""
+    n = len(values)
+    keep = {0, n - 1}
+    for bucket in np.array_split(np.arange(n), buckets):
+        if len(bucket) == 0:
+            continue
+        chunk = values[bucket]
+        keep.update(bucket[np.nanargmin(chunk, axis=0)].tolist())
+        keep.update(bucket[np.nanargmax(chunk, axis=0)].tolist())
+    return np.array(sorted(keep))
+
+
+def _prepare_line(df: pd.DataFrame, spec: dict, max_points: int):
+    y_cols = _y_columns(spec)
+    data = df[list(dict.fromkeys([spec["x"], *y_cols]))].dropna(subset=y_cols)
+    data = data.sort_values(spec["x"], kind="stable")
+    if len(data) <= max_points:
+        return data, spec, None
+    y = data[y_cols].to_numpy(dtype=float)
+    if len(y_cols) == 1:
+        indices = lttb_indices(_numeric_axis(data[spec["x"]]), y[:, 0], max_points)
+        method = "LTTB"
+    else:
+        indices = minmax_indices(y, max(1, max_points // (2 * len(y_cols))))
+        method = "min/max per bucket"
+    reduced = data.iloc[indices]
+    return reduced, spec, f"Line downsampled from {len(data):,} to {len(reduced):,} points ({method})."
+
+
+def _prepare_scatter(df: pd.DataFrame, spec: dict, max_points: int):
+    x, y = spec["x"], _y_columns(spec)[0]
+    data = df[list(dict.fromkeys([x, y]))].dropna()
+    if len(data) <= max_points or not (
+        pd.api.types.is_numeric_dtype(data[x]) and pd.api.types.is_numeric_dtype(data[y])
+    ):
+        return data, spec, None
+    bins = max(2, int(np.sqrt(max_points)))
+    x_bins = pd.cut(data[x], bins=bins)
+    y_bins = pd.cut(data[y], bins=bins)
+    grouped = data.groupby([x_bins, y_bins], observed=True)
+    binned = pd.DataFrame({
+        x: grouped[x].mean(),
+        y: grouped[y].mean(),
+        "points": grouped.size(),
+    }).reset_index(drop=True)
+    note = (f"Scatter aggregated from {len(data):,} rows into {len(binned):,} bins "
+            f"({bins}×{bins} grid, point size = rows per bin).")
+    return binned, {**spec, "y": y, "size": "points"}, note
+
+
+def _prepare_bar(df: pd.DataFrame, spec: dict, max_bars: int):
+    x, y_cols = spec["x"], _y_columns(spec)
+    data = df[list(dict.fromkeys([x, *y_cols]))]
+    if data[x].nunique(dropna=False) <= max_bars:
+        return data, spec, None
+    totals = data.groupby(x, dropna=False, sort=False)[y_cols].sum()
+    totals = totals.sort_values(y_cols[0], ascending=False)
+    top, rest = totals.iloc[:max_bars - 1], totals.iloc[max_bars - 1:]
+    other = pd.DataFrame([rest.sum()], index=[OTHER_LABEL])
+    reduced = pd.concat([top, other]).rename_axis(x).reset_index()
+    reduced[x] = reduced[x].astype(str)  # "Other" next to numeric categories
+    note = (f"Showing the top {max_bars - 1} of {len(totals):,} {x} values by {y_cols[0]}; "
+            f"the other {len(rest):,} are summed into \"{OTHER_LABEL}\".")
+    return reduced, spec, note
+
+
+def prepare_plot_data(df: pd.DataFrame, spec: dict, max_line_points: int = MAX_LINE_POINTS,
+                      max_scatter_points: int = MAX_SCATTER_POINTS, max_bars: int = MAX_BARS):
+    """Return (data, spec, note) for drawing spec; see the module docstring."""
+    chart_type = spec["chart_type"]
+    if chart_type == "line":
+        return _prepare_line(df, spec, max_line_points)
+    if chart_type == "scatter":
+        return _prepare_scatter(df, spec, max_scatter_points)
+    return _prepare_bar(df, spec, max_bars)
+
+
+# --------------------------- #
+#      SQL PUSHDOWN
+# --------------------------- #
+# Aggregate the plotted series in Postgres instead of plotting fetched raw rows
+AGGREGATE_WORDS = [
+    ("AVG", re.compile(r"\b(average|avg|mean)\b", re.I)),
+    ("MAX", re.compile(r"\b(max|maximum|highest|peak)\b", re.I)),
+    ("MIN", re.compile(r"\b(min|minimum|lowest)\b", re.I)),
+    ("SUM", re.compile(r"\b(sum|total)\b", re.I)),
+]
+COUNT_WORDS = re.compile(r"\b(count|number of|how many)\b", re.I)
+ADDITIVE_NAME = re.compile(r"(count|total|sum|num|^n$)", re.I)
+AVERAGE_NAME = re.compile(r"(avg|average|mean|rate|pct|percent|ratio|score|grade)", re.I)
+TIME_UNITS = [
+    ("hour", re.compile(r"\b(hourly|per hour|by hour)\b", re.I)),
+    ("day", re.compile(r"\b(daily|per day|by day)\b", re.I)),
+    ("week", re.compile(r"\b(weekly|per week|by week)\b", re.I)),
+    ("month", re.compile(r"\b(monthly|per month|by month)\b", re.I)),
+    ("quarter", re.compile(r"\b(quarterly|per quarter|by quarter)\b", re.I)),
+    ("year", re.compile(r"\b(yearly|annual(ly)?|per year|by year)\b", re.I)),
+]
+
+
+def choose_aggregate(user_input: str, y_column: str) -> str:
+    """
+    Aggregate for y: the one asked for, SUM for columns that already hold
+    counts/totals, COUNT when counting was asked for, AVG for ratio-like
+    columns, else SUM.
+    """
+    for function, pattern in AGGREGATE_WORDS:
+        if pattern.search(user_input):
+            return function
+    if ADDITIVE_NAME.search(str(y_column)):
+        return "SUM"
+    if COUNT_WORDS.search(user_input):
+        return "COUNT"
+    return "AVG" if AVERAGE_NAME.search(str(y_column)) else "SUM"
+
+
+def requested_time_unit(user_input: str):
+    for unit, pattern in TIME_UNITS:
+        if pattern.search(user_input):
+            return unit
+    return None
+
+
+def _is_time_like(series: pd.Series) -> bool:
+    return pd.api.types.is_datetime64_any_dtype(series) or pd.api.types.infer_dtype(
+        series, skipna=True
+    ) in ("date", "datetime")
+
+
+def needs_pushdown(df: pd.DataFrame, spec: dict, max_line_points: int = MAX_LINE_POINTS,
+                   max_bars: int = MAX_BARS) -> bool:
+    """True if the fetched rows are incomplete, or more than the chart can show."""
+    if spec["chart_type"] == "scatter":
+        return False  # binned locally; the point cloud itself is what the user wants
+    if df.attrs.get("truncated_at"):
+        return True
+    limit = max_line_points if spec["chart_type"] == "line" else max_bars
+    return df[spec["x"]].nunique() > limit or (
+        len(df) > limit and df[spec["x"]].duplicated().any()
+    )
+
+
+def aggregate_plot_sql(sql_query: str, spec: dict, df: pd.DataFrame, user_input: str,
+                       max_line_points: int = MAX_LINE_POINTS):
+    """
+    SQL that computes the plotted series from the previous query (used as a
+    CTE): y aggregated per x, per date_trunc(unit, x) when the user asks for
+    daily/monthly/... values, or per equal-width bucket of a time/numeric x on
+    line charts. Column names are kept so the same spec can draw the result.
+    Returns None for charts that cannot be pushed down.
+    """
+    if spec["chart_type"] == "scatter":
+        return None
+    x = spec["x"]
+    y_cols = [c for c in _y_columns(spec) if c != x]
+    if not y_cols or x not in df.columns:
+        return None
+    qx = quote_identifier(x)
+    aggregates = ", ".join(
+        f"{choose_aggregate(user_input, y)}(p.{quote_identifier(y)}) AS {quote_identifier(y)}"
+        for y in y_cols
+    )
+    source = f"WITH plot_source AS (\n{strip_trailing_semicolon(sql_query)}\n)"
+    unit = requested_time_unit(user_input)
+    time_like = _is_time_like(df[x])
+    if unit and time_like:
+        return (f"{source}\nSELECT date_trunc('{unit}', p.{qx}) AS {qx}, {aggregates}\n"
+                f"FROM plot_source p\nGROUP BY 1\nORDER BY 1")
+    if spec["chart_type"] == "line" and (time_like or pd.api.types.is_numeric_dtype(df[x])):
+        value = f"EXTRACT(EPOCH FROM p.{qx})" if time_like else f"p.{qx}"
+        return (
+            f"{source},\nbounds AS (SELECT MIN({value}) AS lo, MAX({value}) AS hi FROM plot_source p)\n"
+            f"SELECT MIN(p.{qx}) AS {qx}, {aggregates}\n"
+            f"FROM plot_source p CROSS JOIN bounds b\n"
+            f"GROUP BY CASE WHEN b.lo = b.hi THEN 1 "
+            f"ELSE width_bucket({value}, b.lo, b.hi, {int(max_line_points)}) END\n"
+            f"ORDER BY 1"
+        )
+    return (f"{source}\nSELECT p.{qx}, {aggregates}\nFROM plot_source p\n"
+            f"GROUP BY 1\nORDER BY 2 DESC")
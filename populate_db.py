@@ -1,28 +1,38 @@
+import argparse
 import os
 import pandas as pd
 from sqlalchemy import create_engine
-from dotenv import load_dotenv
 
-# Load environment variables
-load_dotenv('db_config.env')
+from database import get_conn_str
+from query_cache import mark_tables_reloaded
 
-PG_USER = os.getenv('PG_USER')
-PG_PASSWORD = os.getenv('PG_PASSWORD')
-PG_HOST = os.getenv('PG_HOST')
-PG_PORT = os.getenv('PG_PORT')
-PG_DATABASE = os.getenv('PG_DATABASE')
+CSV_FOLDER = 'table_csvs'
 
-# SQLAlchemy engine connection string
-conn_str = f'postgresql+psycopg2://{PG_USER}:{PG_PASSWORD}@{PG_HOST}:{PG_PORT}/{PG_DATABASE}'
-engine = create_engine(conn_str)
 
-csv_folder = 'table_csvs'
+def get_engine():
+    """Engine for the database configured in db_config.env."""
+    return create_engine(get_conn_str('db_config.env'))
 
-for csv_file in os.listdir(csv_folder):
-    if csv_file.endswith('.csv'):
-        table_name = os.path.splitext(csv_file)[0]
-        df = pd.read_csv(os.path.join(csv_folder, csv_file))
-        df.to_sql(table_name, engine, if_exists='replace', index=False)
-        print(f"Loaded {csv_file} into table '{table_name}'.")
 
-print("Database population complete.")
+def populate_database(engine, csv_folder=CSV_FOLDER, verbose=True):
+    """Load every CSV in csv_folder into a table of the same name (replacing it)."""
+    tables = []
+    for csv_file in sorted(os.listdir(csv_folder)):
+        if csv_file.endswith('.csv'):
+            table_name = os.path.splitext(csv_file)[0]
+            df = pd.read_csv(os.path.join(csv_folder, csv_file))
+            df.to_sql(table_name, engine, if_exists='replace', index=False)
+            # Invalidate cached app results that read this table
+            mark_tables_reloaded([table_name])
+            tables.append(table_name)
+            if verbose:
+                print(f"Loaded {csv_file} into table '{table_name}'.")
+    return tables
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load the CSV files of a folder into Postgres.")
+    parser.add_argument("--csv-folder", default=CSV_FOLDER)
+    args = parser.parse_args()
+    populate_database(get_engine(), args.csv_folder)
+    print("Database population complete.")
@@ -0,0 +1,136 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import pandas as pd
+
+from sql_utils import normalize_sql, identifier_names, is_select_query
+
+# --- Paths ---
+# populate_db.py stamps this file whenever it (re)loads a table, so every
+# process sharing the working directory can drop stale cached results.
+TABLE_VERSIONS_FILE = Path(".cache/table_versions.json")
+
+
+# --------------------------- #
+#   TABLE VERSION STAMPS
+# --------------------------- #
+def load_table_versions() -> dict:
+    """Return {lower-cased table name: reload timestamp} or {} if never stamped."""
+    try:
+        with open(TABLE_VERSIONS_FILE, "r") as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def mark_tables_reloaded(table_names) -> None:
+    """Record that the given tables were just (re)loaded."""
+    versions = load_table_versions()
+    now = time.time()
+    for table_name in table_names:
+        versions[table_name.lower()] = now
+    TABLE_VERSIONS_FILE.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = TABLE_VERSIONS_FILE.with_suffix(".tmp")
+    with open(tmp_path, "w") as file:
+        json.dump(versions, file)
+    os.replace(tmp_path, TABLE_VERSIONS_FILE)
+
+
+# --------------------------- #
+#     RESULT SET CACHE
+# --------------------------- #
+class ResultCache:
+    """
+    Thread-safe LRU cache of query results keyed on normalized SQL.
+
+    Bounded by total DataFrame size (bytes) and entry age (TTL). An entry is
+    also dropped when any table it references has been reloaded since the
+    entry was stored. Only read-only queries are cached.
+    """
+    def __init__(self, max_bytes: int = 256 * 1024 ** 2, ttl_seconds: float = 900):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_bytes // 4
+        self.ttl_seconds = ttl_seconds
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (df, nbytes, stored_at, identifiers)
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._versions_mtime = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, sql_query: str) -> bool:
+        """True if a fresh entry exists; does not touch hit/miss counters or LRU order."""
+        with self._lock:
+            entry = self._entries.get(normalize_sql(sql_query))
+            return entry is not None and not self._is_stale(entry[2], entry[3])
+
+    def _table_versions(self) -> dict:
+        """Reload the version stamps only when the file changed on disk."""
+        try:
+            mtime = TABLE_VERSIONS_FILE.stat().st_mtime
+        except FileNotFoundError:
+            mtime = None
+        if mtime != self._versions_mtime:
+            self._versions = load_table_versions()
+            self._versions_mtime = mtime
+        return self._versions
+
+    def _is_stale(self, stored_at: float, identifiers: set) -> bool:
+        if time.time() - stored_at > self.ttl_seconds:
+            return True
+        versions = self._table_versions()
+        return any(
+            reloaded_at > stored_at
+            for table_name, reloaded_at in versions.items()
+            if table_name in identifiers
+        )
+
+    def _evict(self, key) -> None:
+        _, nbytes, _, _ = self._entries.pop(key)
+        self.total_bytes -= nbytes
+
+    def get(self, sql_query: str):
+        """Return a copy of the cached DataFrame, or None on a miss."""
+        key = normalize_sql(sql_query)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            df, _, stored_at, identifiers = entry
+            if self._is_stale(stored_at, identifiers):
+                self._evict(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return df.copy()
+
+    def put(self, sql_query: str, df: pd.DataFrame) -> None:
+        """Store a result; oversized results and write statements are skipped."""
+        if not is_select_query(sql_query):
+            return
+        nbytes = int(df.memory_usage(deep=True).sum())
+        if nbytes > self.max_entry_bytes:
+            return
+        key = normalize_sql(sql_query)
+        with self._lock:
+            if key in self._entries:
+                self._evict(key)
+            self._entries[key] = (df, nbytes, time.time(), identifier_names(sql_query))
+            self.total_bytes += nbytes
+            while self.total_bytes > self.max_bytes:
+                self._evict(next(iter(self._entries)))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
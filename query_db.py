@@ -1,32 +1,247 @@
+"""
+Run SQL against the database in db_config.env, and record / replay the SQL
+workload of the app.
+
+The pipeline appends every query it executes to logs/sql_workload.jsonl
+(SQL_WORKLOAD_LOG, empty to disable) with its duration, row count and shape
+(sql_utils.fingerprint_sql: literals replaced by ?). Replaying that log with
+N concurrent clients reports throughput and p50 / p99 latency per query
+shape, next to the latency recorded in production, e.g. to check an index
+or config change against real analyst traffic before rolling it out:
+
+    python query_db.py 'SELECT * FROM "Enrollments" LIMIT 5;'
+    python query_db.py --replay logs/sql_workload.jsonl --clients 8 --repeat 3 --out runs/replay.json
+
+Replayed queries run like the app's: read-only transaction, statement
+timeout, server-side cursor capped at QUERY_MAX_ROWS. With --prepared, hot
+query shapes run as prepared statements like in the app (database.PlanCache);
+compare against a run without it to see the planning time saved.
+"""
+import argparse
+import json
 import os
+import queue
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+
 import pandas as pd
 from sqlalchemy import create_engine, text
-from dotenv import load_dotenv
 
-# Load environment variables
-load_dotenv('db_config.env')
+from database import PlanCache, get_conn_str, stream_query
+from stats_utils import percentile
+from sql_utils import fingerprint_sql, shape_id
 
-PG_USER = os.getenv('PG_USER')
-PG_PASSWORD = os.getenv('PG_PASSWORD')
-PG_HOST = os.getenv('PG_HOST')
-PG_PORT = os.getenv('PG_PORT')
-PG_DATABASE = os.getenv('PG_DATABASE')
+WORKLOAD_LOG_FILE = "logs/sql_workload.jsonl"
 
-# Connect to database
-conn_str = f'postgresql+psycopg2://{PG_USER}:{PG_PASSWORD}@{PG_HOST}:{PG_PORT}/{PG_DATABASE}'
-engine = create_engine(conn_str)
+_engine = None
 
-# Example query execution function
-def run_query(sql_query):
-    with engine.connect() as conn:
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        _engine = create_engine(get_conn_str("db_config.env"))
+    return _engine
+
+
+def run_query(sql_query, engine=None):
+    with (engine or get_engine()).connect() as conn:
         result = pd.read_sql(text(sql_query), conn)
     return result
 
-# Example usage:
+
+# --------------------------- #
+#     RECORD
+# --------------------------- #
+class WorkloadLog:
+    """Appends executed queries to a JSONL file (path None = disabled); safe to share between threads."""
+    def __init__(self, path=WORKLOAD_LOG_FILE):
+        self.path = Path(path) if path else None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "WorkloadLog":
+        return cls(os.getenv("SQL_WORKLOAD_LOG", WORKLOAD_LOG_FILE))
+
+    def record(self, sql_query: str, seconds: float, rows: int = None, truncated: bool = False,
+               error: str = None) -> None:
+        if self.path is None:
+            return
+        record = {
+            "ts": round(time.time(), 3),
+            "shape": shape_id(sql_query),
+            "sql": sql_query,
+            "seconds": round(seconds, 4),
+            "rows": rows,
+            "truncated": truncated,
+            "error": error[:500] if error else None,
+        }
+        try:
+            with self._lock:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                with open(self.path, "a", encoding="utf-8") as file:
+                    file.write(json.dumps(record) + "\n")
+        except OSError:
+            pass  # the workload log must never fail a query
+
+
+def load_workload(path: Path, limit: int = None, include_failed: bool = False) -> list:
+    """Recorded queries in log order (failed ones only if include_failed)."""
+    records = []
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record.get("error") and not include_failed:
+                continue
+            records.append(record)
+            if limit and len(records) >= limit:
+                break
+    return records
+
+
+# --------------------------- #
+#     REPLAY
+# --------------------------- #
+def replay(engine, records: list, clients: int = 4, repeat: int = 1, timeout_ms: int = 60_000,
+           max_rows: int = 100_000, plan_cache: PlanCache = None) -> tuple:
+    """
+    Run the recorded queries `repeat` times on `clients` threads (each takes
+    the next query as soon as it is free), through prepared statements for
+    hot shapes if a plan_cache is given. Returns ([{"sql", "seconds",
+    "rows", "error"}, ...], wall seconds).
+    """
+    jobs = queue.Queue()
+    for _ in range(repeat):
+        for record in records:
+            jobs.put(record["sql"])
+    results = []
+    results_lock = threading.Lock()
+
+    def client():
+        while True:
+            try:
+                sql_query = jobs.get_nowait()
+            except queue.Empty:
+                return
+            started = time.time()
+            result = {"sql": sql_query, "rows": None, "error": None}
+            try:
+                result["rows"] = len(stream_query(engine, sql_query, max_rows=max_rows, timeout_ms=timeout_ms,
+                                                  plan_cache=plan_cache))
+            except Exception as e:
+                result["error"] = str(e).splitlines()[0][:200]
+            result["seconds"] = time.time() - started
+            with results_lock:
+                results.append(result)
+
+    started = time.time()
+    threads = [threading.Thread(target=client, name=f"replay-{i}") for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.time() - started
+
+
+def shape_report(results: list, recorded: list = None) -> list:
+    """Per query shape: runs, errors, p50 / p99 / mean ms (and the recorded p50), slowest total first."""
+    by_shape = defaultdict(list)
+    for result in results:
+        by_shape[fingerprint_sql(result["sql"])].append(result)
+    recorded_seconds = defaultdict(list)
+    for record in recorded or []:
+        recorded_seconds[fingerprint_sql(record["sql"])].append(record["seconds"])
+
+    report = []
+    for fingerprint, runs in by_shape.items():
+        seconds = [r["seconds"] for r in runs if not r["error"]]
+        row = {
+            "shape": shape_id(runs[0]["sql"]),
+            "fingerprint": fingerprint,
+            "runs": len(runs),
+            "errors": sum(1 for r in runs if r["error"]),
+            "p50_ms": round(percentile(seconds, 50) * 1000, 2) if seconds else None,
+            "p99_ms": round(percentile(seconds, 99) * 1000, 2) if seconds else None,
+            "mean_ms": round(sum(seconds) / len(seconds) * 1000, 2) if seconds else None,
+            "total_s": round(sum(r["seconds"] for r in runs), 3),
+        }
+        if recorded_seconds.get(fingerprint):
+            row["recorded_p50_ms"] = round(percentile(recorded_seconds[fingerprint], 50) * 1000, 2)
+        report.append(row)
+    return sorted(report, key=lambda r: r["total_s"], reverse=True)
+
+
+def _ms(value) -> str:
+    return f"{value:>10.1f}" if value is not None else f"{'-':>10}"
+
+
+def print_report(report: list, results: list, wall: float, clients: int) -> None:
+    seconds = [r["seconds"] for r in results if not r["error"]] or [0.0]
+    errors = sum(1 for r in results if r["error"])
+    print(f"queries:     {len(results)} on {clients} clients in {wall:.1f} s "
+          f"({len(results) / wall if wall else 0:.1f} queries/s), {errors} errors")
+    print(f"latency:     p50 {percentile(seconds, 50) * 1000:.1f} ms, p99 {percentile(seconds, 99) * 1000:.1f} ms")
+    print()
+    print(f"{'shape':<14}{'runs':>6}{'errors':>8}{'p50 ms':>10}{'p99 ms':>10}{'recorded':>10}  query")
+    for row in report:
+        print(f"{row['shape']:<14}{row['runs']:>6}{row['errors']:>8}{_ms(row['p50_ms'])}{_ms(row['p99_ms'])}"
+              f"{_ms(row.get('recorded_p50_ms'))}  {row['fingerprint'][:80]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a query, or replay the recorded SQL workload.")
+    parser.add_argument("sql", nargs="?", default='SELECT * FROM "Enrollments" LIMIT 5;')
+    parser.add_argument("--replay", metavar="WORKLOAD", help=f"Workload log to replay (e.g. {WORKLOAD_LOG_FILE})")
+    parser.add_argument("--clients", type=int, default=4, help="Concurrent connections")
+    parser.add_argument("--repeat", type=int, default=1, help="Passes over the workload")
+    parser.add_argument("--limit", type=int, default=None, help="Only the first N recorded queries")
+    parser.add_argument("--include-failed", action="store_true", help="Also replay queries that failed")
+    parser.add_argument("--timeout-seconds", type=float, default=float(os.getenv("QUERY_TIMEOUT_SECONDS", "60")))
+    parser.add_argument("--max-rows", type=int, default=int(os.getenv("QUERY_MAX_ROWS", "100000")))
+    parser.add_argument("--prepared", action="store_true",
+                        help="Run hot query shapes as prepared statements (PREPARE_* settings)")
+    parser.add_argument("--out", default=None, help="Write the per-shape report as JSON")
+    args = parser.parse_args()
+
+    if not args.replay:
+        print(run_query(args.sql))
+        return
+
+    records = load_workload(Path(args.replay), args.limit, args.include_failed)
+    if not records:
+        print(f"No queries to replay in {args.replay}.")
+        return
+    # One pooled connection per client
+    engine = create_engine(get_conn_str("db_config.env"), pool_size=args.clients, max_overflow=0)
+    plan_cache = (PlanCache.from_env() or PlanCache()) if args.prepared else None
+    results, wall = replay(engine, records, args.clients, args.repeat,
+                           int(args.timeout_seconds * 1000), args.max_rows, plan_cache)
+    report = shape_report(results, records)
+    print_report(report, results, wall, args.clients)
+    if plan_cache is not None:
+        plan_stats = plan_cache.stats(top=0)
+        print(f"\nprepared:    {plan_stats['prepared_executions']} of {plan_stats['executions']} queries "
+              f"({plan_stats['shapes']} parameterized shapes, {plan_stats['rejected_shapes']} not preparable)")
+    if args.out:
+        Path(args.out).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.out, "w", encoding="utf-8") as file:
+            json.dump({
+                "workload": args.replay,
+                "clients": args.clients,
+                "queries": len(results),
+                "errors": sum(1 for r in results if r["error"]),
+                "wall_seconds": round(wall, 3),
+                "queries_per_second": round(len(results) / wall, 2) if wall else None,
+                "prepared": plan_cache.stats(top=0) if plan_cache is not None else None,
+                "shapes": report,
+            }, file, indent=2)
+
+
 if __name__ == "__main__":
-    query = 'SELECT * FROM "Enrollments" LIMIT 5;'
-    df_result = run_query(query)
-    print(df_result)
+    main()
 
 # import os
 # import pandas as pd
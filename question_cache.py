@@ -0,0 +1,203 @@
+import difflib
+from contextlib import contextmanager
+from functools import lru_cache
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from pathlib import Path
+
+from sql_validator import catalog_from_prompt
+
+# --- Paths ---
+QUESTION_CACHE_FILE = Path(".cache/question_sql.sqlite")
+
+# Words that do not change which data a question asks for
+STOPWORDS = {
+    "a", "an", "the", "of", "for", "in", "on", "to", "and", "is", "are", "was",
+    "were", "be", "me", "my", "i", "we", "us", "our", "you", "your", "please",
+    "can", "could", "would", "will", "show", "give", "get", "list", "tell",
+    "display", "return", "find", "what", "which", "there", "do", "does", "with",
+    "all", "that", "this", "it", "by", "from", "at", "as", "pull", "fetch",
+}
+# Words that flip or rank what a question asks for; they must match exactly
+ANCHOR_WORDS = {
+    "not", "no", "without", "never", "except", "excluding", "non", "none", "only",
+    "highest", "lowest", "most", "least", "max", "maximum", "min", "minimum", "top", "bottom",
+    "more", "less", "fewer", "greater", "larger", "smaller", "above", "below", "over", "under",
+    "before", "after", "earliest", "latest", "oldest", "newest", "first", "last",
+    "ascending", "descending", "increase", "decrease",
+}
+
+
+# --------------------------- #
+#   QUESTION NORMALIZATION
+# --------------------------- #
+def normalize_question(question: str) -> str:
+    """Lower-case, strip accents/punctuation and collapse whitespace."""
+    question = unicodedata.normalize("NFKD", question)
+    question = question.encode("ascii", "ignore").decode("ascii").lower()
+    question = re.sub(r"[^a-z0-9%.\-]+", " ", question)
+    question = re.sub(r"(?<![0-9])[.\-]|[.\-](?![0-9])", " ", question)
+    return " ".join(question.split())
+
+
+def _stem(word: str) -> str:
+    """Very light plural stemming (students -> student, classes -> class)."""
+    if len(word) > 4 and word.endswith("es") and word[-3] in "sxz":
+        return word[:-2]
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+def fuzzy_question_key(question: str) -> str:
+    """Content words in question order, used by the fuzzy matching mode."""
+    words = [_stem(w) for w in normalize_question(question).split() if w not in STOPWORDS]
+    return " ".join(words)
+
+
+@lru_cache(maxsize=8)
+def schema_words(prompt_template: str) -> frozenset:
+    """Stemmed words of the table and column names in the prompt template's schema sections."""
+    names = []
+    for table, columns in catalog_from_prompt(prompt_template).items():
+        names.append(table)
+        names.extend(column["name"] for column in columns)
+    return frozenset(_stem(w) for name in names for w in normalize_question(name.replace("_", " ")).split())
+
+
+def _anchor_tokens(fuzzy_key: str, names: frozenset = frozenset()) -> list:
+    """
+    Words that must match exactly and in the same order: numbers and
+    two-letter codes (years, state codes, grade levels), negations and
+    comparatives (ANCHOR_WORDS), and words of table / column names.
+    "students per state" and "states per student" differ in their anchors.
+    """
+    return [
+        w for w in fuzzy_key.split()
+        if len(w) == 2 or any(c.isdigit() for c in w) or w in ANCHOR_WORDS or w in names
+    ]
+
+
+def template_hash(prompt_template: str) -> str:
+    return hashlib.sha256(prompt_template.encode("utf-8")).hexdigest()[:16]
+
+
+# --------------------------- #
+#   QUESTION -> SQL CACHE
+# --------------------------- #
+class QuestionCache:
+    """
+    Persistent (SQLite) map from a user question to the last SQL that ran
+    successfully for it, keyed on (prompt template hash, schema fingerprint,
+    normalized question).
+
+    Matching modes:
+      - "normalized": case/punctuation/whitespace-insensitive exact match
+      - "fuzzy":      also matches re-worded questions, provided their anchors
+                      (numbers, short codes, negations, comparatives and schema
+                      words) are identical and in the same order
+    """
+    def __init__(self, path: Path = QUESTION_CACHE_FILE, fuzzy_threshold: float = 0.9):
+        self.path = Path(path)
+        self.fuzzy_threshold = fuzzy_threshold
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS question_sql (
+                    template_hash TEXT NOT NULL,
+                    schema_fingerprint TEXT NOT NULL,
+                    question_key TEXT NOT NULL,
+                    fuzzy_key TEXT NOT NULL,
+                    question TEXT NOT NULL,
+                    sql TEXT NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (template_hash, schema_fingerprint, question_key)
+                )
+                """
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def lookup(self, prompt_template: str, schema_fingerprint: str, question: str,
+               mode: str = "normalized"):
+        """Return the cached SQL for this question, or None on a miss."""
+        t_hash = template_hash(prompt_template)
+        question_key = normalize_question(question)
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT question_key, sql FROM question_sql "
+                "WHERE template_hash = ? AND schema_fingerprint = ? AND question_key = ?",
+                (t_hash, schema_fingerprint, question_key),
+            ).fetchone()
+            if row is None and mode == "fuzzy":
+                row = self._fuzzy_lookup(conn, t_hash, schema_fingerprint, question,
+                                         schema_words(prompt_template))
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute(
+                "UPDATE question_sql SET hits = hits + 1 "
+                "WHERE template_hash = ? AND schema_fingerprint = ? AND question_key = ?",
+                (t_hash, schema_fingerprint, row[0]),
+            )
+            self.hits += 1
+            return row[1]
+
+    def _fuzzy_lookup(self, conn, t_hash: str, schema_fingerprint: str, question: str, names: frozenset):
+        target = fuzzy_question_key(question)
+        anchors = _anchor_tokens(target, names)
+        best_row, best_ratio = None, self.fuzzy_threshold
+        candidates = conn.execute(
+            "SELECT question_key, sql, fuzzy_key FROM question_sql "
+            "WHERE template_hash = ? AND schema_fingerprint = ? "
+            "ORDER BY updated_at DESC",
+            (t_hash, schema_fingerprint),
+        )
+        for question_key, sql, fuzzy_key in candidates:
+            if fuzzy_key == target:
+                return question_key, sql
+            if _anchor_tokens(fuzzy_key, names) != anchors:
+                continue
+            ratio = difflib.SequenceMatcher(None, target, fuzzy_key).ratio()
+            if ratio >= best_ratio:
+                best_row, best_ratio = (question_key, sql), ratio
+        return best_row
+
+    def store(self, prompt_template: str, schema_fingerprint: str, question: str, sql: str) -> None:
+        """Remember the SQL that was last executed successfully for this question."""
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                """
+                INSERT INTO question_sql
+                    (template_hash, schema_fingerprint, question_key, fuzzy_key, question, sql, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (template_hash, schema_fingerprint, question_key)
+                DO UPDATE SET sql = excluded.sql, question = excluded.question,
+                              updated_at = excluded.updated_at
+                """,
+                (
+                    template_hash(prompt_template),
+                    schema_fingerprint,
+                    normalize_question(question),
+                    fuzzy_question_key(question),
+                    question,
+                    sql,
+                    time.time(),
+                ),
+            )
@@ -0,0 +1,302 @@
+"""
+Local fast-path classifier for chat requests (SQL / PLOT / CHAT).
+
+Keyword/regex rules answer the obvious cases; a small TF-IDF + logistic
+regression model handles the rest. scikit-learn is only needed to train the
+model: it is exported to a plain-Python linear scorer (saved as JSON), so
+inference takes microseconds. The app only escalates to the LLM classifier when the local
+confidence is below a threshold.
+
+Train the model from the labeled samples plus turns logged by the app:
+    python request_classifier.py train
+"""
+import argparse
+import json
+import logging
+import math
+import re
+import time
+from pathlib import Path
+
+try:
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.pipeline import make_pipeline
+except ImportError:  # training unavailable; a saved model still loads
+    make_pipeline = None
+
+logger = logging.getLogger(__name__)
+
+# --- Paths ---
+MODEL_FILE = Path(".cache/request_classifier.json")
+TURN_LOG_FILE = Path("logs/classified_turns.jsonl")
+TRAIN_SAMPLES_FILE = Path("benchmarks/classifier_train.jsonl")
+
+LABELS = ("SQL", "PLOT", "CHAT")
+
+# (label, pattern, confidence) -- the first matching rule wins
+RULES = [
+    ("SQL", re.compile(r"```sql|^\s*(select|with)\b[\s\S]+\bfrom\b", re.IGNORECASE), 0.99),
+    ("PLOT", re.compile(
+        r"\b(plot|chart|graph|visuali[sz]e|histogram|scatter\s*plot|bar\s*chart|line\s*chart|pie)\b",
+        re.IGNORECASE), 0.95),
+    ("CHAT", re.compile(
+        r"^\s*(hi|hello|hey|thanks|thank you|thx|ok(ay)?|great|cool|nice|good (morning|afternoon))\b[\s!.,]*$",
+        re.IGNORECASE), 0.95),
+    ("SQL", re.compile(
+        r"\b(how many|number of|count|average|avg|mean|median|total|sum of|percentage|"
+        r"top \d+|list (all|the)|show me|pull|fetch|query|per (state|year|grade|school|student)|"
+        r"group(ed)? by|broken down by|students? (who|that|with|in)|run (this|the) (sql|query))\b",
+        re.IGNORECASE), 0.85),
+    ("CHAT", re.compile(
+        r"\b(what (does|is) (a |an |the )?(column|table|field|code)|explain|why|meaning of|"
+        r"what can you do|who are you|help me understand)\b",
+        re.IGNORECASE), 0.8),
+]
+
+
+def classify_with_rules(user_input: str):
+    """Return (label, confidence) from the first matching rule, or (None, 0.0)."""
+    for label, pattern, confidence in RULES:
+        if pattern.search(user_input):
+            return label, confidence
+    return None, 0.0
+
+
+# --------------------------- #
+#    LOCAL CLASSIFIER
+# --------------------------- #
+class LinearTextModel:
+    """
+    Plain-Python copy of a fitted TF-IDF + logistic regression pipeline.
+    Avoids the per-call overhead of scikit-learn (and the dependency) at inference time.
+    """
+    def __init__(self, classes, intercepts, weights, ngram_range, token_pattern, sublinear_tf):
+        self.classes = list(classes)
+        self.intercepts = list(intercepts)
+        self.weights = weights  # term -> (idf, per-class coefficients)
+        self.ngram_range = ngram_range
+        self.token_pattern = re.compile(token_pattern)
+        self.sublinear_tf = sublinear_tf
+
+    @classmethod
+    def from_pipeline(cls, pipeline) -> "LinearTextModel":
+        vectorizer, regression = pipeline[0], pipeline[-1]
+        coef = regression.coef_
+        weights = {
+            term: (float(vectorizer.idf_[index]), tuple(float(c) for c in coef[:, index]))
+            for term, index in vectorizer.vocabulary_.items()
+        }
+        return cls(
+            regression.classes_,
+            (float(b) for b in regression.intercept_),
+            weights,
+            vectorizer.ngram_range,
+            vectorizer.token_pattern,
+            vectorizer.sublinear_tf,
+        )
+
+    def to_dict(self) -> dict:
+        """Plain JSON form (no pickled classes, so any process can load it)."""
+        return {
+            "classes": self.classes,
+            "intercepts": self.intercepts,
+            "weights": {term: [idf, list(coef)] for term, (idf, coef) in self.weights.items()},
+            "ngram_range": list(self.ngram_range),
+            "token_pattern": self.token_pattern.pattern,
+            "sublinear_tf": self.sublinear_tf,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "LinearTextModel":
+        return cls(
+            data["classes"],
+            data["intercepts"],
+            {term: (float(idf), tuple(coef)) for term, (idf, coef) in data["weights"].items()},
+            tuple(data["ngram_range"]),
+            data["token_pattern"],
+            data["sublinear_tf"],
+        )
+
+    def save(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(self.to_dict(), file)
+
+    @classmethod
+    def load(cls, path: Path) -> "LinearTextModel":
+        with open(path, "r", encoding="utf-8") as file:
+            return cls.from_dict(json.load(file))
+
+    def _term_counts(self, text: str) -> dict:
+        tokens = self.token_pattern.findall(text.lower())
+        counts = {}
+        low, high = self.ngram_range
+        for n in range(low, high + 1):
+            for i in range(len(tokens) - n + 1):
+                term = " ".join(tokens[i:i + n])
+                if term in self.weights:
+                    counts[term] = counts.get(term, 0) + 1
+        return counts
+
+    def predict_proba(self, text: str) -> list:
+        """Class probabilities, in the order of self.classes."""
+        features = {}
+        for term, count in self._term_counts(text).items():
+            tf = 1 + math.log(count) if self.sublinear_tf else count
+            features[term] = tf * self.weights[term][0]
+        norm = math.sqrt(sum(v * v for v in features.values())) or 1.0
+        scores = list(self.intercepts)
+        for term, value in features.items():
+            for k, c in enumerate(self.weights[term][1]):
+                scores[k] += c * value / norm
+        if len(self.classes) == 2:
+            # Binary logistic regression has a single decision function
+            scores = [0.0, scores[0]]
+        top = max(scores)
+        exps = [math.exp(s - top) for s in scores]
+        total = sum(exps)
+        return [e / total for e in exps]
+
+
+class LocalClassifier:
+    """Rules first, then the trained model (if any)."""
+    def __init__(self, model=None):
+        self.model = model
+
+    @classmethod
+    def load(cls, path: Path = MODEL_FILE) -> "LocalClassifier":
+        """Load the trained model if present; fall back to rules only."""
+        try:
+            return cls(LinearTextModel.load(Path(path)))
+        except FileNotFoundError:
+            return cls()
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning("Request classifier model %s could not be loaded (%s); using rules only. "
+                           "Retrain it with `python request_classifier.py train`.", path, e)
+            return cls()
+
+    def classify(self, user_input: str):
+        """
+        Return (label, confidence). label is None when nothing matched and
+        no model is available.
+        """
+        label, confidence = classify_with_rules(user_input)
+        if self.model is None or confidence >= 0.9:
+            return label, confidence
+        probabilities = self.model.predict_proba(user_input)
+        best = max(range(len(probabilities)), key=probabilities.__getitem__)
+        model_label, model_confidence = self.model.classes[best], probabilities[best]
+        if label is None or (model_label != label and model_confidence > confidence):
+            return model_label, model_confidence
+        if model_label == label:
+            # Rules and model agree => more confident than either alone
+            return label, 1 - (1 - confidence) * (1 - model_confidence)
+        return label, confidence
+
+
+def build_classification_prompt(user_input: str, chat_history: str) -> str:
+    """Prompt used when the local classifier is not confident enough."""
+    return f"""
+You are a text classifier that must categorize the user's request as one of these three categories only:
+1) SQL  - The user wants a new SQL query or fresh data from the DB or has SQL query they want to run.
+2) PLOT - The user wants to plot or visualize the last known data.
+3) CHAT - The user is simply chatting or clarifying, with no need for SQL or plotting.
+
+Chat history summary:
+{chat_history}
+
+User's request:
+{user_input}
+
+Return ONLY one word, either 'SQL', 'PLOT', or 'CHAT'.
+"""
+
+
+def parse_llm_label(result: str) -> str:
+    result = result.strip().upper()
+    if "SQL" in result:
+        return "SQL"
+    elif "PLOT" in result:
+        return "PLOT"
+    else:
+        return "CHAT"
+
+
+def log_turn(user_input: str, label: str, source: str, confidence: float,
+             path: Path = TURN_LOG_FILE) -> None:
+    """Append a classified turn; LLM-labeled turns become training data."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    record = {
+        "text": user_input,
+        "label": label,
+        "source": source,
+        "confidence": round(confidence, 4),
+        "ts": time.time(),
+    }
+    with open(path, "a", encoding="utf-8") as file:
+        file.write(json.dumps(record) + "\n")
+
+
+# --------------------------- #
+#         TRAINING
+# --------------------------- #
+def load_labeled(path: Path, sources=None) -> list:
+    """Read (text, label) pairs from a JSONL file, optionally filtered by source."""
+    samples = []
+    if not Path(path).exists():
+        return samples
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if sources and record.get("source") not in sources:
+                continue
+            if record.get("label") in LABELS:
+                samples.append((record["text"], record["label"]))
+    return samples
+
+
+def train_model(samples: list) -> LinearTextModel:
+    """Fit a TF-IDF + logistic regression pipeline on (text, label) pairs."""
+    if make_pipeline is None:
+        raise RuntimeError("scikit-learn is required to train the request classifier.")
+    texts, labels = zip(*samples)
+    model = make_pipeline(
+        TfidfVectorizer(ngram_range=(1, 2), sublinear_tf=True, min_df=1),
+        LogisticRegression(C=10.0, max_iter=1000, class_weight="balanced"),
+    )
+    model.fit(texts, labels)
+    return LinearTextModel.from_pipeline(model)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train the local request classifier.")
+    parser.add_argument("command", choices=["train"])
+    parser.add_argument("--samples", default=str(TRAIN_SAMPLES_FILE),
+                        help="JSONL file of labeled sample questions")
+    parser.add_argument("--turns", default=str(TURN_LOG_FILE),
+                        help="JSONL log of turns classified by the app")
+    parser.add_argument("--output", default=str(MODEL_FILE))
+    args = parser.parse_args()
+
+    # Only turns labeled by the LLM are trusted; local labels would just reinforce themselves
+    samples = load_labeled(args.samples) + load_labeled(args.turns, sources={"llm"})
+    if len(set(label for _, label in samples)) < 2:
+        parser.error("Need labeled samples for at least two classes to train.")
+    model = train_model(samples)
+
+    output = Path(args.output)
+    model.save(output)
+    # Round trip: the saved file must load and score exactly like the trained model
+    loaded = LocalClassifier.load(output).model
+    if loaded is None or any(
+        loaded.predict_proba(text) != model.predict_proba(text) for text, _ in samples
+    ):
+        raise SystemExit(f"Model saved to {output} does not load back identically.")
+    print(f"Trained on {len(samples)} samples. Model saved to {output}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Per-session spill-to-disk storage for query results.
+
+Chat messages only keep a small preview and a result id; the full DataFrame
+is written to `.cache/results/<session id>/<result id>.parquet` and read back
+lazily (through a small in-memory LRU) when a later turn needs it, e.g. to
+plot the last result or to re-render an older one.
+"""
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+
+import pandas as pd
+
+# --- Paths ---
+RESULTS_DIR = Path(".cache/results")
+
+PREVIEW_ROWS = 50
+
+
+def purge_stale_sessions(root: Path = RESULTS_DIR, max_age_seconds: float = 24 * 3600) -> int:
+    """Delete result directories of sessions idle for longer than max_age_seconds."""
+    removed = 0
+    if not root.exists():
+        return removed
+    cutoff = time.time() - max_age_seconds
+    for session_dir in root.iterdir():
+        if session_dir.is_dir() and session_dir.stat().st_mtime < cutoff:
+            shutil.rmtree(session_dir, ignore_errors=True)
+            removed += 1
+    return removed
+
+
+class ResultStore:
+    """
+    Results of one chat session, on disk with an LRU byte budget.
+
+    max_disk_bytes bounds the session directory (oldest results are deleted
+    first); max_memory_bytes bounds the recently used frames kept in RAM.
+    """
+    def __init__(self, session_id: str, root: Path = RESULTS_DIR,
+                 max_disk_bytes: int = 512 * 1024 ** 2, max_memory_bytes: int = 64 * 1024 ** 2):
+        self.directory = Path(root) / session_id
+        self.max_disk_bytes = max_disk_bytes
+        self.max_memory_bytes = max_memory_bytes
+        self._files = OrderedDict()  # result id -> (path, size on disk)
+        self._memory = OrderedDict()  # result id -> (df, nbytes)
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def disk_bytes(self) -> int:
+        return sum(size for _, size in self._files.values())
+
+    def __len__(self):
+        return len(self._files)
+
+    def __contains__(self, result_id: str) -> bool:
+        return result_id in self._files
+
+    def put(self, df: pd.DataFrame) -> str:
+        """Spill df to disk and return its result id."""
+        result_id = uuid.uuid4().hex
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / f"{result_id}.parquet"
+        try:
+            df.to_parquet(path, index=False)
+        except Exception:
+            # pyarrow missing or a column it cannot encode (mixed object types)
+            path = path.with_suffix(".pkl")
+            df.to_pickle(path)
+        with self._lock:
+            self._files[result_id] = (path, path.stat().st_size)
+            while len(self._files) > 1 and self.disk_bytes > self.max_disk_bytes:
+                _, (old_path, _) = self._files.popitem(last=False)
+                old_path.unlink(missing_ok=True)
+            self._remember(result_id, df)
+        os.utime(self.directory)  # keeps purge_stale_sessions away from active sessions
+        return result_id
+
+    def get(self, result_id: str):
+        """The full DataFrame, or None if it was evicted/never stored."""
+        with self._lock:
+            if result_id in self._memory:
+                self._memory.move_to_end(result_id)
+                return self._memory[result_id][0]
+            entry = self._files.get(result_id)
+            if entry is None:
+                return None
+            self._files.move_to_end(result_id)
+        path = entry[0]
+        try:
+            if path.suffix == ".parquet":
+                df = pd.read_parquet(path, memory_map=True)
+            else:
+                df = pd.read_pickle(path)
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            self._remember(result_id, df)
+        return df
+
+    def _remember(self, result_id: str, df: pd.DataFrame) -> None:
+        nbytes = int(df.memory_usage(deep=True).sum())
+        if nbytes > self.max_memory_bytes:
+            return
+        self._memory[result_id] = (df, nbytes)
+        self._memory_bytes += nbytes
+        while self._memory_bytes > self.max_memory_bytes:
+            _, (_, evicted) = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted
+
+    def clear(self) -> None:
+        """Drop every result of the session (memory and disk)."""
+        with self._lock:
+            self._files.clear()
+            self._memory.clear()
+            self._memory_bytes = 0
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def result_metadata(result_id: str, df: pd.DataFrame) -> dict:
+    """What a chat message keeps about a result: an id, a preview and its shape."""
+    return {
+        "result_id": result_id,
+        "df_preview": df.head(PREVIEW_ROWS),
+        "rows": len(df),
+        "truncated_at": df.attrs.get("truncated_at"),
+    }
@@ -0,0 +1,118 @@
+"""
+Compact, token-bounded descriptions of query results for conversation memory.
+
+The SQL branch used to store the pandas repr of each result in
+ConversationSummaryBufferMemory, which fills the buffer quickly and forces
+extra summarization calls. summarize_result() keeps what a follow-up
+question needs -- shape, columns and types, a few statistics and sample
+rows -- within a fixed token budget.
+"""
+from collections import deque
+
+import pandas as pd
+
+from schema_retrieval import count_tokens
+
+SUMMARY_TOKEN_BUDGET = 250
+MAX_CELL_CHARS = 40
+
+
+def _cell(value) -> str:
+    text = "NULL" if pd.isna(value) else str(value)
+    return text if len(text) <= MAX_CELL_CHARS else text[:MAX_CELL_CHARS - 1] + "…"
+
+
+def _column_stats(series: pd.Series) -> str:
+    """One short line of statistics, depending on the column type."""
+    non_null = series.dropna()
+    nulls = len(series) - len(non_null)
+    parts = []
+    if non_null.empty:
+        parts.append("all NULL")
+    elif pd.api.types.is_bool_dtype(series):
+        parts.append(f"{int(non_null.sum())} true")
+    elif pd.api.types.is_numeric_dtype(series):
+        parts.append(f"min {non_null.min():g}, max {non_null.max():g}, mean {non_null.mean():g}")
+    elif pd.api.types.is_datetime64_any_dtype(series):
+        parts.append(f"{non_null.min()} to {non_null.max()}")
+    else:
+        counts = non_null.astype(str).value_counts()
+        top = ", ".join(f"{_cell(v)} ({n})" for v, n in counts.head(3).items())
+        parts.append(f"{len(counts)} distinct; top: {top}")
+    if nulls:
+        parts.append(f"{nulls} NULL")
+    return "; ".join(parts)
+
+
+def _render(df: pd.DataFrame, stat_columns: int, sample_rows: int) -> str:
+    lines = [f"Result: {len(df):,} rows x {df.shape[1]} columns"
+             + (f" (truncated at {df.attrs['truncated_at']:,} rows)" if df.attrs.get("truncated_at") else "")]
+    for i, column in enumerate(df.columns):
+        line = f"- {column} ({df[column].dtype})"
+        if i < stat_columns:
+            line += f": {_column_stats(df[column])}"
+        lines.append(line)
+    if sample_rows:
+        lines.append("Sample rows:")
+        lines.append(" | ".join(str(c) for c in df.columns))
+        for row in df.head(sample_rows).itertuples(index=False):
+            lines.append(" | ".join(_cell(v) for v in row))
+    return "\n".join(lines)
+
+
+def summarize_result(df: pd.DataFrame, token_budget: int = SUMMARY_TOKEN_BUDGET) -> str:
+    """
+    Describe a result within token_budget tokens. Sample rows go first, then
+    per-column statistics; if even the column list does not fit, it is cut.
+    """
+    if df is None:
+        return "No result."
+    sample_rows = min(3, len(df))
+    stat_columns = df.shape[1]
+    while True:
+        text = _render(df, stat_columns, sample_rows)
+        if count_tokens(text) <= token_budget:
+            return text
+        if sample_rows:
+            sample_rows -= 1
+        elif stat_columns:
+            stat_columns = max(0, stat_columns // 2 if stat_columns > 1 else 0)
+        else:
+            break
+    # Too many columns to list: keep the first lines that fit
+    kept = []
+    for line in text.splitlines():
+        if count_tokens("\n".join(kept + [line])) > token_budget - 10:
+            break
+        kept.append(line)
+    return "\n".join(kept + [f"- ... {df.shape[1] - (len(kept) - 1)} more columns"])
+
+
+# --------------------------- #
+#   MEMORY ACCOUNTING
+# --------------------------- #
+class ShadowMemory:
+    """
+    Token-count model of ConversationSummaryBufferMemory: messages are
+    buffered until the buffer exceeds max_token_limit, then the oldest are
+    pruned into the summary with one LLM call. Running two of these side by
+    side (old vs new message contents) measures summarization calls avoided.
+    """
+    def __init__(self, max_token_limit: int = 6000):
+        self.max_token_limit = max_token_limit
+        self.buffer = deque()
+        self.buffer_tokens = 0
+        self.summarizations = 0
+
+    def add(self, *texts: str) -> bool:
+        """Add a turn's messages; True if this would trigger a summarization call."""
+        for text in texts:
+            tokens = count_tokens(text)
+            self.buffer.append(tokens)
+            self.buffer_tokens += tokens
+        if self.buffer_tokens <= self.max_token_limit:
+            return False
+        while self.buffer and self.buffer_tokens > self.max_token_limit:
+            self.buffer_tokens -= self.buffer.popleft()
+        self.summarizations += 1
+        return True
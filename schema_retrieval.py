@@ -0,0 +1,303 @@
+"""
+Schema-aware pruning of prompt templates.
+
+Templates like prompts/db-sql-prompt.md describe every table in sections
+that start with a `**Table: <name>**` heading and are separated by `---`
+lines. Instead of sending all of them each turn, only the tables relevant to
+the question (plus the tables on their foreign-key join paths) are kept;
+the rest are listed by name so the model knows they exist.
+"""
+import math
+import re
+from collections import deque
+from dataclasses import dataclass, field
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+TABLE_HEADING = re.compile(r"^\*\*Table:\s*(.+?)\s*\*\*\s*$", re.MULTILINE)
+SECTION_SEPARATOR = re.compile(r"^---[ \t]*$", re.MULTILINE)
+WORD = re.compile(r"[a-z][a-z0-9]*")
+STOPWORDS = {
+    "a", "an", "the", "of", "for", "in", "on", "to", "and", "or", "is", "are", "was",
+    "were", "be", "by", "with", "from", "at", "as", "it", "this", "that", "these",
+    "do", "does", "did", "what", "which", "who", "how", "many", "much", "me", "my",
+    "we", "our", "you", "your", "i", "can", "could", "would", "please", "show", "give",
+    "get", "list", "now", "same", "also", "only", "all", "each", "per", "any", "there",
+    "e", "g", "eg", "if", "not", "no", "yes",
+    # Aggregation words describe the query, not the schema
+    "count", "number", "total", "sum", "average", "avg", "mean", "median", "distribution",
+    "top", "most", "least", "percentage", "percent", "breakdown",
+}
+
+# Weight of a question term found in the table name / a column name / the descriptions
+TABLE_NAME_WEIGHT = 3.0
+COLUMN_NAME_WEIGHT = 2.0
+DESCRIPTION_WEIGHT = 0.5
+# Conversation history only nudges the ranking (follow-up questions)
+HISTORY_WEIGHT = 0.5
+# Keep tables scoring at least this share of the best table's score,
+# or at least this absolute score (weak but real matches such as value examples)
+RELATIVE_SCORE_CUTOFF = 0.25
+ABSOLUTE_SCORE_CUTOFF = 0.6
+MAX_TABLES = 4
+
+
+# --------------------------- #
+#       TOKEN COUNTING
+# --------------------------- #
+@lru_cache(maxsize=1)
+def _encoding():
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        # Encodings are downloaded on first use; offline => estimate instead
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """Token count for gpt-4o, or a ~4 characters/token estimate without tiktoken."""
+    encoding = _encoding()
+    if encoding is None:
+        return len(text) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+# --------------------------- #
+#       SCHEMA INDEX
+# --------------------------- #
+def _stem(word: str) -> str:
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+def _terms(text: str) -> list:
+    return [
+        _stem(w) for w in WORD.findall(text.lower().replace("_", " ")) if w not in STOPWORDS
+    ]
+
+
+@dataclass
+class TableSection:
+    name: str
+    text: str
+    columns: list = field(default_factory=list)
+    primary_keys: list = field(default_factory=list)
+    foreign_keys: dict = field(default_factory=dict)  # column -> referenced table
+    name_terms: set = field(default_factory=set)
+    column_terms: set = field(default_factory=set)
+    description_terms: set = field(default_factory=set)
+
+
+@dataclass
+class SchemaIndex:
+    preamble: str
+    sections: dict  # table name -> TableSection
+    postamble: str
+    edges: dict  # table name -> set of neighbouring table names
+    idf: dict
+
+    @property
+    def table_names(self) -> list:
+        return list(self.sections)
+
+
+def _parse_columns(section_text: str):
+    """Yield (column name, row text) for every markdown table row of the section."""
+    for line in section_text.splitlines():
+        if not line.startswith("|"):
+            continue
+        cells = [c.strip() for c in line.strip().strip("|").split("|")]
+        name = cells[0].strip("`* ") if cells else ""
+        if not name or set(name) <= set("-: ") or name.lower() == "column name":
+            continue
+        yield name, line
+
+
+@lru_cache(maxsize=8)
+def build_schema_index(prompt_template: str):
+    """
+    Split a prompt template into preamble, per-table sections and postamble.
+    Returns None if the template has no `**Table: ...**` sections.
+    """
+    chunks = SECTION_SEPARATOR.split(prompt_template)
+    table_chunks = [i for i, chunk in enumerate(chunks) if TABLE_HEADING.search(chunk)]
+    if not table_chunks:
+        return None
+    first, last = table_chunks[0], table_chunks[-1]
+    preamble = "---".join(chunks[:first])
+    postamble = "---".join(chunks[last + 1:])
+
+    sections = {}
+    for chunk in chunks[first:last + 1]:
+        heading = TABLE_HEADING.search(chunk)
+        if heading is None:
+            continue
+        name = heading.group(1).strip("` ")
+        section = TableSection(name=name, text=chunk.strip("\n"))
+        for column, row in _parse_columns(chunk):
+            section.columns.append(column)
+            section.column_terms.update(_terms(column))
+            row_lower = row.lower()
+            if "primary" in row_lower:
+                section.primary_keys.append(column)
+            if "foreign" in row_lower or column.endswith("_fk"):
+                section.foreign_keys[column] = row
+        section.name_terms = set(_terms(name))
+        section.description_terms = set(_terms(chunk)) - section.column_terms
+        sections[name] = section
+
+    # Resolve foreign keys: a table named in the row, else `<pk>_fk` -> owner of `<pk>`
+    owners = {pk: s.name for s in sections.values() for pk in s.primary_keys}
+    edges = {name: set() for name in sections}
+    for section in sections.values():
+        for column, row in list(section.foreign_keys.items()):
+            mentioned = [t for t in sections if t != section.name and f"`{t}`" in row]
+            target = mentioned[0] if mentioned else owners.get(re.sub(r"_fk$", "", column))
+            section.foreign_keys[column] = target
+            if target and target != section.name:
+                edges[section.name].add(target)
+                edges[target].add(section.name)
+
+    document_frequency = {}
+    for section in sections.values():
+        for term in section.name_terms | section.column_terms | section.description_terms:
+            document_frequency[term] = document_frequency.get(term, 0) + 1
+    # Terms present in every table (e.g. "student") carry no signal
+    idf = {term: math.log(len(sections) / df) for term, df in document_frequency.items()}
+    return SchemaIndex(preamble, sections, postamble, edges, idf)
+
+
+# --------------------------- #
+#         RETRIEVAL
+# --------------------------- #
+def _prefix_match(term: str, candidates: set):
+    """Abbreviations and inflections: "math" -> "mathematics", "moved" -> "move"."""
+    if len(term) < 4:
+        return None
+    matches = [t for t in candidates if len(t) >= 4 and (t.startswith(term) or term.startswith(t))]
+    return max(matches, key=len) if matches else None
+
+
+def _match_score(index: SchemaIndex, section: TableSection, term: str) -> float:
+    """Score of one question term against a table's name, columns and descriptions."""
+    score = 0.0
+    fields = (
+        (section.name_terms, TABLE_NAME_WEIGHT),
+        (section.column_terms, COLUMN_NAME_WEIGHT),
+        (section.description_terms, DESCRIPTION_WEIGHT),
+    )
+    for candidates, weight in fields:
+        if term in candidates:
+            score += weight * index.idf.get(term, 0.0)
+            continue
+        prefixed = _prefix_match(term, candidates)
+        if prefixed:
+            score += weight * index.idf.get(prefixed, 0.0)
+    return score
+
+
+def score_tables(index: SchemaIndex, question: str, history: str = "") -> dict:
+    """Relevance score of every table for the question (and, weakly, the history)."""
+    scores = {name: 0.0 for name in index.sections}
+    for text, weight in ((question, 1.0), (history or "", HISTORY_WEIGHT)):
+        terms = set(_terms(text))
+        lowered = text.lower()
+        for name, section in index.sections.items():
+            score = 0.0
+            for term in terms:
+                if section.name_terms == {term}:
+                    # Even a table named after a common word ("Student") is worth a little
+                    score += TABLE_NAME_WEIGHT * max(index.idf.get(term, 0.0), 0.2)
+                else:
+                    score += _match_score(index, section, term)
+            # Mentions of a multi-word table or column name are strong signals
+            if len(section.name_terms) > 1 and section.name_terms <= terms:
+                score += 2 * TABLE_NAME_WEIGHT
+            score += sum(
+                COLUMN_NAME_WEIGHT for c in section.columns if " " in c and c.lower() in lowered
+            )
+            scores[name] += weight * score
+    return scores
+
+
+def join_path(index: SchemaIndex, start: str, goal: str) -> list:
+    """Shortest list of tables connecting start to goal through foreign keys."""
+    previous = {start: None}
+    queue = deque([start])
+    while queue:
+        table = queue.popleft()
+        if table == goal:
+            path = []
+            while table is not None:
+                path.append(table)
+                table = previous[table]
+            return path[::-1]
+        for neighbour in sorted(index.edges[table]):
+            if neighbour not in previous:
+                previous[neighbour] = table
+                queue.append(neighbour)
+    return []
+
+
+def select_tables(index: SchemaIndex, question: str, history: str = "") -> list:
+    """
+    Tables relevant to the question plus those needed to join them.
+    Returns an empty list when nothing in the schema matches.
+    """
+    scores = score_tables(index, question, history)
+    best = max(scores.values(), default=0.0)
+    if best <= 0:
+        return []
+    ranked = sorted(scores, key=scores.get, reverse=True)
+    cutoff = min(RELATIVE_SCORE_CUTOFF * best, ABSOLUTE_SCORE_CUTOFF)
+    chosen = [t for t in ranked if scores[t] > 0 and scores[t] >= cutoff][:MAX_TABLES]
+    selected = set(chosen)
+    for other in chosen[1:]:
+        selected.update(join_path(index, chosen[0], other))
+    # Keep the document's original table order
+    return [t for t in index.table_names if t in selected]
+
+
+@dataclass
+class PruneReport:
+    tables: list
+    tokens_before: int
+    tokens_after: int
+
+    @property
+    def pruned(self) -> bool:
+        return self.tokens_after < self.tokens_before
+
+
+def prune_prompt_template(prompt_template: str, question: str, history: str = ""):
+    """
+    Return (template, PruneReport). The template keeps the original preamble
+    and postamble but only the relevant table sections. Templates without
+    table sections, or questions matching no table, are returned unchanged.
+    """
+    index = build_schema_index(prompt_template)
+    tokens_before = count_tokens(prompt_template)
+    if index is None:
+        return prompt_template, PruneReport([], tokens_before, tokens_before)
+    tables = select_tables(index, question, history)
+    if not tables:
+        return prompt_template, PruneReport(index.table_names, tokens_before, tokens_before)
+
+    omitted = [t for t in index.table_names if t not in tables]
+    body = "\n\n---\n\n".join(index.sections[t].text for t in tables)
+    if omitted:
+        body += (
+            "\n\n---\n\nOther tables in the database (not described here, ask if you need them): "
+            + ", ".join(f"`{t}`" for t in omitted)
+        )
+    template = f"{index.preamble.rstrip()}\n\n---\n\n{body}\n\n---{index.postamble}"
+    return template, PruneReport(tables, tokens_before, count_tokens(template))
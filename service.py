@@ -0,0 +1,448 @@
+"""
+Headless HTTP service for the text-to-SQL pipeline (see pipeline.py).
+
+A plain ASGI app, so any ASGI server can host it; uvicorn is used below:
+
+    python service.py --port 8000 --workers 4
+
+Endpoints (JSON in, JSON out; "stream": true returns NDJSON events instead):
+  GET  /health     status and current load of this worker process
+  POST /ask        {"question", "history"?, "prompt"?, "sql"?, "candidates"?, "cost_action"?, "llm_cache"?}
+                   classify and answer; PLOT requests plot the result of "sql"
+  POST /sql        {"sql", "cost_action"?} cost-check and run a query
+  POST /plot-spec  {"sql", "question"} chart spec and plot-ready data for a query result
+  GET  /metrics    per-stage latency and counters of this worker (Prometheus text)
+
+Each worker process runs at most SERVICE_CONCURRENCY requests at once (on a
+thread pool, since the pipeline is blocking); up to SERVICE_QUEUE_SIZE more
+wait for a slot and anything beyond that gets 503 with Retry-After. The
+service is stateless: clients pass the conversation history themselves.
+Every request is traced (see tracing.py) to TRACE_LOG_FILE.
+"""
+import argparse
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.chat_models import ChatOpenAI
+
+from database import MultipleStatementsError, create_pooled_engine, get_conn_str
+from llm_cache import replay_tokens, shared_llm_cache
+from pipeline import COST_ACTIONS, PROMPTS_DIR, Pipeline, load_prompt_template
+from tracing import LLMTraceHandler, StageMetrics, Trace
+
+# --- DB connection + tuning settings (PG_*, QUERY_*, SERVICE_*, ...) ---
+load_dotenv("db_config.env")
+
+SERVICE_CONCURRENCY = int(os.getenv("SERVICE_CONCURRENCY", "8"))
+SERVICE_QUEUE_SIZE = int(os.getenv("SERVICE_QUEUE_SIZE", "32"))
+SERVICE_MAX_ROWS = int(os.getenv("SERVICE_MAX_ROWS", "1000"))  # rows returned per response
+SERVICE_PROMPT = os.getenv("SERVICE_PROMPT", "db-sql-prompt.md")
+SERVICE_MODEL = os.getenv("SERVICE_MODEL", "gpt-4o")
+SQL_CANDIDATE_TEMPERATURE = float(os.getenv("SQL_CANDIDATE_TEMPERATURE", "0.7"))
+SQL_CANDIDATES_MAX = int(os.getenv("SQL_CANDIDATES_MAX", "5"))  # same as the app's slider
+
+
+class ServiceError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+# --------------------------- #
+#     SHARED STATE
+# --------------------------- #
+_pipeline = None
+_executor = None
+_limiter = None
+_metrics = StageMetrics()
+
+
+def get_pipeline() -> Pipeline:
+    """One pipeline (pooled engine, caches) per worker process, created on first use."""
+    global _pipeline
+    if _pipeline is None:
+        _pipeline = Pipeline(create_pooled_engine(get_conn_str("db_config.env")))
+    return _pipeline
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=SERVICE_CONCURRENCY, thread_name_prefix="service")
+    return _executor
+
+
+class Limiter:
+    """At most `concurrency` requests in flight; at most `max_waiting` queued behind them."""
+    def __init__(self, concurrency: int, max_waiting: int):
+        self.max_waiting = max_waiting
+        self.active = 0
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    @property
+    def full(self) -> bool:
+        return self._semaphore.locked() and self.waiting >= self.max_waiting
+
+    async def __aenter__(self):
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.active -= 1
+        self._semaphore.release()
+
+
+def get_limiter() -> Limiter:
+    global _limiter
+    if _limiter is None:
+        _limiter = Limiter(SERVICE_CONCURRENCY, SERVICE_QUEUE_SIZE)
+    return _limiter
+
+
+# --------------------------- #
+#     LLMs
+# --------------------------- #
+class EventForwarder(BaseCallbackHandler):
+    """Streams LLM tokens to the request's event stream."""
+    def __init__(self, emit):
+        self.emit = emit
+
+    def on_llm_new_token(self, token: str, **kwargs):
+        self.emit({"type": "token", "text": token})
+
+    def on_llm_end(self, response, **kwargs):
+        # Completions served from the LLM cache arrive without tokens
+        for token in replay_tokens(response):
+            self.on_llm_new_token(token)
+
+
+def make_llm(emit=None, temperature: float = 0.0, trace: Trace = None, label: str = "helper",
+             cache: bool = True):
+    """
+    A per-request ChatOpenAI (OPENAI_API_KEY); streams tokens to emit if given.
+    Temperature-0 calls use the LLM cache unless cache=False.
+    """
+    callbacks = [EventForwarder(emit)] if emit is not None else []
+    if trace is not None:
+        callbacks.append(LLMTraceHandler(label, trace))
+    return ChatOpenAI(
+        temperature=temperature,
+        openai_api_key=os.getenv("OPENAI_API_KEY"),
+        model_name=SERVICE_MODEL,
+        streaming=emit is not None,
+        callbacks=callbacks or None,
+        cache=shared_llm_cache() if cache and temperature == 0 else False,
+    )
+
+
+# --------------------------- #
+#     HANDLERS (blocking, run on the executor)
+# --------------------------- #
+def frame_payload(df) -> dict:
+    """A result as JSON-ready columns/rows, capped at SERVICE_MAX_ROWS."""
+    if df is None:
+        return {"columns": None, "data": None, "row_count": 0}
+    shown = json.loads(df.head(SERVICE_MAX_ROWS).to_json(orient="split", index=False, date_format="iso"))
+    return {
+        "columns": shown["columns"],
+        "data": shown["data"],
+        "row_count": len(df),
+        "truncated_at": df.attrs.get("truncated_at"),
+        "rows_returned": len(shown["data"]),
+    }
+
+
+def _cost_action(payload: dict) -> str:
+    action = payload.get("cost_action", "feedback")
+    if action not in COST_ACTIONS:
+        raise ServiceError(400, f"cost_action must be one of {', '.join(COST_ACTIONS)}")
+    return action
+
+
+def _candidates(payload: dict) -> int:
+    """"candidates" as an int, clamped to 1..SQL_CANDIDATES_MAX."""
+    value = payload.get("candidates", 1)
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ServiceError(400, '"candidates" must be an integer')
+    try:
+        candidates = int(value)
+    except ValueError:
+        raise ServiceError(400, '"candidates" must be an integer')
+    return max(1, min(candidates, SQL_CANDIDATES_MAX))
+
+
+def _prompt_template(payload: dict) -> str:
+    """The template named by "prompt": a file under prompts/, or None/"None" for plain chat."""
+    name = payload.get("prompt", SERVICE_PROMPT)
+    if name is not None and not isinstance(name, str):
+        raise ServiceError(400, '"prompt" must be a prompt file name')
+    if name and name != "None" and not (PROMPTS_DIR / os.path.basename(name)).is_file():
+        raise ServiceError(400, f"unknown prompt template {name!r}")
+    try:
+        return load_prompt_template(name)
+    except (OSError, TypeError, UnicodeDecodeError):
+        raise ServiceError(400, f"unknown prompt template {name!r}")
+
+
+def _required(payload: dict, key: str) -> str:
+    value = payload.get(key)
+    if not isinstance(value, str) or not value.strip():
+        raise ServiceError(400, f'"{key}" is required')
+    return value
+
+
+def _run_traced(pipeline: Pipeline, sql_query: str, trace: Trace):
+    with trace.span("run") as span:
+        df = pipeline.run_sql(sql_query)
+        span["rows"] = len(df)
+    trace.set(rows=len(df), bytes=int(df.memory_usage(deep=True).sum()))
+    return df
+
+
+def handle_sql(payload: dict, emit=None, trace: Trace = None) -> dict:
+    pipeline = get_pipeline()
+    trace = trace or Trace(path=None)
+    with trace.span("explain"):
+        sql_query, note = pipeline.check_cost(_required(payload, "sql"), _cost_action(payload))
+    df = _run_traced(pipeline, sql_query, trace)
+    with trace.span("render"):
+        return {"sql": sql_query, "note": note, **frame_payload(df)}
+
+
+def handle_plot_spec(payload: dict, emit=None, trace: Trace = None) -> dict:
+    pipeline = get_pipeline()
+    trace = trace or Trace(path=None)
+    sql_query = _required(payload, "sql")
+    with trace.span("explain"):
+        checked_sql = pipeline.check_cost(sql_query, "feedback")[0]
+    df = _run_traced(pipeline, checked_sql, trace)
+    # The LLM is only asked when the chart is ambiguous
+    llm = make_llm(trace=trace, cache=payload.get("llm_cache", True)) if os.getenv("OPENAI_API_KEY") else None
+    with trace.span("plot") as span:
+        plot = pipeline.plot(df, payload.get("question", ""), llm, sql_query=sql_query, on_event=emit)
+        span["pushdown"] = bool(plot.pushdown_sql)
+    if plot.spec is None:
+        return {"spec": None, "notes": plot.notes + ["Plotting instructions could not be determined."]}
+    with trace.span("render"):
+        data, spec, note = pipeline.prepare_chart(plot.df, plot.spec)
+    return {
+        "spec": spec,
+        "source": plot.source,
+        "pushdown_sql": plot.pushdown_sql,
+        "notes": plot.notes + ([note] if note else []),
+        **frame_payload(data),
+    }
+
+
+def handle_ask(payload: dict, emit=None, trace: Trace = None) -> dict:
+    pipeline = get_pipeline()
+    trace = trace or Trace(path=None)
+    question = _required(payload, "question")
+    history = payload.get("history") or "NONE"
+    prompt_template = _prompt_template(payload)
+    use_cache = payload.get("llm_cache", True)
+    with trace.span("classify"):
+        action = pipeline.classify(question, history, make_llm(trace=trace, cache=use_cache))
+    trace.set(action=action)
+    if emit is not None:
+        emit({"type": "action", "action": action})
+
+    if action == "PLOT":
+        if not payload.get("sql"):
+            return {"action": action, "text": "No recent data found to plot. Please run a query first."}
+        plot_payload = {"sql": payload["sql"], "question": question, "llm_cache": use_cache}
+        return {"action": action, **handle_plot_spec(plot_payload, emit, trace)}
+
+    with trace.span("prompt_build"):
+        prompt, _ = pipeline.build_prompt(prompt_template, question, history)
+    llm = make_llm(emit, trace=trace, label="chat", cache=use_cache)
+    if action == "CHAT":
+        return {"action": action, "text": llm.predict(prompt)}
+
+    candidates = _candidates(payload)
+    answer = pipeline.answer_sql(
+        llm, prompt, prompt_template, question,
+        on_event=emit,
+        candidates=candidates,
+        candidate_llm=(make_llm(temperature=SQL_CANDIDATE_TEMPERATURE, trace=trace, label="candidates")
+                       if candidates > 1 else None),
+        cost_action=_cost_action(payload),
+        reuse_sql=payload.get("reuse_sql", True),
+    )
+    trace.extend(answer.spans)
+    trace.set(source=answer.source, retries=max(0, answer.attempts - 1), error=answer.error)
+    run_spans = [span for span in answer.spans if span["name"] == "run" and "rows" in span]
+    if run_spans:
+        trace.set(rows=run_spans[-1]["rows"], bytes=run_spans[-1]["bytes"])
+    return {
+        "action": action,
+        "text": answer.response_text,
+        "sql": answer.sql,
+        "source": answer.source,
+        "attempts": answer.attempts,
+        "error": answer.error,
+        "timings": answer.timings,
+        **frame_payload(answer.df),
+    }
+
+
+ROUTES = {
+    ("POST", "/ask"): handle_ask,
+    ("POST", "/sql"): handle_sql,
+    ("POST", "/plot-spec"): handle_plot_spec,
+}
+
+
+def traced(handler, route: str):
+    """handler(payload, emit) wrapped in a Trace of the whole request."""
+    def run(payload: dict, emit=None) -> dict:
+        trace = Trace(_metrics, route=route, action=route)
+        try:
+            return handler(payload, emit, trace)
+        except Exception as e:
+            trace.set(error=str(e)[:500])
+            raise
+        finally:
+            trace.finish()
+    return run
+
+
+# --------------------------- #
+#     ASGI
+# --------------------------- #
+def _dumps(obj) -> bytes:
+    return json.dumps(obj, default=str).encode("utf-8")
+
+
+async def _respond(send, status: int, body: dict, headers: list = None):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json")] + (headers or []),
+    })
+    await send({"type": "http.response.body", "body": _dumps(body)})
+
+
+async def _read_json(receive) -> dict:
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    try:
+        payload = json.loads(body or b"{}")
+    except ValueError:
+        raise ServiceError(400, "request body must be JSON")
+    if not isinstance(payload, dict):
+        raise ServiceError(400, "request body must be a JSON object")
+    return payload
+
+
+def _status_of(error: Exception) -> int:
+    if isinstance(error, MultipleStatementsError):
+        return 400
+    return error.status if isinstance(error, ServiceError) else 500
+
+
+async def _run_streaming(send, handler, payload: dict):
+    """Run handler on the executor, forwarding its events as NDJSON lines."""
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    def emit(event: dict):
+        loop.call_soon_threadsafe(events.put_nowait, event)
+
+    future = loop.run_in_executor(get_executor(), handler, payload, emit)
+    future.add_done_callback(lambda _: events.put_nowait(None))
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [(b"content-type", b"application/x-ndjson")],
+    })
+    while (event := await events.get()) is not None:
+        await send({"type": "http.response.body", "body": _dumps(event) + b"\n", "more_body": True})
+    try:
+        final = {"type": "result", **future.result()}
+    except Exception as e:
+        final = {"type": "error", "status": _status_of(e), "error": str(e)}
+    await send({"type": "http.response.body", "body": _dumps(final) + b"\n"})
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if _executor is not None:
+                    _executor.shutdown(wait=False, cancel_futures=True)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+
+    limiter = get_limiter()
+    if scope["method"] == "GET" and scope["path"] == "/health":
+        await _respond(send, 200, {"status": "ok", "active": limiter.active, "waiting": limiter.waiting})
+        return
+    if scope["method"] == "GET" and scope["path"] == "/metrics":
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"text/plain; version=0.0.4")],
+        })
+        await send({"type": "http.response.body", "body": _metrics.prometheus_text().encode("utf-8")})
+        return
+    handler = ROUTES.get((scope["method"], scope["path"]))
+    if handler is None:
+        await _respond(send, 404, {"error": f"no route for {scope['method']} {scope['path']}"})
+        return
+    if limiter.full:
+        # Backpressure: tell the client (or load balancer) to come back later
+        await _respond(send, 503, {"error": "server busy, retry later"}, [(b"retry-after", b"1")])
+        return
+
+    try:
+        payload = await _read_json(receive)
+    except ServiceError as e:
+        await _respond(send, e.status, {"error": str(e)})
+        return
+    handler = traced(handler, scope["path"])
+    async with limiter:
+        if payload.get("stream"):
+            await _run_streaming(send, handler, payload)
+            return
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(get_executor(), handler, payload)
+        except Exception as e:
+            await _respond(send, _status_of(e), {"error": str(e)})
+            return
+        await _respond(send, 200, result)
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Serve the text-to-SQL pipeline over HTTP.")
+    parser.add_argument("--host", default=os.getenv("SERVICE_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("SERVICE_PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("SERVICE_WORKERS", "1")),
+                        help="worker processes (each with its own pool, caches and SERVICE_CONCURRENCY)")
+    args = parser.parse_args()
+    uvicorn.run("service:app", host=args.host, port=args.port, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Parallel generation of candidate SQL queries.
+
+Instead of generate -> execute -> regenerate, N candidates are requested at
+once (with some temperature so they differ). Each worker validates its
+candidate locally and asks the planner for an estimate; the caller then
+executes the cheapest valid candidate and only falls back to the sequential
+retry loop if none of them works.
+"""
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+from dataclasses import dataclass, field
+
+from database import explain_estimate
+from sql_utils import extract_sql
+from sql_validator import validate_sql
+
+
+@dataclass
+class Candidate:
+    response_text: str = ""
+    sql: str = None
+    fixes: list = field(default_factory=list)
+    cost: float = None
+    rows: float = None
+    error: str = None
+    over_budget: bool = False
+    seconds: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return self.sql is not None and self.error is None
+
+
+def generate_candidate(llm, prompt: str, catalog_index, engine, max_cost: float, max_rows: float,
+                       timeout_ms: int = None, cost_action: str = "feedback") -> Candidate:
+    """
+    One LLM call, then local validation and an EXPLAIN estimate. Never raises.
+    An over-budget estimate fails the candidate only for cost_action
+    "feedback"; otherwise it is flagged so the caller can rewrite it.
+    """
+    started = time.time()
+    candidate = Candidate()
+    try:
+        candidate.response_text = llm.predict(prompt)
+        extracted = extract_sql(candidate.response_text)
+        if extracted:
+            validation = validate_sql(extracted, catalog_index)
+            candidate.sql, candidate.fixes = validation.sql, validation.fixes
+            if not validation.ok:
+                candidate.error = "\n".join(validation.errors)
+            else:
+                estimate = explain_estimate(engine, candidate.sql, timeout_ms)
+                candidate.cost, candidate.rows = estimate["cost"], estimate["rows"]
+                candidate.over_budget = candidate.cost > max_cost or candidate.rows > max_rows
+                if candidate.over_budget and cost_action == "feedback":
+                    candidate.error = (
+                        f"Estimated {candidate.rows:,.0f} rows / cost {candidate.cost:,.0f} is over budget; "
+                        "aggregate or filter instead of returning raw rows."
+                    )
+    except Exception as e:  # LLM/network errors, SQL the planner rejects
+        candidate.error = str(e)
+    candidate.seconds = time.time() - started
+    return candidate
+
+
+def generate_candidates(executor, llm, prompt: str, n: int, catalog_index, engine,
+                        max_cost: float, max_rows: float, timeout_ms: int = None,
+                        grace_seconds: float = 1.5, cost_action: str = "feedback") -> list:
+    """
+    Request n candidates concurrently on executor. Once the first valid one
+    arrives, the others get grace_seconds to finish (a cheaper plan may still
+    come in); whatever is still pending after that is cancelled/ignored.
+
+    Returns the finished candidates, valid ones first, within budget before
+    over budget, cheapest first.
+    """
+    futures = [
+        executor.submit(generate_candidate, llm, prompt, catalog_index, engine,
+                        max_cost, max_rows, timeout_ms, cost_action)
+        for _ in range(n)
+    ]
+    pending = set(futures)
+    deadline = None
+    while pending:
+        timeout = None if deadline is None else max(0.0, deadline - time.time())
+        finished, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        if not finished:
+            break
+        if deadline is None and any(f.result().ok for f in finished):
+            deadline = time.time() + grace_seconds
+    for future in pending:
+        # Queued calls never start; in-flight LLM calls finish in the background and are dropped
+        future.cancel()
+    candidates = [f.result() for f in futures if f.done() and not f.cancelled()]
+    return sorted(candidates, key=lambda c: (not c.ok, c.over_budget, c.cost if c.cost is not None else float("inf")))
@@ -0,0 +1,261 @@
+import hashlib
+import re
+from dataclasses import dataclass
+
+# --------------------------- #
+#     SQL TOKENIZER
+# --------------------------- #
+# A deliberately small PostgreSQL tokenizer. It only needs to tell apart
+# comments, string literals, quoted identifiers, bare words, numbers and
+# punctuation -- enough to normalize queries without a full parser.
+TOKEN_PATTERN = re.compile(
+    r"""
+    (?P<comment>--[^\n]*|/\*.*?\*/)
+  | (?P<string>[Ee]'(?:[^'\\]|\\.|'')*'|'(?:[^']|'')*')
+  | (?P<quoted>"(?:[^"]|"")*")
+  | (?P<number>\d+(?:\.\d*)?(?:[eE][+-]?\d+)?|\.\d+(?:[eE][+-]?\d+)?)
+  | (?P<word>[A-Za-z_][A-Za-z0-9_$]*)
+  | (?P<space>\s+)
+  | (?P<punct>::|<=|>=|<>|!=|\|\||.)
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+WORDISH_KINDS = {"string", "quoted", "number", "word"}
+
+WRITE_KEYWORDS = {
+    "insert", "update", "delete", "merge", "drop", "create", "alter",
+    "truncate", "grant", "revoke", "copy", "vacuum", "reindex", "cluster",
+    "comment", "lock", "call", "do", "refresh", "set", "reset",
+}
+
+
+def tokenize(sql_query: str) -> list:
+    """
+    Split a SQL string into (kind, text) tuples.
+    Kinds: comment, string, quoted, number, word, space, punct.
+    """
+    return [
+        (match.lastgroup, match.group())
+        for match in TOKEN_PATTERN.finditer(sql_query)
+    ]
+
+
+def significant_tokens(sql_query: str) -> list:
+    """Tokens without whitespace, comments or trailing semicolons."""
+    tokens = [t for t in tokenize(sql_query) if t[0] not in ("space", "comment")]
+    while tokens and tokens[-1] == ("punct", ";"):
+        tokens.pop()
+    return tokens
+
+
+def join_tokens(tokens: list) -> str:
+    """Join tokens with a single space only where two words would otherwise merge."""
+    parts = []
+    prev_kind = None
+    for kind, value in tokens:
+        if parts and kind in WORDISH_KINDS and prev_kind in WORDISH_KINDS:
+            parts.append(" ")
+        parts.append(value)
+        prev_kind = kind
+    return "".join(parts)
+
+
+def normalize_sql(sql_query: str) -> str:
+    """
+    Canonical form of a query used as a cache key.
+    Comments, redundant whitespace and trailing semicolons are dropped and
+    bare keywords/identifiers are lower-cased (PostgreSQL folds them anyway).
+    Quoted identifiers and string literals keep their exact case.
+    """
+    tokens = [
+        (kind, value.lower() if kind == "word" else value)
+        for kind, value in significant_tokens(sql_query)
+    ]
+    return join_tokens(tokens)
+
+
+def identifier_names(sql_query: str) -> set:
+    """
+    Lower-cased names of every bare word and quoted identifier in the query.
+    Used to decide which tables a query may depend on.
+    """
+    names = set()
+    for kind, value in significant_tokens(sql_query):
+        if kind == "word":
+            names.add(value.lower())
+        elif kind == "quoted":
+            names.add(value[1:-1].replace('""', '"').lower())
+    return names
+
+
+def is_single_statement(sql_query: str) -> bool:
+    """
+    True unless the query holds a ";" before its end (SELECT 1; COMMIT; DROP ...)
+    or dollar quoting, whose body this tokenizer does not see into.
+    """
+    return not any(token in (("punct", ";"), ("punct", "$")) for token in significant_tokens(sql_query))
+
+
+def is_select_query(sql_query: str) -> bool:
+    """True if the query only reads data (SELECT / WITH ... SELECT / VALUES)."""
+    words = [value.lower() for kind, value in significant_tokens(sql_query) if kind == "word"]
+    if not words or words[0] not in ("select", "with", "values", "table"):
+        return False
+    return not any(word in WRITE_KEYWORDS for word in words)
+
+
+# --------------------------- #
+#     QUERY SHAPES
+# --------------------------- #
+LITERAL_KINDS = {"string", "number"}
+IN_LIST_PATTERN = re.compile(r"\(\?(?:,\?)+\)")
+
+
+def fingerprint_sql(sql_query: str) -> str:
+    """
+    The shape of a query: normalize_sql() with every string / number literal
+    replaced by ? and literal lists collapsed, so
+    SELECT * FROM t WHERE id IN (1, 2, 3) AND name = 'x'
+    -> select*from t where id in(?)and name=?
+    """
+    tokens = [
+        ("number", "?") if kind in LITERAL_KINDS else (kind, value.lower() if kind == "word" else value)
+        for kind, value in significant_tokens(sql_query)
+    ]
+    return IN_LIST_PATTERN.sub("(?)", join_tokens(tokens))
+
+
+def shape_id(sql_query: str) -> str:
+    """Short stable id of fingerprint_sql(sql_query)."""
+    return hashlib.sha1(fingerprint_sql(sql_query).encode("utf-8")).hexdigest()[:12]
+
+
+# Literals that have to stay inline: typed literals (DATE '2024-01-01',
+# INTERVAL '1 day') and type modifiers (numeric(10, 2)) do not accept
+# parameters, and numbers in GROUP BY / ORDER BY are column positions.
+TYPE_WORDS = {
+    "date", "time", "timestamp", "timestamptz", "interval", "numeric", "decimal",
+    "varchar", "char", "character", "varying", "bit", "float", "double", "precision",
+}
+BY_CLAUSE_ENDS = {
+    "select", "from", "where", "having", "limit", "offset", "fetch", "window",
+    "union", "intersect", "except", "for",
+}
+INT4_MAX = 2 ** 31 - 1
+INT8_MAX = 2 ** 63 - 1
+
+
+@dataclass
+class ParameterizedQuery:
+    """A query with its literals lifted into $1, $2, ... parameters."""
+    key: str  # normalized template, the same for every query of this shape
+    template: str  # executable template (original layout, comments dropped)
+    values: list  # parameter values, as text
+    types: list  # Postgres type of each parameter (unknown = inferred, like a string literal)
+
+
+def _literal_type(kind: str, value: str) -> str:
+    """The type Postgres gives the literal when it is written inline."""
+    if kind == "string":
+        return "unknown"
+    if not value.isdigit():
+        return "numeric"
+    number = int(value)
+    return "integer" if number <= INT4_MAX else "bigint" if number <= INT8_MAX else "numeric"
+
+
+def parameterize_sql(sql_query: str):
+    """
+    Lift the string / number literals of a query into bind parameters:
+    SELECT * FROM t WHERE state = 'CA' AND year > 2020 LIMIT 10
+    -> SELECT * FROM t WHERE state = $1 AND year > $2 LIMIT $3, ["CA", "2020", "10"]
+    Queries that differ only in their literals (of the same types) share the
+    key. Returns None for queries this cannot handle safely (dollar signs, no
+    literals). GROUP BY / ORDER BY positions stay inline, in any case:
+
+    >>> parameterize_sql("SELECT s, COUNT(*) FROM t GROUP BY 1 ORDER BY 2 DESC LIMIT 10").template
+    'SELECT s, COUNT(*) FROM t GROUP BY 1 ORDER BY 2 DESC LIMIT $1'
+    """
+    if "$" in sql_query:
+        return None
+    tokens = [("space", " ") if kind == "comment" else (kind, value) for kind, value in tokenize(sql_query)]
+    while tokens and (tokens[-1][0] == "space" or tokens[-1] == ("punct", ";")):
+        tokens.pop()
+
+    template, key_tokens, values, types = [], [], [], []
+    prev, prev_word = None, None  # previous significant token (words lower-cased) and word
+    by_clause = [False]  # per parenthesis depth: inside GROUP BY / ORDER BY
+    type_parens = []  # depths of parentheses that hold type modifiers
+    for kind, value in tokens:
+        if kind == "space":
+            template.append(value)
+            continue
+        lowered = value.lower()
+        keep_inline = (
+            kind not in LITERAL_KINDS
+            or value[0] in "Ee" and kind == "string"  # E'...' escapes
+            or type_parens and type_parens[-1] == len(by_clause)
+            or kind == "string" and prev is not None and prev[0] == "word" and prev[1] in TYPE_WORDS
+            or kind == "number" and by_clause[-1] and prev in (("word", "by"), ("punct", ","))
+        )
+        if keep_inline:
+            key_token = (kind, lowered if kind == "word" else value)
+            template.append(value)
+        else:
+            values.append(value[1:-1].replace("''", "'") if kind == "string" else value)
+            types.append(_literal_type(kind, value))
+            template.append(f"${len(values)}")
+            # The type is part of the shape: an int4 and a numeric literal need different statements
+            key_token = ("number", template[-1] if types[-1] == "unknown" else f"{template[-1]}::{types[-1]}")
+        key_tokens.append(key_token)
+
+        if kind == "punct" and value == "(":
+            by_clause.append(False)
+            if prev is not None and prev[0] == "word" and prev[1] in TYPE_WORDS:
+                type_parens.append(len(by_clause))
+        elif kind == "punct" and value == ")" and len(by_clause) > 1:
+            if type_parens and type_parens[-1] == len(by_clause):
+                type_parens.pop()
+            by_clause.pop()
+        elif kind == "word":
+            if lowered == "by" and prev_word in ("group", "order"):
+                by_clause[-1] = True
+            elif lowered in BY_CLAUSE_ENDS:
+                by_clause[-1] = False
+            prev_word = lowered
+        prev = key_token  # words lower-cased
+
+    if not values:
+        return None
+    return ParameterizedQuery(join_tokens(key_tokens), "".join(template).strip(), values, types)
+
+
+def quote_identifier(name: str) -> str:
+    """Double-quote an identifier for PostgreSQL (keeps its exact case)."""
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def strip_trailing_semicolon(sql_query: str) -> str:
+    """Remove trailing semicolons/whitespace so the query can be used as a subquery."""
+    return re.sub(r"[\s;]+$", "", sql_query)
+
+
+def wrap_subquery(sql_query: str, outer_select: str, alias: str) -> str:
+    """
+    Embed a query as a derived table:
+    wrap_subquery("SELECT ...", "SELECT COUNT(*)", "q") -> SELECT COUNT(*) FROM (...) AS q
+    A trailing line comment in the inner query cannot swallow the closing parenthesis
+    because the inner query is placed on its own lines.
+    """
+    return f"{outer_select} FROM (\n{strip_trailing_semicolon(sql_query)}\n) AS {alias}"
+
+
+def extract_sql(response_text: str) -> str:
+    """
+    Extract SQL code from triple-backtick ```sql ... ``` blocks.
+    Returns the first match or None if no block found.
+    """
+    pattern = r"```sql\s*(.*?)\s*```"
+    matches = re.findall(pattern, response_text, flags=re.DOTALL | re.IGNORECASE)
+    return matches[0].strip() if matches else None
@@ -0,0 +1,365 @@
+"""
+Local validation of generated SQL against the schema catalog.
+
+Most failed attempts of the SQL retry loop are mechanical: identifiers in
+single quotes, mixed-case tables left unquoted (Postgres folds them to lower
+case), multi-word columns written bare, or the right name in the wrong case.
+These are fixed here without a round trip. Genuine mistakes (unknown tables
+or columns, a column used without its table) are reported so the model can
+be asked to correct them without executing anything.
+"""
+import difflib
+import re
+from dataclasses import dataclass, field
+
+from sql_utils import tokenize
+
+# Bare words that are never rewritten into identifiers
+SQL_KEYWORDS = {
+    "all", "and", "any", "as", "asc", "between", "by", "case", "cast", "count", "cross",
+    "current_date", "current_timestamp", "date", "desc", "distinct", "else", "end",
+    "except", "exists", "false", "fetch", "filter", "first", "from", "full", "group",
+    "having", "ilike", "in", "inner", "intersect", "interval", "is", "join", "lateral",
+    "left", "like", "limit", "not", "null", "nulls", "offset", "on", "or", "order",
+    "outer", "over", "partition", "right", "select", "then", "time", "timestamp", "true",
+    "union", "using", "values", "when", "where", "window", "with", "year", "month", "day",
+}
+TABLE_CONTEXT = {"from", "join"}
+# Words that start a clause at their own parenthesis level
+CLAUSE_WORDS = {
+    "select", "from", "join", "on", "using", "where", "group", "having", "order", "limit",
+    "offset", "window", "union", "intersect", "except", "values",
+}
+# Keywords that are called like functions: count(...), cast(... AS type)
+CALL_KEYWORDS = {"count", "cast"}
+# Tokens that may follow a select-list / GROUP BY / ORDER BY item
+ITEM_END = {
+    ",", ")", None, "from", "as", "asc", "desc", "nulls", "having", "order", "limit", "offset",
+    "window", "union", "intersect", "except",
+}
+# Numeric aggregates: sum('x') cannot be meant as a literal, so it names a column
+NUMERIC_AGGREGATES = {"sum", "avg"}
+FUNCTION_CALL = "function call"  # clause of the tokens inside function-call parentheses
+MAX_RUN_WORDS = 8
+
+
+def _key(name: str) -> str:
+    """Case/spacing-insensitive form of an identifier: "Course_History" -> "course history"."""
+    return re.sub(r"[\s_]+", " ", name.strip().lower())
+
+
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _unquote(token: str) -> str:
+    return token[1:-1].replace('""', '"')
+
+
+# --------------------------- #
+#       CATALOG INDEX
+# --------------------------- #
+@dataclass
+class CatalogIndex:
+    table_columns: dict  # exact table name -> set of exact column names
+    tables: dict = field(default_factory=dict)  # key -> exact name (None if ambiguous)
+    columns: dict = field(default_factory=dict)
+
+    def resolve(self, name: str):
+        """Exact table or column name for a loosely written one, or None."""
+        key = _key(name)
+        return self.tables.get(key) or self.columns.get(key)
+
+    @property
+    def all_names(self) -> set:
+        names = set(self.table_columns)
+        for columns in self.table_columns.values():
+            names.update(columns)
+        return names
+
+
+def build_catalog_index(catalog: dict) -> CatalogIndex:
+    """Index a {table: [{"name": column, ...}, ...]} catalog (see database.load_catalog)."""
+    index = CatalogIndex({table: {c["name"] for c in columns} for table, columns in catalog.items()})
+    for table, columns in index.table_columns.items():
+        _add_name(index.tables, table)
+        for column in columns:
+            _add_name(index.columns, column)
+    return index
+
+
+def _add_name(names: dict, name: str) -> None:
+    key = _key(name)
+    if key in names and names[key] != name:
+        names[key] = None  # two names differ only in case/spacing: never guess
+    else:
+        names[key] = name
+
+
+def catalog_from_prompt(prompt_template: str) -> dict:
+    """Catalog built from the `**Table: ...**` sections of a prompt template (no database needed)."""
+    from schema_retrieval import build_schema_index
+
+    index = build_schema_index(prompt_template)
+    if index is None:
+        return {}
+    return {
+        name: [{"name": column, "type": ""} for column in section.columns]
+        for name, section in index.sections.items()
+    }
+
+
+# --------------------------- #
+#        VALIDATION
+# --------------------------- #
+class SQLValidationError(Exception):
+    """Generated SQL references tables or columns that do not exist."""
+
+
+@dataclass
+class ValidationResult:
+    sql: str
+    fixes: list = field(default_factory=list)
+    errors: list = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+
+def _previous_significant(tokens: list, i: int):
+    for kind, value in reversed(tokens[:i]):
+        if kind not in ("space", "comment"):
+            return kind, value.lower()
+    return None, None
+
+
+def _next_significant(tokens: list, i: int):
+    for kind, value in tokens[i + 1:]:
+        if kind not in ("space", "comment"):
+            return kind, value.lower()
+    return None, None
+
+
+def _match_bare_run(tokens: list, start: int, index: CatalogIndex):
+    """
+    Longest run of bare words starting at `start` naming a multi-word column or
+    table (e.g. Subject Area Name, Grade-to-Date). Returns (end, exact name) or (start, None).
+    """
+    ends = []
+    words = 0
+    j = start
+    while j < len(tokens) and words < MAX_RUN_WORDS:
+        kind, value = tokens[j]
+        if kind == "word":
+            words += 1
+            if words > 1:
+                ends.append(j + 1)
+        elif not (kind == "space" and "\n" not in value) and not (kind == "punct" and value in "-/"):
+            break
+        j += 1
+    for end in reversed(ends):
+        run = "".join(value for _, value in tokens[start:end])
+        name = index.resolve(run)
+        if name is not None:
+            return end, name
+    return start, None
+
+
+def _clauses(tokens: list) -> list:
+    """
+    For each token, the clause it is in at its own parenthesis level
+    ("select", "from", "where", "group", "order", ...; None before any), or
+    FUNCTION_CALL inside the parentheses of a function call, where FROM
+    (EXTRACT(YEAR FROM x), TRIM(' ' FROM x)) does not name a table.
+    """
+    stack = [None]
+    clauses = []
+    previous = (None, "")
+    for kind, value in tokens:
+        if kind in ("space", "comment"):
+            clauses.append(stack[-1])
+            continue
+        lowered = value.lower()
+        if kind == "punct" and value == "(":
+            clauses.append(stack[-1])
+            called = previous[0] in ("word", "quoted") and (
+                previous[1] not in SQL_KEYWORDS or previous[1] in CALL_KEYWORDS
+            )
+            stack.append(FUNCTION_CALL if called else None)
+        elif kind == "punct" and value == ")" and len(stack) > 1:
+            stack.pop()
+            clauses.append(stack[-1])
+        else:
+            if kind == "word" and lowered in CLAUSE_WORDS and stack[-1] != FUNCTION_CALL:
+                stack[-1] = "from" if lowered == "join" else lowered
+            clauses.append(stack[-1])
+        previous = (kind, lowered)
+    return clauses
+
+
+def _is_identifier_position(tokens: list, i: int, clause: str) -> bool:
+    """
+    Whether a string literal at tokens[i] stands where only an identifier
+    makes sense: after AS, FROM / JOIN or ".", as a whole select-list or
+    GROUP / ORDER BY item, or as the argument of sum() / avg().
+    """
+    previous = _previous_significant(tokens, i)[1]
+    following = _next_significant(tokens, i)[1]
+    if previous in ("as", "."):
+        return True
+    if clause == FUNCTION_CALL:
+        if previous != "(" or following != ")":
+            return False
+        j = i - 1
+        while tokens[j][0] in ("space", "comment"):
+            j -= 1
+        return _previous_significant(tokens, j)[1] in NUMERIC_AGGREGATES
+    if previous in TABLE_CONTEXT:
+        return True
+    if clause == "select":
+        return previous in ("select", "distinct", ",") and following in ITEM_END
+    if clause in ("group", "order"):
+        return previous in ("by", ",") and following in ITEM_END
+    return False
+
+
+def _identifier_name(kind: str, value: str) -> str:
+    return _unquote(value) if kind == "quoted" else value.lower()
+
+
+def _defined_names(significant: list, ctes_only: bool = False) -> set:
+    """CTE names and aliases (`AS name`) defined by the query itself."""
+    defined = set()
+    for i, (kind, value) in enumerate(significant[:-1]):
+        next_kind, next_value = significant[i + 1]
+        if kind == "word" and value.lower() == "as" and next_kind in ("word", "quoted") and not ctes_only:
+            defined.add(_identifier_name(next_kind, next_value))
+        elif kind in ("word", "quoted") and next_value.lower() == "as" and i + 2 < len(significant) \
+                and significant[i + 2][1] == "(":
+            defined.add(_identifier_name(kind, value))
+    return defined
+
+
+def _fix_identifiers(tokens: list, index: CatalogIndex, fixes: list) -> list:
+    """Rewrite mechanically broken identifiers; returns a new token list."""
+    # Aliases and CTE names are the query's own names, even if they look like catalog names
+    significant = [t for t in tokens if t[0] not in ("space", "comment")]
+    defined, ctes = _defined_names(significant), _defined_names(significant, ctes_only=True)
+    clauses = _clauses(tokens)
+    fixed = []
+    i = 0
+    while i < len(tokens):
+        kind, value = tokens[i]
+        if kind in ("word", "quoted"):
+            name, previous = _identifier_name(kind, value), _previous_significant(tokens, i)[1]
+            table_position = previous in TABLE_CONTEXT and clauses[i] != FUNCTION_CALL
+            if previous == "as" or name in (ctes if table_position else defined):
+                fixed.append((kind, value))
+                i += 1
+                continue
+        if kind == "word":
+            end, name = _match_bare_run(tokens, i, index)
+            if name is not None:
+                run = "".join(v for _, v in tokens[i:end])
+                fixes.append(f"quoted {run} as {_quote(name)}")
+                fixed.append(("quoted", _quote(name)))
+                i = end
+                continue
+            name = index.resolve(value) if value.lower() not in SQL_KEYWORDS else None
+            if (name is not None and name != value.lower()
+                    and _next_significant(tokens, i)[1] != "("):
+                # Unquoted mixed-case names are folded to lower case by Postgres
+                fixes.append(f"quoted {value} as {_quote(name)}")
+                fixed.append(("quoted", _quote(name)))
+                i += 1
+                continue
+        elif kind == "string" and value.startswith("'") and _is_identifier_position(tokens, i, clauses[i]):
+            # Elsewhere ('Sex' IN ('Sex', 'F'), ELSE 'Suffix') a string is a value, whatever it spells
+            content = value[1:-1].replace("''", "'")
+            name = index.resolve(content)
+            if _previous_significant(tokens, i)[1] == "as":
+                name = name or content
+            if name is not None and '"' not in content:
+                fixes.append(f"{value} is an identifier: {_quote(name)}")
+                fixed.append(("quoted", _quote(name)))
+                i += 1
+                continue
+        elif kind == "quoted":
+            content = _unquote(value)
+            if content not in index.all_names:
+                name = index.resolve(content)
+                if name is not None:
+                    fixes.append(f"{value} -> {_quote(name)}")
+                    fixed.append(("quoted", _quote(name)))
+                    i += 1
+                    continue
+        fixed.append((kind, value))
+        i += 1
+    return fixed
+
+
+def _check_references(tokens: list, index: CatalogIndex, errors: list) -> None:
+    """Report unknown tables/columns and columns used without their table."""
+    significant = [t for t in tokens if t[0] not in ("space", "comment")]
+    defined = _defined_names(significant)
+    clauses = _clauses(significant)
+
+    known = index.all_names
+    lower_names = {name for name in known if name == name.lower()}
+    suggestions = sorted(known)
+    tables, columns = set(), set()
+    for i, (kind, value) in enumerate(significant):
+        previous = significant[i - 1][1].lower() if i else ""
+        following = significant[i + 1][1] if i + 1 < len(significant) else ""
+        if kind not in ("word", "quoted") or following in (".", "("):
+            if kind == "quoted" and following == "." and _unquote(value) in index.table_columns:
+                tables.add(_unquote(value))
+            continue
+        name = _identifier_name(kind, value)
+        if previous in TABLE_CONTEXT and clauses[i] != FUNCTION_CALL:
+            if name in index.table_columns:
+                tables.add(name)
+            elif name not in defined:
+                errors.append(_unknown("table", name, sorted(index.table_columns)))
+            continue
+        if kind == "word" and previous != ".":
+            continue  # keywords, functions, aliases: too ambiguous to judge
+        if name in index.table_columns:
+            tables.add(name)
+        elif name in known or (kind == "word" and name in lower_names):
+            columns.add(name)
+        elif name not in defined:
+            errors.append(_unknown("column", name, suggestions))
+
+    if errors or not tables:
+        return
+    available = set().union(*(index.table_columns[t] for t in tables))
+    for column in sorted(columns - available):
+        owners = sorted(t for t, cols in index.table_columns.items() if column in cols)
+        errors.append(
+            f"Column {_quote(column)} is not in {', '.join(_quote(t) for t in sorted(tables))}; "
+            f"it belongs to {', '.join(_quote(t) for t in owners)} (join it first)."
+        )
+
+
+def _unknown(what: str, name: str, candidates: list) -> str:
+    message = f"Unknown {what} {_quote(name)}."
+    close = difflib.get_close_matches(name, candidates, n=3, cutoff=0.6)
+    if close:
+        message += " Did you mean " + " or ".join(_quote(c) for c in close) + "?"
+    return message
+
+
+def validate_sql(sql_query: str, index: CatalogIndex) -> ValidationResult:
+    """
+    Fix identifier quoting/casing in sql_query and check its references
+    against the catalog. result.sql is the (possibly rewritten) query;
+    result.errors lists problems only the model can fix.
+    """
+    if index is None or not index.table_columns:
+        return ValidationResult(sql_query)
+    fixes, errors = [], []
+    tokens = _fix_identifiers(tokenize(sql_query), index, fixes)
+    _check_references(tokens, index, errors)
+    return ValidationResult("".join(value for _, value in tokens), fixes, errors)
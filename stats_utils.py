@@ -0,0 +1,8 @@
+"""Small statistics helpers shared by the runtime metrics and the offline tools."""
+
+
+def percentile(values: list, pct: float) -> float:
+    """Nearest-rank percentile (pct in 0-100) of a non-empty list."""
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
@@ -0,0 +1,286 @@
+"""
+Per-turn tracing and per-stage latency metrics.
+
+A Trace collects the spans of one chat turn / request: stage name, start,
+duration and attributes (tokens, rows and bytes returned, retry attempt,
+error). finish() appends the turn to a JSONL trace file (TRACE_LOG_FILE,
+empty to disable) and feeds the process-wide StageMetrics, which keeps the
+most recent durations of each stage for p50 / p95 / p99 plus cumulative
+counters, and renders both as Prometheus text.
+
+LLM calls are traced by attaching an LLMTraceHandler to the ChatOpenAI
+callbacks; it records one "llm" span per call with token counts and the
+time to the first streamed token.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from langchain.callbacks.base import BaseCallbackHandler
+
+from stats_utils import percentile
+from llm_cache import CACHED_FLAG
+
+TRACE_LOG_FILE = "logs/traces.jsonl"
+_FROM_ENV = object()
+METRIC_PREFIX = "text_to_sql"
+QUANTILES = (50, 95, 99)
+CHARS_PER_TOKEN = 4
+
+
+# --------------------------- #
+#     METRICS
+# --------------------------- #
+class StageMetrics:
+    """
+    Latency per stage over the last `window` observations (for quantiles),
+    plus cumulative counts / sums and counters since the process started.
+    """
+    def __init__(self, window: int = 2048):
+        self.window = window
+        self._recent = defaultdict(lambda: deque(maxlen=self.window))
+        self._count = defaultdict(int)
+        self._sum = defaultdict(float)
+        self._counters = defaultdict(float)  # (name, label value) -> total
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self._recent[stage].append(seconds)
+            self._count[stage] += 1
+            self._sum[stage] += seconds
+
+    def increment(self, name: str, value: float = 1, label: str = "") -> None:
+        with self._lock:
+            self._counters[(name, label)] += value
+
+    def record_trace(self, trace: "Trace") -> None:
+        """Fold a finished turn into the aggregates."""
+        for span in trace.spans:
+            self.observe(span["name"], span["seconds"])
+            if span["name"] == "llm":
+                self.increment("llm_calls", 1, "cache" if span.get("cached") else "upstream")
+                if not span.get("cached"):
+                    self.increment("llm_tokens", span.get("prompt_tokens") or 0, "prompt")
+                    self.increment("llm_tokens", span.get("completion_tokens") or 0, "completion")
+                if "first_token_seconds" in span:
+                    self.observe("first_token", span["first_token_seconds"])
+        self.observe("turn", trace.seconds)
+        self.increment("turns", 1, trace.attrs.get("action", ""))
+        self.increment("rows_returned", trace.attrs.get("rows") or 0)
+        self.increment("bytes_returned", trace.attrs.get("bytes") or 0)
+        self.increment("sql_retries", trace.attrs.get("retries") or 0)
+        if trace.attrs.get("error"):
+            self.increment("turn_errors", 1, trace.attrs.get("action", ""))
+
+    def summary(self) -> dict:
+        """{stage: {"count", "p50", "p95", "p99", "mean"}} in seconds (quantiles over the window)."""
+        with self._lock:
+            recent = {stage: list(values) for stage, values in self._recent.items()}
+            counts, sums = dict(self._count), dict(self._sum)
+        return {
+            stage: {
+                "count": counts[stage],
+                **{f"p{q}": percentile(values, q) for q in QUANTILES},
+                "mean": sums[stage] / counts[stage],
+            }
+            for stage, values in sorted(recent.items()) if values
+        }
+
+    def prometheus_text(self) -> str:
+        """The metrics in the Prometheus text exposition format (0.0.4)."""
+        lines = [
+            f"# HELP {METRIC_PREFIX}_stage_seconds Latency of a pipeline stage (quantiles over recent turns).",
+            f"# TYPE {METRIC_PREFIX}_stage_seconds summary",
+        ]
+        summary = self.summary()
+        for stage, stats in summary.items():
+            for q in QUANTILES:
+                lines.append(f'{METRIC_PREFIX}_stage_seconds{{stage="{stage}",quantile="{q / 100:g}"}} '
+                             f'{stats[f"p{q}"]:.6f}')
+            lines.append(f'{METRIC_PREFIX}_stage_seconds_sum{{stage="{stage}"}} '
+                         f'{stats["mean"] * stats["count"]:.6f}')
+            lines.append(f'{METRIC_PREFIX}_stage_seconds_count{{stage="{stage}"}} {stats["count"]}')
+        with self._lock:
+            counters = dict(self._counters)
+        label_names = {"llm_calls": "source", "llm_tokens": "type", "turns": "action", "turn_errors": "action"}
+        for name in sorted({name for name, _ in counters}):
+            metric = f"{METRIC_PREFIX}_{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+            for (counter, label), value in sorted(counters.items()):
+                if counter != name:
+                    continue
+                labels = f'{{{label_names[name]}="{label}"}}' if name in label_names else ""
+                lines.append(f"{metric}{labels} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.rstrip("/") != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.metrics.prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_metrics_server(metrics: StageMetrics, port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Serve GET /metrics on a background thread (for processes without their own HTTP routes)."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    server.metrics = metrics
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+# --------------------------- #
+#     TRACES
+# --------------------------- #
+class Trace:
+    """
+    The spans of one turn; spans may be added from several threads. path
+    defaults to TRACE_LOG_FILE from the environment; None disables the file.
+    """
+    def __init__(self, metrics: StageMetrics = None, path=_FROM_ENV, **attrs):
+        if path is _FROM_ENV:
+            path = os.getenv("TRACE_LOG_FILE", TRACE_LOG_FILE)
+        self.trace_id = uuid.uuid4().hex
+        self.metrics = metrics
+        self.path = Path(path) if path else None
+        self.attrs = dict(attrs)
+        self.spans = []
+        self.started = time.time()
+        self.seconds = None
+        self._lock = threading.Lock()
+
+    def add(self, name: str, start: float, seconds: float, **attrs) -> dict:
+        span = {"name": name, "start": start, "seconds": seconds, **attrs}
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    def extend(self, spans: list) -> None:
+        """Add spans recorded elsewhere, e.g. SQLAnswer.spans."""
+        for span in spans:
+            self.add(**span)
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        """Time a block; the yielded dict takes extra attributes (rows, tokens, ...)."""
+        started = time.time()
+        extra = dict(attrs)
+        try:
+            yield extra
+        except Exception as e:
+            extra["error"] = str(e)[:500]
+            raise
+        finally:
+            self.add(name, started, time.time() - started, **extra)
+
+    def set(self, **attrs) -> None:
+        self.attrs.update(attrs)
+
+    def finish(self, **attrs) -> dict:
+        """Close the turn: write it to the trace file and the metrics. Returns the record."""
+        self.attrs.update(attrs)
+        self.seconds = time.time() - self.started
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s["start"])
+        record = {
+            "trace_id": self.trace_id,
+            "ts": self.started,
+            "seconds": round(self.seconds, 4),
+            **self.attrs,
+            "spans": [
+                {**s, "start": round(s["start"] - self.started, 4), "seconds": round(s["seconds"], 4)}
+                for s in spans
+            ],
+        }
+        if self.metrics is not None:
+            self.metrics.record_trace(self)
+        if self.path is not None:
+            _append_jsonl(self.path, record)
+        return record
+
+
+_write_lock = threading.Lock()
+
+
+def _append_jsonl(path: Path, record: dict) -> None:
+    try:
+        with _write_lock:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, "a", encoding="utf-8") as file:
+                file.write(json.dumps(record, default=str) + "\n")
+    except OSError:
+        pass  # tracing must never break a turn
+
+
+class LLMTraceHandler(BaseCallbackHandler):
+    """
+    Records an "llm" span per call on the current trace (set .trace per
+    turn): duration, prompt / completion tokens and the time to the first
+    streamed token. Streamed calls report no usage, so their completion
+    tokens are the streamed tokens and prompt tokens are estimated at
+    CHARS_PER_TOKEN characters each. Completions replayed from the LLM
+    cache are marked cached=True.
+    """
+    def __init__(self, label: str, trace: Trace = None):
+        self.label = label
+        self.trace = trace
+        self._calls = {}  # run_id -> {"start", "tokens", "first_token"}
+        self._lock = threading.Lock()
+
+    def _start(self, run_id, prompt_chars: int):
+        with self._lock:
+            self._calls[run_id] = {"start": time.time(), "tokens": 0, "first_token": None,
+                                   "prompt_chars": prompt_chars}
+
+    def on_llm_start(self, serialized, prompts, *, run_id=None, **kwargs):
+        self._start(run_id, sum(len(p) for p in prompts))
+
+    def on_chat_model_start(self, serialized, messages, *, run_id=None, **kwargs):
+        self._start(run_id, sum(len(str(m.content)) for batch in messages for m in batch))
+
+    def on_llm_new_token(self, token: str, *, run_id=None, **kwargs):
+        call = self._calls.get(run_id)
+        if call is not None:
+            call["tokens"] += 1
+            if call["first_token"] is None:
+                call["first_token"] = time.time() - call["start"]
+
+    def _finish(self, run_id, **attrs):
+        with self._lock:
+            call = self._calls.pop(run_id, None)
+        if call is None or self.trace is None:
+            return
+        if call["first_token"] is not None:
+            attrs["first_token_seconds"] = call["first_token"]
+        self.trace.add("llm", call["start"], time.time() - call["start"], llm=self.label, **attrs)
+
+    def on_llm_end(self, response, *, run_id=None, **kwargs):
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        call = self._calls.get(run_id) or {}
+        cached = any((g.generation_info or {}).get(CACHED_FLAG) for gs in response.generations for g in gs)
+        self._finish(
+            run_id,
+            cached=cached,
+            prompt_tokens=usage.get("prompt_tokens") or call.get("prompt_chars", 0) // CHARS_PER_TOKEN,
+            completion_tokens=usage.get("completion_tokens") or call.get("tokens"),
+        )
+
+    def on_llm_error(self, error, *, run_id=None, **kwargs):
+        self._finish(run_id, error=str(error)[:500])